@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# aioprotocol.py - asyncio transport for the Bitcoin protocol.
+#
+# Copyright (c) Addy Yeow Chin Heng <ayeowch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+asyncio transport for the Bitcoin protocol.
+
+AsyncConnection mirrors the request methods of protocol.Connection on top of
+an asyncio.Protocol and reuses Serializer for framing, so it runs on any
+asyncio event loop, e.g. uvloop, without gevent monkey-patching. Methods
+that wait for a response return futures to be awaited (Python 3) or yielded
+from (trollius on Python 2):
+
+    conn = AsyncConnection(("127.0.0.1", 8333))
+    yield From(conn.open())
+    version_msgs = yield From(conn.handshake())
+    addr_msgs = yield From(conn.getaddr())
+    conn.close()
+"""
+
+import random
+import socket
+from collections import deque
+
+try:
+    import asyncio
+except ImportError:  # Python 2
+    import trollius as asyncio
+
+from protocol import (
+    HEADER_LEN,
+    INBOX_SIZE,
+    PROTOCOL_VERSION,
+    SOCKET_TIMEOUT,
+    ConnectionError,
+    ProtocolError,
+    RemoteHostClosedConnection,
+    Serializer,
+)
+
+
+def then(future, callback):
+    """
+    Returns a future for the result of callback(result of future). If
+    callback returns a future, the returned future follows it. Exceptions
+    raised by future or callback are set on the returned future.
+    """
+    loop = future._loop
+    result = asyncio.Future(loop=loop)
+
+    def follow(inner):
+        if result.cancelled():
+            return
+        if inner.cancelled():
+            result.cancel()
+        elif inner.exception() is not None:
+            result.set_exception(inner.exception())
+        else:
+            result.set_result(inner.result())
+
+    def done(future):
+        if result.cancelled():
+            return
+        if future.cancelled():
+            result.cancel()
+            return
+        if future.exception() is not None:
+            result.set_exception(future.exception())
+            return
+        try:
+            value = callback(future.result())
+        except Exception as err:
+            result.set_exception(err)
+            return
+        if isinstance(value, asyncio.Future):
+            value.add_done_callback(follow)
+        else:
+            result.set_result(value)
+
+    future.add_done_callback(done)
+    return result
+
+
+class BitcoinProtocol(asyncio.Protocol):
+    """
+    Passes transport events to the AsyncConnection that created it.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def connection_made(self, transport):
+        self.conn.connection_made(transport)
+
+    def data_received(self, data):
+        self.conn.data_received(data)
+
+    def connection_lost(self, exc):
+        self.conn.connection_lost(exc)
+
+
+class AsyncConnection(object):
+    """
+    Connection to a node over an asyncio transport. Received messages are
+    decoded as they arrive; ping and version are answered immediately and
+    other messages are passed to a pending wait_for() or kept in the inbox.
+    Connecting through a proxy is not supported.
+    """
+    def __init__(self, to_addr, from_addr=("0.0.0.0", 0), loop=None,
+                 **conf):
+        self.to_addr = to_addr
+        self.from_addr = from_addr
+        self.loop = loop or asyncio.get_event_loop()
+        self.serializer = Serializer(**conf)
+        # Policy used when reading messages, None to decode all messages
+        self.decode_policy = conf.get('decode_policy', None)
+        self.socket_timeout = conf.get('socket_timeout', SOCKET_TIMEOUT)
+        self.transport = None
+        self.rbuf = bytearray()  # receive buffer
+        self.inbox = deque([], maxlen=INBOX_SIZE)
+        self.waiters = []  # (commands, predicate, future) of wait_for()
+        self.error = None  # error closing the connection, if any
+
+    def open(self):
+        """
+        Returns a future that is done once connected; it fails with
+        socket.timeout if the connection takes longer than socket timeout.
+        """
+        local_addr = self.from_addr
+        if ":" in self.to_addr[0] and ":" not in local_addr[0]:
+            local_addr = None  # IPv4 address cannot be bound for IPv6 peer
+        connect = asyncio.ensure_future(self.loop.create_connection(
+            lambda: BitcoinProtocol(self), self.to_addr[0], self.to_addr[1],
+            local_addr=local_addr), loop=self.loop)
+        timer = self.loop.call_later(self.socket_timeout, connect.cancel)
+        result = asyncio.Future(loop=self.loop)
+
+        def connected(future):
+            timer.cancel()
+            if future.cancelled():
+                result.set_exception(socket.timeout("timed out"))
+            elif future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(None)
+
+        connect.add_done_callback(connected)
+        return result
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        if self.error is not None:
+            return
+        self.error = exc
+        if exc is None:
+            self.error = RemoteHostClosedConnection(
+                "{} closed connection".format(self.to_addr))
+        for (_, _, future) in self.waiters:
+            if not future.done():
+                future.set_exception(self.error)
+        self.waiters = []
+
+    def send(self, data):
+        if self.transport is None or self.error is not None:
+            raise ConnectionError("{} not connected".format(self.to_addr))
+        self.transport.write(data)
+
+    def data_received(self, data):
+        self.rbuf.extend(data)
+
+        offset = 0
+        try:
+            while len(self.rbuf) - offset >= HEADER_LEN:
+                header = self.serializer.deserialize_header(self.rbuf, offset)
+                if len(self.rbuf) - offset < HEADER_LEN + header['length']:
+                    break
+                (msg, offset) = self.serializer.deserialize_msg_at(
+                    memoryview(self.rbuf), offset, policy=self.decode_policy)
+                self.dispatch(msg)
+        except ProtocolError as err:
+            self.transport.close()
+            self.connection_lost(err)
+            return
+        if offset > 0:
+            del self.rbuf[:offset]  # in place, partial frame is kept
+
+    def dispatch(self, msg):
+        command = msg.get('command')
+        if command == b"ping":
+            self.pong(msg['nonce'])  # respond to ping immediately
+        elif command == b"version":
+            self.verack()  # respond to version immediately
+        for waiter in self.waiters:
+            (commands, predicate, future) = waiter
+            if command not in commands or future.done():
+                continue
+            if predicate is None or predicate(msg):
+                self.waiters.remove(waiter)
+                future.set_result(msg)
+                return
+        self.inbox.append(msg)
+
+    def wait_for(self, commands, predicate=None, timeout=None):
+        """
+        Returns a future for the first received message with one of the
+        commands for which predicate, if specified, returns True. The
+        future's result is None if no such message arrives within timeout
+        seconds (defaults to socket timeout).
+        """
+        future = asyncio.Future(loop=self.loop)
+        for msg in self.inbox:
+            if msg.get('command') not in commands:
+                continue
+            if predicate is None or predicate(msg):
+                self.inbox.remove(msg)
+                future.set_result(msg)
+                return future
+        if self.error is not None:
+            future.set_exception(self.error)
+            return future
+
+        if timeout is None:
+            timeout = self.socket_timeout
+        waiter = (commands, predicate, future)
+        self.waiters.append(waiter)
+
+        def expire():
+            if not future.done():
+                self.waiters.remove(waiter)
+                future.set_result(None)
+
+        timer = self.loop.call_later(max(timeout, 0), expire)
+        future.add_done_callback(lambda _: timer.cancel())
+        return future
+
+    def pop_messages(self, commands):
+        """
+        Removes and returns all messages with one of the commands that are
+        already in the inbox.
+        """
+        msgs = [m for m in self.inbox if m.get('command') in commands]
+        for msg in msgs:
+            self.inbox.remove(msg)
+        return msgs
+
+    def get_response(self, commands):
+        """
+        Returns a future for the first message with one of the commands
+        together with the other matching messages received so far.
+        """
+        return then(self.wait_for(commands), lambda msg: (
+            [] if msg is None else [msg] + self.pop_messages(commands)))
+
+    def set_min_version(self, version):
+        self.serializer.protocol_version = min(
+            self.serializer.protocol_version,
+            version.get(b'version', PROTOCOL_VERSION))
+
+    def handshake(self):
+        # [version] >>>
+        msg = self.serializer.serialize_msg(
+            command=b"version", to_addr=self.to_addr, from_addr=self.from_addr)
+        self.send(msg)
+
+        # <<< [version 124 bytes] [verack 24 bytes]
+        msgs = []
+        deadline = self.loop.time() + self.socket_timeout
+
+        def on_version(version):
+            if version is None:
+                return msgs
+            msgs.append(version)
+            self.set_min_version(version)
+            return then(self.wait_for(
+                [b"verack"], timeout=deadline - self.loop.time()), on_verack)
+
+        def on_verack(verack):
+            if verack is not None:
+                msgs.append(verack)
+            return msgs
+
+        return then(self.wait_for([b"version"]), on_version)
+
+    def verack(self):
+        # [verack] >>>
+        msg = self.serializer.serialize_msg(command=b"verack")
+        self.send(msg)
+
+    def getaddr(self):
+        # [getaddr] >>>
+        msg = self.serializer.serialize_msg(command=b"getaddr")
+        self.send(msg)
+
+        # <<< [addr]..
+        # Skip addr messages advertising only the node's own address.
+        return then(
+            self.wait_for([b"addr"], predicate=lambda m: m['count'] > 1),
+            lambda msg: (
+                [] if msg is None else [msg] + self.pop_messages([b"addr"])))
+
+    def addr(self, addr_list):
+        # addr_list = [(TIMESTAMP, SERVICES, "IP_ADDRESS", PORT),]
+        # [addr] >>>
+        msg = self.serializer.serialize_msg(
+            command=b"addr", addr_list=addr_list)
+        self.send(msg)
+
+    def ping(self, nonce=None):
+        if nonce is None:
+            nonce = random.getrandbits(64)
+
+        # [ping] >>>
+        msg = self.serializer.serialize_msg(command=b"ping", nonce=nonce)
+        self.send(msg)
+
+    def pong(self, nonce):
+        # [pong] >>>
+        msg = self.serializer.serialize_msg(command=b"pong", nonce=nonce)
+        self.send(msg)
+
+    def inv(self, inventory):
+        # inventory = [(INV_TYPE, "INV_HASH"),]
+        # [inv] >>>
+        msg = self.serializer.serialize_msg(
+            command=b"inv", inventory=inventory)
+        self.send(msg)
+
+    def getheaders(self, block_hashes, last_block_hash=None):
+        if last_block_hash is None:
+            last_block_hash = b"0" * 64
+
+        # block_hashes = ["BLOCK_HASH",]
+        # [getheaders] >>>
+        msg = self.serializer.serialize_msg(command=b"getheaders",
+                                            block_hashes=block_hashes,
+                                            last_block_hash=last_block_hash)
+        self.send(msg)
+
+        # <<< [headers]..
+        return self.get_response([b"headers"])
@@ -33,114 +33,494 @@ monkey.patch_all()
 
 import geoip2.database
 import gevent
+import gevent.lock
+import gevent.pool
+import gevent.queue
 import json
 import logging
 import os
+import random
 import redis
 import redis.connection
-import requests
 import socket
+import struct
 import sys
 import time
-from base64 import b32decode
-from binascii import hexlify, unhexlify
-from collections import Counter
+from binascii import unhexlify
+from collections import Counter, defaultdict, deque
 from configparser import ConfigParser
 from geoip2.errors import AddressNotFoundError
-from ipaddress import ip_address, ip_network
 import subprocess 
 
 from protocol import (
+    IPV4_PREFIX,
     ONION_PREFIX,
     TO_SERVICES,
     Connection,
     ConnectionError,
     ProtocolError,
+    pack_address,
+)
+from utils import (
+    NODE,
+    EPOCH_KEY,
+    MAX_TARGET,
+    AdaptiveLimit,
+    AddressFilter,
+    HashRing,
+    HeaderChain,
+    SeenFilter,
+    crawl_key,
+    fetch_networks,
+    get_epoch,
+    list_excluded_networks,
+    migrate_nodes,
+    new_redis_conn,
+    pack_node,
+    unlink,
+    unpack_node,
 )
-from utils import new_redis_conn, get_keys, ip_to_network
 
 redis.connection.socket = gevent.socket
 
 REDIS_CONN = None
 CONF = {}
 
+# Connect pipeline, see run(): probe() opens connections to claimed nodes
+# in PROBES and queues them in HANDSHAKES for handshake_worker(), holding
+# one of HANDSHAKE_SLOTS from spawn_probe() until the handshake ends
+PROBES = None
+HANDSHAKES = None
+HANDSHAKE_SLOTS = None
+# Adaptive limit on concurrent probe workers, None for a fixed pool size
+PROBE_LIMIT = None
+
+# Recent blocks shared by all workers for the block locator in get_txns(),
+# see bootstrap_chain()
+CHAIN = HeaderChain()
+
+# Peering nodes added into the crawl set by this process in the epoch, see
+# get_seen_filter()
+SEEN = {}
+
+# Scores added to a node in the crawl set, see add_pending(); nodes with the
+# highest score are claimed first
+REACHABLE_SCORE = 100.0  # reachable in the previous crawl
+ADVERTISED_SCORE = 1.0  # advertised just now with TO_SERVICES
+
+# Failure count and next eligible time of an unreachable node in the
+# crawl:failures hash, see record_failure()
+FAILURE = struct.Struct(">HI")
+
+# Pops up to ARGV[1] nodes with the highest score from the pending sorted
+# set and claims those that pass the checks previously made by task() for
+# each node in separate commands: IPv6 nodes are skipped unless ARGV[2] is
+# 1, nodes already in the nodes set (KEYS[4]) of the epoch are skipped and
+# at most ARGV[4] IPv6 nodes are claimed per /ARGV[3] prefix (counted in
+# KEYS[5]). Nodes in the failures hash (KEYS[3]) that are not eligible
+# before ARGV[8] are skipped unless sampled for a probe at rate ARGV[10];
+# skipped and probed nodes and the connect seconds (ARGV[11] per node) saved
+# are counted in the metrics hash (KEYS[6]) of the epoch. The epoch keys
+# are those of epoch ARGV[5]; if the current epoch differs, nothing is
+# popped. Returns the current epoch, the number of popped nodes and the
+# claimed members. See claim() for the arguments.
+CLAIM_NODES = """
+local epoch = tonumber(redis.call('GET', KEYS[2]) or 0)
+if epoch ~= tonumber(ARGV[5]) then
+    return {epoch, 0}
+end
+local nodes_key = KEYS[4]
+local cidr_key = KEYS[5]
+local metrics_key = KEYS[6]
+local ipv6 = ARGV[2] == '1'
+local prefix = tonumber(ARGV[3])
+local limit = tonumber(ARGV[4])
+local now = tonumber(ARGV[8])
+local probe_rate = tonumber(ARGV[10])
+math.randomseed(tonumber(ARGV[9]))
+local members = redis.call('ZREVRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #members > 0 then
+    redis.call('ZREM', KEYS[1], unpack(members))
+end
+local claimed = {epoch, #members}
+local skipped = 0
+local probed = 0
+for _, member in ipairs(members) do
+    local ip_addr = string.sub(member, 1, 16)
+    local is_ipv6 = string.sub(ip_addr, 1, 12) ~= ARGV[6] and
+        string.sub(ip_addr, 1, 6) ~= ARGV[7]
+    if (ipv6 or not is_ipv6) and
+            redis.call('SADD', nodes_key, member) == 1 then
+        local claim = true
+        local failure = redis.call('HGET', KEYS[3], member)
+        if failure then
+            local _, eligible = struct.unpack('>HI', failure)
+            if eligible > now then
+                if math.random() < probe_rate then
+                    probed = probed + 1
+                else
+                    skipped = skipped + 1
+                    claim = false
+                end
+            end
+        end
+        if claim and is_ipv6 and prefix < 128 then
+            local cidr = string.sub(ip_addr, 1, math.floor(prefix / 8))
+            local bits = prefix % 8
+            if bits > 0 then
+                local byte = string.byte(ip_addr, #cidr + 1)
+                cidr = cidr .. string.char(byte - byte % 2 ^ (8 - bits))
+            end
+            claim = redis.call('HINCRBY', cidr_key, cidr, 1) <= limit
+        end
+        if claim then
+            table.insert(claimed, member)
+        end
+    end
+end
+if skipped + probed > 0 then
+    redis.call('HINCRBY', metrics_key, 'skipped', skipped)
+    redis.call('HINCRBY', metrics_key, 'probed', probed)
+    redis.call('HINCRBY', metrics_key, 'saved', skipped * tonumber(ARGV[11]))
+end
+return claimed
+"""
+
+# Increments the failure count of the node ARGV[1] in the failures hash
+# (KEYS[1]) and makes it eligible for a crawl after ARGV[3] seconds from
+# ARGV[2], doubling with each consecutive failure up to ARGV[4] seconds.
+# Returns the failure count. See record_failure().
+RECORD_FAILURE = """
+local failure = redis.call('HGET', KEYS[1], ARGV[1])
+local count = 0
+if failure then
+    count = struct.unpack('>HI', failure)
+end
+count = math.min(count + 1, 65535)
+local backoff = math.min(tonumber(ARGV[3]) * 2 ^ math.min(count - 1, 32),
+                         tonumber(ARGV[4]))
+redis.call('HSET', KEYS[1], ARGV[1],
+           struct.pack('>HI', count, tonumber(ARGV[2]) + backoff))
+return count
+"""
+
 # MaxMind databases
 # ASN = geoip2.database.Reader("geoip/GeoLite2-ASN.mmdb")
 
 
-def enumerate_node(redis_pipe, addr_msgs, now):
+def get_seen_filter(epoch):
     """
-    Adds all peering nodes with age <= max. age into the crawl set.
+    Returns the seen filter of this process for the crawl epoch, replacing
+    the filter of the previous epoch.
+    """
+    if SEEN.get('epoch') != epoch:
+        SEEN['epoch'] = epoch
+        SEEN['filter'] = SeenFilter(CONF['seen_capacity'],
+                                    CONF['seen_error_rate'])
+    return SEEN['filter']
+
+
+def enumerate_node(redis_pipe, addr_msgs, now, epoch):
+    """
+    Adds all peering nodes with age <= max. age into the crawl set. Nodes
+    already added max. advertisements times by this process in the epoch
+    are dropped (once with the random schedule, for which adding again has
+    no effect).
     """
     peers = 0
     excluded = 0
+    seen = get_seen_filter(epoch)
+    limit = CONF['max_advertisements']
+    if CONF['schedule'] == "random":
+        limit = 1
 
     logging.debug('Num addr_msgs is: %d', len(addr_msgs))
     # logging.debug('First addr msg: %s', addr_msgs[0])
     for addr_msg in addr_msgs:
-        if 'addr_list' in addr_msg:
-            for peer in addr_msg['addr_list']:
-                age = now - peer['timestamp']  # seconds
-                # logging.debug('Peer age: %s', age)
-
-                if age >= 0 and age <= CONF['max_age']:
-                    address = peer['ipv4'] or peer['ipv6'] or peer['onion']
-                    logging.debug('Address: %s', address)
-                    port = peer['port'] if peer['port'] > 0 else CONF['port']
-                    services = peer['services']
-                    if not address:
-                        continue
-                    if is_excluded(address):
-                        logging.debug("Exclude: (%s, %d)", address, port)
-                        excluded += 1
-                        continue
-                    redis_pipe.sadd('pending', (address, port, services))
-                    peers += 1
-                    if peers >= CONF['peers_per_node']:
-                        return (peers, excluded)
+        if 'addr_list' not in addr_msg:
+            continue
+        (addr_list, addr_excluded) = filter_addr_list(
+            addr_msg['addr_list'], now)
+        excluded += addr_excluded
+        for (age, services, ip_addr, port) in addr_list:
+            # Raw address is stored as is, see utils.pack_node()
+            port = port if port > 0 else CONF['port']
+            member = NODE.pack(ip_addr, port, services)
+            if seen.check(member, limit):
+                add_pending(redis_pipe, score_peer(services, age), member)
+            peers += 1
+            if peers >= CONF['peers_per_node']:
+                return (peers, excluded)
 
     return (peers, excluded)
 
 
-def connect(redis_conn, key):
+def score_peer(services, age):
     """
-    Establishes connection with a node to:
-    1) Send version message
-    2) Receive version and verack message
-    3) Send getaddr message
-    4) Receive addr message containing list of peering nodes
-    Stores state and height for node in Redis.
+    Returns score added to a peering node advertised with services age
+    seconds ago. Nodes advertised by more peers, more recently and with
+    TO_SERVICES accumulate higher scores.
     """
-    handshake_msgs = []
-    addr_msgs = []
+    score = ADVERTISED_SCORE * (1.0 - float(age) / CONF['max_age'])
+    if services & TO_SERVICES != TO_SERVICES:
+        score /= 2
+    return score
+
+
+def add_pending(redis_conn, score, *members):
+    """
+    Adds score to members in the crawl set, or in the pending shards owning
+    them if the crawl set is sharded. With the random schedule, members are
+    added once with a random score instead.
+    """
+    shards = defaultdict(list)
+    for member in members:
+        shard = 0
+        if CONF['shard_ring'] is not None:
+            shard = CONF['shard_ring'].shard(member)
+        shards[shard].append(member)
+    for (shard, shard_members) in shards.items():
+        key = CONF['pending_keys'][shard]
+        for member in shard_members:
+            if CONF['schedule'] == "random":
+                redis_conn.execute_command(
+                    'ZADD', key, 'NX', random.random(), member)
+            else:
+                redis_conn.zincrby(key, member, score)
+
 
-    redis_conn.set(key, "")  # Set Redis key for a new node
+def count_pending():
+    """
+    Returns the number of nodes in the crawl set across all pending shards.
+    """
+    redis_pipe = REDIS_CONN.pipeline()
+    for key in CONF['pending_keys']:
+        redis_pipe.zcard(key)
+    return sum(redis_pipe.execute())
+
+
+def filter_addr_list(addr_list, now):
+    """
+    Returns (age, services, 16 bytes IP_ADDR, port) of the peers in AddrList
+    with age <= max. age that are not excluded, and the number of excluded
+    peers.
+    """
+    flags = CONF['exclude_filter'].excluded(addr_list.addresses)
+    peers = []
+    excluded = 0
+    for (timestamp, services, ip_addr, port, is_excluded) in zip(
+            addr_list.timestamps, addr_list.services, addr_list.addresses,
+            addr_list.ports, flags):
+        age = now - timestamp  # seconds
+        if age < 0 or age > CONF['max_age']:
+            continue
+        if is_excluded:
+            excluded += 1
+            continue
+        peers.append((age, services, ip_addr, port))
+    return (peers, excluded)
 
-    (address, port, services) = key[5:].split("-", 2)
-    services = int(services)
-    height = redis_conn.get('height')
+
+class Stage(object):
+    """
+    Counters of a connect pipeline stage: nodes waiting for and in the
+    stage, and nodes completed and their latency since the last report.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.queued = 0
+        self.active = 0
+        self.done = 0
+        self.failed = 0
+        self.seconds = 0.0
+
+    def start(self):
+        """
+        Moves a queued node into the stage and returns its start time.
+        """
+        self.queued -= 1
+        self.active += 1
+        return time.time()
+
+    def finish(self, start, failed=False):
+        self.active -= 1
+        self.done += 1
+        self.failed += int(failed)
+        self.seconds += time.time() - start
+
+    def report(self, redis_pipe, epoch):
+        """
+        Logs the counters, adds completed nodes and their latency into the
+        metrics of the crawl epoch and resets them.
+        """
+        latency = self.seconds / self.done if self.done else 0.0
+        logging.info("%s: queued %d, active %d, done %d (failed %d), "
+                     "latency %.3fs", self.name, self.queued, self.active,
+                     self.done, self.failed, latency)
+        metrics_key = crawl_key(epoch, 'metrics')
+        redis_pipe.hincrby(metrics_key, self.name + ':done', self.done)
+        redis_pipe.hincrby(metrics_key, self.name + ':failed', self.failed)
+        redis_pipe.hincrbyfloat(metrics_key, self.name + ':seconds',
+                                self.seconds)
+        self.done = 0
+        self.failed = 0
+        self.seconds = 0.0
+
+
+PROBE_STAGE = Stage('probe')
+HANDSHAKE_STAGE = Stage('handshake')
+
+
+def new_connection(node):
+    """
+    Returns an unopened connection to the node. The connection is opened
+    within probe timeout unless it is made through the Tor proxy.
+    """
+    (address, port, services) = node
+    height = REDIS_CONN.get('height')
     if height:
         height = int(height)
 
     proxy = None
+    connect_timeout = CONF['probe_timeout']
     if address.endswith(".onion"):
         proxy = CONF['tor_proxy']
+        connect_timeout = CONF['socket_timeout']
 
-    conn = Connection((address, int(port)),
+    return Connection((address, int(port)),
                       (CONF['source_address'], 0),
                       magic_number=CONF['magic_number'],
                       socket_timeout=CONF['socket_timeout'],
+                      connect_timeout=connect_timeout,
                       proxy=proxy,
                       protocol_version=CONF['protocol_version'],
                       to_services=services,
                       from_services=CONF['services'],
                       user_agent=CONF['user_agent'],
                       height=height,
-                      relay=CONF['relay'])
+                      relay=CONF['relay'],
+                      lazy_blocks=True)
+
+
+def probe(epoch, node):
+    """
+    Stage one of the connect pipeline: opens a connection to the node with
+    the handshake slot reserved by spawn_probe() and queues it for
+    handshake_worker(), which releases the slot. Records a failure if the
+    node is unreachable.
+    """
+    start = PROBE_STAGE.start()
+    conn = new_connection(node)
     try:
         logging.debug("Connecting to %s", conn.to_addr)
         conn.open()
-        handshake_msgs = conn.handshake()  # Sends version, receives version and verack
+    except (ProtocolError, ConnectionError, socket.error) as err:
+        logging.debug("Error connecting to %s: %s", conn.to_addr, err)
+        conn.close()
+        HANDSHAKE_SLOTS.release()
+        PROBE_STAGE.finish(start, failed=True)
+        record_failure(REDIS_CONN, pack_node(*node), int(time.time()))
+        return
+    PROBE_STAGE.finish(start)
+    if PROBE_LIMIT is not None:
+        PROBE_LIMIT.sample(time.time() - start)
+    HANDSHAKE_STAGE.queued += 1
+    HANDSHAKES.put((epoch, node, conn))
+
+
+def spawn_probe(epoch, node):
+    """
+    Reserves a handshake slot and spawns probe() for the node in the probe
+    pool, blocking while no slot is free, the probe limit is reached or
+    the pool is full.
+    """
+    # Reserved before opening so that opened connections never wait for a
+    # handshake worker and go stale, and before the probe limit so that
+    # waiting for a slot is not counted as an active probe
+    HANDSHAKE_SLOTS.acquire()
+    if PROBE_LIMIT is None:
+        PROBES.spawn(probe, epoch, node)
+        return
+    PROBE_LIMIT.acquire()
+    PROBES.spawn(probe, epoch, node).link(lambda _: PROBE_LIMIT.release())
+
+
+def handshake_worker():
+    """
+    Stage two of the connect pipeline: runs connect() on the connections
+    opened by probe().
+    """
+    redis_conn = new_redis_conn(db=CONF['db'])
+    while True:
+        (epoch, node, conn) = HANDSHAKES.get()
+        start = HANDSHAKE_STAGE.start()
+        try:
+            reachable = connect(redis_conn, epoch, node, conn)
+        finally:
+            HANDSHAKE_SLOTS.release()
+        HANDSHAKE_STAGE.finish(start, failed=not reachable)
+
+
+def report_stages():
+    """
+    Periodically reports the counters of the connect pipeline stages, of
+    the seen filter and of the probe limit, and saves the recent blocks of
+    the header chain.
+    """
+    while True:
+        gevent.sleep(CONF['cron_delay'])
+        redis_pipe = REDIS_CONN.pipeline()
+        epoch = get_epoch(REDIS_CONN)
+        for stage in (PROBE_STAGE, HANDSHAKE_STAGE):
+            stage.report(redis_pipe, epoch)
+        seen = get_seen_filter(epoch)
+        hit_rate = float(seen.dropped) / seen.checked if seen.checked else 0.0
+        logging.info("seen: checked %d, dropped %d (hit rate %.3f)",
+                     seen.checked, seen.dropped, hit_rate)
+        metrics_key = crawl_key(epoch, 'metrics')
+        redis_pipe.hincrby(metrics_key, 'seen:checked', seen.checked)
+        redis_pipe.hincrby(metrics_key, 'seen:dropped', seen.dropped)
+        seen.checked = 0
+        seen.dropped = 0
+        if PROBE_LIMIT is not None:
+            logging.info("probe limit: %d, increases %d, decreases %d",
+                         PROBE_LIMIT.limit, PROBE_LIMIT.increases,
+                         PROBE_LIMIT.decreases)
+            redis_pipe.hincrby(metrics_key, 'probe:increases',
+                               PROBE_LIMIT.increases)
+            redis_pipe.hincrby(metrics_key, 'probe:decreases',
+                               PROBE_LIMIT.decreases)
+            PROBE_LIMIT.increases = 0
+            PROBE_LIMIT.decreases = 0
+        if CHAIN.height >= 0:
+            # Bootstraps the header chain of the next crawl process
+            redis_pipe.delete('crawl:blockhashes')
+            redis_pipe.rpush('crawl:blockhashes', CHAIN.tip(),
+                             *CHAIN.locator())
+        redis_pipe.execute()
+
+
+def connect(redis_conn, epoch, node, conn):
+    """
+    Uses an open connection with a node to:
+    1) Send version message
+    2) Receive version and verack message
+    3) Send getaddr message
+    4) Receive addr message containing list of peering nodes
+    Stores state and height for node in Redis under the crawl epoch and
+    records a failure if the node is unreachable. Returns True if the
+    handshake succeeded.
+    """
+    handshake_msgs = []
+    addr_msgs = []
+
+    (address, port, services) = node
+    try:
+        with conn.batch():
+            handshake_msgs = conn.handshake()  # Sends version, receives version and verack
+            if len(handshake_msgs) > 0:
+                # Queued getaddr is sent together with our verack
+                conn.getaddr(block=False)
         logging.debug('Finished processing handshake messages.')
 
     except (ProtocolError, ConnectionError, socket.error) as err:
@@ -149,53 +529,70 @@ def connect(redis_conn, key):
     redis_pipe = redis_conn.pipeline()
     if len(handshake_msgs) > 0:
         try:
-            conn.getaddr(block=False) # Send the getaddr message and wait for addr messages to be sent in return
+            # Returns as soon as addr messages arrive
+            addr_msgs = conn.wait_for_addr()
         except (ProtocolError, ConnectionError, socket.error) as err:
             logging.debug("Error in conn.getaddr: %s: %s", conn.to_addr, err)
-        else:
-            addr_wait = 0
-            while addr_wait < CONF['socket_timeout']:
-                addr_wait += 1
-                gevent.sleep(0.3)
-                try:
-                    msgs = conn.get_messages(commands=[b'addr'])
-                except (ProtocolError, ConnectionError, socket.error) as err:
-                    logging.debug("No 'addr' messages received in response to 'getaddr', %s: %s", conn.to_addr, err)
-                    break
-                if msgs and any([msg['count'] > 1 for msg in msgs]):
-                    addr_msgs = msgs
-                    break
 
         version_msg = handshake_msgs[0]
         from_services = version_msg.get('services', 0)
         if from_services != services:
             logging.debug("%s Expected %d, got %d for services", conn.to_addr,
                           services, from_services)
-            key = "node:{}-{}-{}".format(address, port, from_services)
-        height_key = "height:{}-{}-{}".format(address, port, from_services)
-        redis_pipe.setex(height_key, CONF['max_age'],
-                         version_msg.get('height', 0))
+        node = pack_node(address, port, from_services)
+        redis_pipe.hset(crawl_key(epoch, 'height'), node,
+                        version_msg.get('height', 0))
         now = int(time.time())
-        (peers, excluded) = enumerate_node(redis_pipe, addr_msgs, now)
+        (peers, excluded) = enumerate_node(redis_pipe, addr_msgs, now,
+                                           epoch)
         logging.debug("%s Peers: %d (Excluded: %d)",
                       conn.to_addr, peers, excluded)
-        redis_pipe.set(key, "")
-        redis_pipe.sadd('up', key)
+        redis_pipe.sadd(crawl_key(epoch, 'nodes'), node)
+        redis_pipe.sadd(crawl_key(epoch, 'up'), node)
+        redis_pipe.zadd('crawl:reachable', now, node)
+        redis_pipe.hdel('crawl:failures', pack_node(address, port, services))
     
         # Now try sending mempool and getblocks to get the txn lists from a node.
         get_txns(conn)
+    else:
+        record_failure(redis_conn, pack_node(address, port, services),
+                       int(time.time()))
     
     conn.close()
     redis_pipe.execute()
+    return len(handshake_msgs) > 0
 
 def get_recent_blockhashes():
     blockhashes = subprocess.check_output(['./get_recent_blockhashes.sh']).split(b'\n')[:-1]
     return blockhashes
 
+
+def bootstrap_chain():
+    """
+    Bootstraps the header chain from the block hashes saved by a previous
+    crawl, or from bitcoind if there are none. The chain is then kept up to
+    date from the headers messages received in get_txns().
+    """
+    global CHAIN
+    CHAIN = HeaderChain(CONF['header_chain_size'],
+                        int(MAX_TARGET / CONF['min_difficulty']))
+    blockhashes = REDIS_CONN.lrange('crawl:blockhashes', 0, -1)
+    if not blockhashes:
+        try:
+            blockhashes = get_recent_blockhashes()
+        except (OSError, subprocess.CalledProcessError) as err:
+            logging.warning("Bootstrap from bitcoind failed: %s", err)
+    CHAIN.bootstrap(blockhashes)
+    logging.info("Header chain: %d blocks", CHAIN.height + 1)
+
+
 def get_txns(conn):
     logging.debug("Sending getheaders, expecting headers")
     print('Sending getheaders')
-    blockhashes = get_recent_blockhashes()
+    blockhashes = CHAIN.locator()
+    if not blockhashes:
+        logging.debug('Header chain is empty, exiting get_txns')
+        return
     headers = conn.getheaders(blockhashes, last_block_hash=blockhashes[0])
     if len(headers) >= 1:
         logging.debug('Got %d headers, sending getblocks, expecting inv', len(headers))
@@ -205,6 +602,8 @@ def get_txns(conn):
         return
     hashes = []
     for header_msg in headers:
+        if CHAIN.add(header_msg['headers']) > 0:
+            logging.info("Tip: %s", CHAIN.tip())
         for header in header_msg['headers']:
             try:
                 hashes.append(header['block_hash'])
@@ -234,23 +633,28 @@ def get_txns(conn):
 
     logging.debug("Exiting get_txns")
 
-def dump(timestamp, nodes):
+def dump(timestamp, epoch, nodes):
     """
-    Dumps data for reachable nodes into timestamp-prefixed JSON file and
-    returns most common height from the nodes.
+    Dumps data for reachable nodes from the crawl epoch into
+    timestamp-prefixed JSON file and returns most common height from the
+    nodes.
     """
     json_data = []
 
     logging.info('Building JSON data')
-    for node in nodes:
-        (address, port, services) = node[5:].split("-", 2)
-        height_key = "height:{}-{}-{}".format(address, port, services)
+    nodes = list(nodes)
+    heights = []
+    if nodes:
+        heights = REDIS_CONN.hmget(crawl_key(epoch, 'height'), nodes)
+    for (node, height) in zip(nodes, heights):
+        (address, port, services) = unpack_node(node)
         try:
-            height = int(REDIS_CONN.get(height_key))
+            height = int(height)
         except TypeError:
-            logging.warning("%s missing", height_key)
+            logging.warning("Height for %s-%d-%d missing", address, port,
+                            services)
             height = 0
-        json_data.append([address, int(port), int(services), height])
+        json_data.append([address, port, services, height])
     logging.info('Built JSON data: %d', len(json_data))
 
     if len(json_data) == 0:
@@ -264,28 +668,47 @@ def dump(timestamp, nodes):
     return Counter([node[-1] for node in json_data]).most_common(1)[0][0]
 
 
+def new_epoch():
+    """
+    Starts a new crawl epoch and returns the id of the previous epoch. State
+    of the previous epoch is kept for export.py; older epochs are removed.
+    """
+    epoch = REDIS_CONN.incr(EPOCH_KEY)
+    unlink(REDIS_CONN, *[crawl_key(epoch - 2, name)
+                         for name in ('nodes', 'up', 'height', 'cidr',
+                                      'metrics')])
+    return epoch - 1
+
+
+def load_reachable(redis_pipe, timestamp):
+    """
+    Adds nodes reachable within max. age into the crawl set with a score
+    decaying with the time since they were last reachable.
+    """
+    start = timestamp - CONF['max_age']
+    history = REDIS_CONN.zrangebyscore(
+        'crawl:reachable', start, timestamp, withscores=True)
+    redis_pipe.zremrangebyscore('crawl:reachable', '-inf', '({}'.format(start))
+    for (node, last_up) in history:
+        score = REACHABLE_SCORE * (1.0 - (timestamp - last_up) /
+                                   CONF['max_age'])
+        add_pending(redis_pipe, score, node)
+    return len(history)
+
+
 def restart(timestamp):
     """
     Dumps data for the reachable nodes into a JSON file.
-    Loads all reachable nodes from Redis into the crawl set.
-    Removes keys for all nodes from current crawl.
+    Loads nodes reachable within max. age from Redis into the crawl set.
+    Starts a new crawl epoch.
     Updates excluded networks with current list of bogons.
     Updates number of reachable nodes and most common height in Redis.
     """
+    epoch = new_epoch()
     redis_pipe = REDIS_CONN.pipeline()
 
-    nodes = REDIS_CONN.smembers('up')  # Reachable nodes
-    redis_pipe.delete('up')
-
-    for node in nodes:
-        (address, port, services) = node[5:].split("-", 2)
-        redis_pipe.sadd('pending', (address, int(port), int(services)))
-
-    for key in get_keys(REDIS_CONN, 'node:*'):
-        redis_pipe.delete(key)
-
-    for key in get_keys(REDIS_CONN, 'crawl:cidr:*'):
-        redis_pipe.delete(key)
+    nodes = REDIS_CONN.smembers(crawl_key(epoch, 'up'))  # Reachable nodes
+    load_reachable(redis_pipe, timestamp)
 
     if CONF['include_checked']:
         checked_nodes = REDIS_CONN.zrangebyscore(
@@ -295,7 +718,8 @@ def restart(timestamp):
             if is_excluded(address):
                 logging.debug("Exclude: %s", address)
                 continue
-            redis_pipe.sadd('pending', (address, port, services))
+            add_pending(redis_pipe, ADVERTISED_SCORE,
+                        pack_node(address, port, services))
 
     redis_pipe.execute()
 
@@ -305,7 +729,14 @@ def restart(timestamp):
     logging.info("Reachable nodes: %d", reachable_nodes)
     REDIS_CONN.lpush('nodes', (timestamp, reachable_nodes))
 
-    height = dump(timestamp, nodes)
+    metrics = REDIS_CONN.hgetall(crawl_key(epoch, 'metrics'))
+    saved = int(metrics.get(b'saved', 0))
+    logging.info("Backoff: skipped %s, probed %s, saved %d connect-seconds",
+                 metrics.get(b'skipped', 0), metrics.get(b'probed', 0), saved)
+    REDIS_CONN.lpush('crawl:saved', (timestamp, saved))
+    logging.info("Pruned failures: %d", prune_failures(timestamp))
+
+    height = dump(timestamp, epoch, nodes)
     REDIS_CONN.set('height', height)
     logging.info("Height: %d", height)
 
@@ -320,7 +751,7 @@ def cron():
     start = int(time.time())
 
     while True:
-        pending_nodes = REDIS_CONN.scard('pending')
+        pending_nodes = count_pending()
         logging.info("Pending: %d", pending_nodes)
 
         if pending_nodes == 0:
@@ -344,55 +775,115 @@ def cron():
 
 
 def task_mock():
+    """
+    Replaces task() if mock nodes are configured: passes each mock node to
+    probe() once, bypassing the crawl set.
+    """
     redis_conn = new_redis_conn(db=CONF['db'])
-    node = b"('169.228.66.83', 8333, 1)"
-    logging.debug('Redis node: %s', node)
-    node = eval(node)  # Convert string from Redis to tuple
+    epoch = get_epoch(redis_conn)
+    for address in CONF['mock_nodes']:
+        node = (address, CONF['port'], TO_SERVICES)
+        logging.debug('Mock node: %s', node)
+        redis_conn.sadd(crawl_key(epoch, 'nodes'), pack_node(*node))
+
+        PROBE_STAGE.queued += 1
+        spawn_probe(epoch, node)
+    logging.debug('end of task_mock()')
 
-    key = "node:{}-{}-{}".format(node[0], node[1], node[2])
 
-    connect(redis_conn, key)
-    logging.debug('end of task_mock()')
+def claim(claim_nodes, key, epoch=0):
+    """
+    Claims a batch of nodes from the pending set in key using the
+    CLAIM_NODES script with the keys of the crawl epoch, retried with the
+    keys of the current epoch if it has changed. Returns the current epoch,
+    the number of popped nodes and the claimed members.
+    """
+    while True:
+        result = claim_nodes(
+            keys=[key, EPOCH_KEY, 'crawl:failures', crawl_key(epoch, 'nodes'),
+                  crawl_key(epoch, 'cidr'), crawl_key(epoch, 'metrics')],
+            args=[CONF['claim_batch'], int(CONF['ipv6']),
+                  CONF['ipv6_prefix'], CONF['nodes_per_ipv6_prefix'], epoch,
+                  IPV4_PREFIX, ONION_PREFIX, int(time.time()),
+                  random.getrandbits(31), CONF['probe_rate'],
+                  CONF['probe_timeout']])
+        if result[0] == epoch:
+            return (result[0], result[1], result[2:])
+        epoch = result[0]
+
+
+def record_failure(redis_conn, member, now):
+    """
+    Records a failed connection to the node in member. The node is not
+    eligible for a crawl for backoff seconds, doubling with each
+    consecutive failure up to max. backoff. The failure is updated by the
+    RECORD_FAILURE script so that concurrent workers do not lose updates.
+    Returns the failure count.
+    """
+    record = redis_conn.register_script(RECORD_FAILURE)
+    return record(keys=['crawl:failures'],
+                  args=[member, now, CONF['backoff'], CONF['max_backoff']])
+
+
+def prune_failures(now):
+    """
+    Removes failures of nodes that have not been eligible for max. backoff
+    seconds, i.e. no longer advertised or no longer failing, and the oldest
+    failures beyond max. failures. Returns the number of removed failures.
+    """
+    failures = []
+    stale = []
+    for (member, failure) in REDIS_CONN.hscan_iter('crawl:failures',
+                                                   count=1000):
+        eligible = FAILURE.unpack(failure)[1]
+        if eligible < now - CONF['max_backoff']:
+            stale.append(member)
+        else:
+            failures.append((eligible, member))
+    if len(failures) > CONF['max_failures']:
+        failures.sort()
+        excess = len(failures) - CONF['max_failures']
+        stale.extend([member for (_, member) in failures[:excess]])
+    for i in range(0, len(stale), 1000):
+        REDIS_CONN.hdel('crawl:failures', *stale[i:i + 1000])
+    return len(stale)
+
 
 def task():
     """
-    Assigned to a worker to retrieve (pop) a node from the crawl set and
-    attempt to establish connection with a new node.
+    Assigned to a worker to retrieve (pop) nodes from the crawl set and pass
+    them to spawn_probe().
     """
     redis_conn = new_redis_conn(db=CONF['db'])
     logging.debug('Start of task()')
+    claim_nodes = redis_conn.register_script(CLAIM_NODES)
+    claimed = deque()
+    epoch = 0
+    turn = 0  # next of the owned pending shards to claim nodes from
 
     while True:
-        if not CONF['master']:
-            while REDIS_CONN.get('crawl:master:state') != b"running":
-                logging.debug('Sleeping for <timeout> because state is %s (should be "running")', REDIS_CONN.get('crawl:master:state'))
-                gevent.sleep(CONF['socket_timeout'])
-
-        node = redis_conn.spop('pending')  # Pop random node from set
-        if node is None:
-            gevent.sleep(1)
-            continue
-
-        node = eval(node)  # Convert string from Redis to tuple
-
-        # Skip IPv6 node
-        if ":" in node[0] and not CONF['ipv6']:
-            continue
-
-        key = "node:{}-{}-{}".format(node[0], node[1], node[2])
-        if redis_conn.exists(key):
+        if not claimed:
+            if not CONF['master']:
+                while REDIS_CONN.get('crawl:master:state') != b"running":
+                    logging.debug('Sleeping for <timeout> because state is %s (should be "running")', REDIS_CONN.get('crawl:master:state'))
+                    gevent.sleep(CONF['socket_timeout'])
+
+            # Pop and claim a batch of nodes in one call, trying the owned
+            # pending shards in turn until one has nodes
+            own_pending = CONF['own_pending']
+            for _ in own_pending:
+                key = own_pending[turn % len(own_pending)]
+                turn += 1
+                (epoch, popped, members) = claim(claim_nodes, key, epoch)
+                claimed.extend(members)
+                PROBE_STAGE.queued += len(members)
+                if popped > 0:
+                    break
+            else:
+                gevent.sleep(1)
             continue
 
-        # Check if prefix has hit its limit
-        if ":" in node[0] and CONF['ipv6_prefix'] < 128:
-            cidr = ip_to_network(node[0], CONF['ipv6_prefix'])
-            nodes = redis_conn.incr('crawl:cidr:{}'.format(cidr))
-            if nodes > CONF['nodes_per_ipv6_prefix']:
-                logging.debug("CIDR %s: %d", cidr, nodes)
-                continue
-
-        connect(redis_conn, key)
-        logging.debug('end of task()')
+        spawn_probe(epoch, unpack_node(claimed.popleft()))
 
 
 def set_pending():
@@ -424,121 +915,66 @@ def set_pending():
                 logging.debug("Exclude: %s", address)
                 continue
             # logging.debug("%s: %s", seeder, address)
-            REDIS_CONN.sadd('pending', (address, CONF['port'], TO_SERVICES))
+            member = pack_node(address, CONF['port'], TO_SERVICES)
+            add_pending(REDIS_CONN, ADVERTISED_SCORE, member)
 
     if CONF['onion']:
         for address in CONF['onion_nodes']:
-            REDIS_CONN.sadd('pending', (address, CONF['port'], TO_SERVICES))
+            member = pack_node(address, CONF['port'], TO_SERVICES)
+            add_pending(REDIS_CONN, ADVERTISED_SCORE, member)
 
 def set_pending_mock():
-    addresses = ['169.228.66.83'] #['15.161.132.203', '13.229.131.185', '206.223.153.52', '68.102.134.227'] #  '132.239.10.127' # 
-    for address in addresses:
-        REDIS_CONN.sadd('pending', (address, CONF['port'], TO_SERVICES))
+    for address in CONF['mock_nodes']:
+        member = pack_node(address, CONF['port'], TO_SERVICES)
+        add_pending(REDIS_CONN, ADVERTISED_SCORE, member)
         logging.debug("Adding test IP to pending set: %s", address)
 
 def is_excluded(address):
     """
     Returns True if address is found in exclusion list, False if otherwise.
     """
-    if address.endswith(".onion"):
-        address = onion_to_ipv6(address)
-    elif ip_address(str(address)).is_private:
-        return True
-
-    if ":" in address:
-        address_family = socket.AF_INET6
-        key = 'exclude_ipv6_networks'
-    else:
-        address_family = socket.AF_INET
-        key = 'exclude_ipv4_networks'
-
-    # try:
-    #     asn_record = ASN.asn(address)
-    # except AddressNotFoundError:
-    #     asn = None
-    # else:
-    #     asn = 'AS{}'.format(asn_record.autonomous_system_number)
-
     try:
-        addr = int(hexlify(socket.inet_pton(address_family, address)), 16)
-    except socket.error:
+        address = pack_address(address)
+    except (socket.error, TypeError, ValueError):
         logging.warning("Bad address: %s", address)
         return True
+    return CONF['exclude_filter'].is_excluded(address)
 
-    if any([(addr & net[1] == net[0]) for net in CONF[key]]):
-        return True
-
-    # if asn and asn in CONF['exclude_asns']:
-    #     return True
 
-    return False
-
-
-def onion_to_ipv6(address):
+def update_excluded_networks():
     """
-    Returns IPv6 equivalent of an .onion address.
+    Adds bogons into the excluded IPv4 and IPv6 networks. Bogons are read
+    from the cache files in bogons_dir and refreshed at most once every
+    bogons_interval seconds.
     """
-    ipv6_bytes = ONION_PREFIX + b32decode(address[:-6], True)
-    return socket.inet_ntop(socket.AF_INET6, ipv6_bytes)
+    changed = False
 
+    lists = []
+    if CONF['exclude_ipv4_bogons']:
+        lists.append(('exclude_ipv4_networks', 32, "fullbogons-ipv4"))
+    if CONF['exclude_ipv6_bogons']:
+        lists.append(('exclude_ipv6_networks', 128, "fullbogons-ipv6"))
 
-def list_excluded_networks(txt, networks=None):
-    """
-    Converts list of networks from configuration file into a list of tuples of
-    network address and netmask to be excluded from the crawl.
-    """
-    txt = str(txt)
-    if networks is None:
-        networks = set()
-    lines = txt.strip().split('\n')
-    for line in lines:
-        line = line.split('#')[0].strip()
-        try:
-            network = ip_network(str(line))
-        except ValueError:
-            continue
-        else:
-            networks.add((int(network.network_address), int(network.netmask)))
-    return networks
+    for (key, bits, name) in lists:
+        url = "http://www.team-cymru.org/Services/Bogons/{}.txt".format(name)
+        path = os.path.join(CONF['bogons_dir'], "{}.bin".format(name))
+        networks = len(CONF[key])
+        CONF[key] |= fetch_networks(url, path, bits, CONF['bogons_interval'])
+        changed |= len(CONF[key]) != networks
+        logging.info("IPv%d: %d", 4 if bits == 32 else 6, len(CONF[key]))
 
+    if changed:
+        index_excluded_networks()
 
-def update_excluded_networks():
+
+def index_excluded_networks():
     """
-    Adds bogons into the excluded IPv4 and IPv6 networks.
+    Rebuilds the address filter used by is_excluded() and filter_addr_list()
+    from the excluded IPv4 and IPv6 networks.
     """
-    if CONF['exclude_ipv4_bogons']:
-        urls = [
-            "http://www.team-cymru.org/Services/Bogons/fullbogons-ipv4.txt",
-        ]
-        for url in urls:
-            try:
-                response = requests.get(url, timeout=15)
-            except requests.exceptions.RequestException as err:
-                logging.warning(err)
-            else:
-                if response.status_code == 200:
-                    CONF['exclude_ipv4_networks'] = list_excluded_networks(
-                        response.content,
-                        networks=CONF['exclude_ipv4_networks'])
-                    logging.info("IPv4: %d",
-                                 len(CONF['exclude_ipv4_networks']))
-
-    if CONF['exclude_ipv6_bogons']:
-        urls = [
-            "http://www.team-cymru.org/Services/Bogons/fullbogons-ipv6.txt",
-        ]
-        for url in urls:
-            try:
-                response = requests.get(url, timeout=15)
-            except requests.exceptions.RequestException as err:
-                logging.warning(err)
-            else:
-                if response.status_code == 200:
-                    CONF['exclude_ipv6_networks'] = list_excluded_networks(
-                        response.content,
-                        networks=CONF['exclude_ipv6_networks'])
-                    logging.info("IPv6: %d",
-                                 len(CONF['exclude_ipv6_networks']))
+    CONF['exclude_filter'] = AddressFilter(CONF['exclude_ipv4_networks'],
+                                           CONF['exclude_ipv6_networks'],
+                                           CONF['exclude_private'])
 
 
 def init_conf(argv):
@@ -553,6 +989,49 @@ def init_conf(argv):
     CONF['db'] = conf.getint('crawl', 'db')
     CONF['seeders'] = conf.get('crawl', 'seeders').strip().split("\n")
     CONF['workers'] = conf.getint('crawl', 'workers')
+    CONF['probe_workers'] = conf.getint('crawl', 'probe_workers',
+                                        fallback=500)
+    CONF['probe_timeout'] = conf.getint('crawl', 'probe_timeout',
+                                        fallback=3)
+    CONF['adaptive_workers'] = conf.getboolean('crawl', 'adaptive_workers',
+                                               fallback=True)
+    CONF['min_workers'] = conf.getint('crawl', 'min_workers', fallback=50)
+    CONF['workers_step'] = conf.getint('crawl', 'workers_step', fallback=50)
+    CONF['max_lag'] = conf.getfloat('crawl', 'max_lag', fallback=0.1)
+    CONF['max_cpu'] = conf.getfloat('crawl', 'max_cpu', fallback=0.9)
+    CONF['fd_reserve'] = conf.getfloat('crawl', 'fd_reserve', fallback=0.1)
+    CONF['latency_ratio'] = conf.getfloat('crawl', 'latency_ratio',
+                                          fallback=2.0)
+    CONF['header_chain_size'] = conf.getint('crawl', 'header_chain_size',
+                                            fallback=2016)
+    CONF['min_difficulty'] = conf.getfloat('crawl', 'min_difficulty',
+                                           fallback=1e12)
+    CONF['claim_batch'] = conf.getint('crawl', 'claim_batch', fallback=10)
+    CONF['schedule'] = conf.get('crawl', 'schedule', fallback="priority")
+    CONF['max_advertisements'] = conf.getint('crawl', 'max_advertisements',
+                                             fallback=3)
+    CONF['seen_capacity'] = conf.getint('crawl', 'seen_capacity',
+                                        fallback=1000000)
+    CONF['seen_error_rate'] = conf.getfloat('crawl', 'seen_error_rate',
+                                            fallback=0.001)
+    CONF['backoff'] = conf.getint('crawl', 'backoff', fallback=3600)
+    CONF['max_backoff'] = conf.getint('crawl', 'max_backoff',
+                                      fallback=7 * 86400)
+    CONF['probe_rate'] = conf.getfloat('crawl', 'probe_rate', fallback=0.05)
+    CONF['max_failures'] = conf.getint('crawl', 'max_failures',
+                                       fallback=1000000)
+
+    # Crawl processes forked by supervise() and pending shards they own
+    CONF['processes'] = conf.getint('crawl', 'processes', fallback=1)
+    shards = conf.getint('crawl', 'pending_shards', fallback=0)
+    CONF['shard_ring'] = None
+    CONF['pending_keys'] = ['pending']
+    if shards > 0:
+        shards = max(shards, CONF['processes'])
+        CONF['shard_ring'] = HashRing(shards)
+        CONF['pending_keys'] = [
+            'pending:{}'.format(shard) for shard in range(shards)]
+    CONF['own_pending'] = CONF['pending_keys']
     CONF['debug'] = conf.getboolean('crawl', 'debug')
     CONF['source_address'] = conf.get('crawl', 'source_address')
     CONF['protocol_version'] = conf.getint('crawl', 'protocol_version')
@@ -572,15 +1051,22 @@ def init_conf(argv):
     CONF['exclude_asns'] = conf.get('crawl',
                                     'exclude_asns').strip().split("\n")
 
+    CONF['exclude_private'] = conf.getboolean('crawl', 'exclude_private',
+                                              fallback=True)
     CONF['exclude_ipv4_networks'] = list_excluded_networks(
         conf.get('crawl', 'exclude_ipv4_networks'))
     CONF['exclude_ipv6_networks'] = list_excluded_networks(
         conf.get('crawl', 'exclude_ipv6_networks'))
+    index_excluded_networks()
 
     CONF['exclude_ipv4_bogons'] = conf.getboolean('crawl',
                                                   'exclude_ipv4_bogons')
     CONF['exclude_ipv6_bogons'] = conf.getboolean('crawl',
                                                   'exclude_ipv6_bogons')
+    CONF['bogons_dir'] = conf.get('crawl', 'bogons_dir',
+                                  fallback="data/bogons")
+    CONF['bogons_interval'] = conf.getint('crawl', 'bogons_interval',
+                                          fallback=86400)
 
     CONF['onion'] = conf.getboolean('crawl', 'onion')
     CONF['tor_proxy'] = None
@@ -588,6 +1074,8 @@ def init_conf(argv):
         tor_proxy = conf.get('crawl', 'tor_proxy').split(":")
         CONF['tor_proxy'] = (tor_proxy[0], int(tor_proxy[1]))
     CONF['onion_nodes'] = conf.get('crawl', 'onion_nodes').strip().split("\n")
+    CONF['mock_nodes'] = conf.get('crawl', 'mock_nodes',
+                                  fallback="").split()
 
     CONF['include_checked'] = conf.getboolean('crawl', 'include_checked')
 
@@ -623,33 +1111,97 @@ def main(argv):
 
     global REDIS_CONN
     REDIS_CONN = new_redis_conn(db=CONF['db'])
+    logging.info("Migrated nodes: %d", migrate_nodes(REDIS_CONN))
 
     if CONF['master']:
         REDIS_CONN.set('crawl:master:state', "starting")
         logging.info("Removing all keys")
         print('removing keys')
-        redis_pipe = REDIS_CONN.pipeline()
-        redis_pipe.delete('up')
-        for key in get_keys(REDIS_CONN, 'node:*'):
-            redis_pipe.delete(key)
-        for key in get_keys(REDIS_CONN, 'crawl:cidr:*'):
-            redis_pipe.delete(key)
-        redis_pipe.delete('pending')
-        redis_pipe.execute()
-        # set_pending()
-        set_pending_mock()
+        new_epoch()
+        unlink(REDIS_CONN, *CONF['pending_keys'])
+        if CONF['mock_nodes']:
+            set_pending_mock()
+        else:
+            set_pending()
         update_excluded_networks()
         REDIS_CONN.set('crawl:master:state', "running")
 
+    if CONF['processes'] > 1:
+        return supervise()
+    return run(0)
+
+
+def supervise():
+    """
+    Forks one crawl process per CONF['processes'] and waits for them to
+    exit. With a sharded crawl set, each process claims nodes only from
+    every processes-th pending shard.
+    """
+    pids = []
+    for index in range(CONF['processes']):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(run(index))
+        logging.info("Forked crawl process %d: %d", index, pid)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    return 0
+
+
+def start_pipeline():
+    """
+    Creates the probe pool, with its adaptive limit if enabled, and the
+    handshake queue of the connect pipeline and returns the spawned
+    handshake workers and reporting workers.
+    """
+    global PROBES, HANDSHAKES, HANDSHAKE_SLOTS, PROBE_LIMIT
+    PROBES = gevent.pool.Pool(CONF['probe_workers'])
+    # At most one opened connection per handshake worker, see probe()
+    HANDSHAKE_SLOTS = gevent.lock.BoundedSemaphore(CONF['workers'])
+    HANDSHAKES = gevent.queue.Queue(CONF['workers'])
+
+    workers = [gevent.spawn(report_stages)]
+    PROBE_LIMIT = None
+    if CONF['adaptive_workers']:
+        PROBE_LIMIT = AdaptiveLimit(
+            'probe', CONF['min_workers'], CONF['probe_workers'],
+            minimum=CONF['min_workers'], step=CONF['workers_step'],
+            max_lag=CONF['max_lag'], max_cpu=CONF['max_cpu'],
+            fd_reserve=CONF['fd_reserve'],
+            latency_ratio=CONF['latency_ratio'])
+        workers.append(gevent.spawn(PROBE_LIMIT.run))
+    for _ in range(CONF['workers']):
+        logging.info('Spawned worker')
+        print('Spawned workers')
+        workers.append(gevent.spawn(handshake_worker))
+    return workers
+
+
+def run(index):
+    """
+    Runs workers of the crawl process with the specified index. The cron
+    worker only runs in the first process of the master.
+    """
+    if CONF['shard_ring'] is not None:
+        CONF['own_pending'] = CONF['pending_keys'][index::CONF['processes']]
+    global REDIS_CONN
+    if CONF['processes'] > 1:
+        # Forked process needs its own connection
+        REDIS_CONN = new_redis_conn(db=CONF['db'])
+    bootstrap_chain()
+
     # Spawn workers (greenlets) including one worker reserved for cron tasks
+    # and one worker feeding the probe pool
     workers = []
-    if CONF['master']:
+    if CONF['master'] and index == 0:
         print('Spawned master')
         workers.append(gevent.spawn(cron))
-    for _ in range(CONF['workers'] - len(workers)):
-        logging.info('Spawned worker')
-        print('Spawned workers')
+    workers.extend(start_pipeline())
+    if CONF['mock_nodes']:
         workers.append(gevent.spawn(task_mock))
+    else:
+        workers.append(gevent.spawn(task))
     logging.info("Workers: %d", len(workers))
     gevent.joinall(workers)
 
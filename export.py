@@ -36,23 +36,28 @@ import time
 from binascii import hexlify, unhexlify
 from ConfigParser import ConfigParser
 
-from utils import new_redis_conn
+from utils import (
+    NODE,
+    crawl_key,
+    get_epoch,
+    new_redis_conn,
+    unpack_opendata,
+)
 
 REDIS_CONN = None
 CONF = {}
 
 
-def get_row(node):
+def get_row(node, height_key):
     """
     Returns enumerated row data from Redis for the specified node.
     """
+    # Height is stored for address, port and services of the node
+    height = REDIS_CONN.hget(height_key, node[:NODE.size])
+
     # address, port, version, user_agent, timestamp, services
-    node = eval(node)
+    node = unpack_opendata(node)
     address = node[0]
-    port = node[1]
-    services = node[-1]
-
-    height = REDIS_CONN.get('height:{}-{}-{}'.format(address, port, services))
     if height is None:
         height = (0,)
     else:
@@ -78,8 +83,10 @@ def export_nodes(nodes, timestamp):
     """
     rows = []
     start = time.time()
+    # Heights from the last completed crawl, see crawl.new_epoch()
+    height_key = crawl_key(get_epoch(REDIS_CONN) - 1, 'height')
     for node in nodes:
-        row = get_row(node)
+        row = get_row(node, height_key)
         rows.append(row)
     end = time.time()
     elapsed = end - start
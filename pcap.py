@@ -102,21 +102,25 @@ class Cache(object):
         for stream_id, self.stream.segments in self.streams.iteritems():
             data = self.stream.data()
             _data = data.next()
+            offset = 0
             while True:
                 try:
-                    (msg, _data) = self.serializer.deserialize_msg(_data)
+                    (msg, offset) = self.serializer.deserialize_msg_at(
+                        _data, offset)
                 except (HeaderTooShortError, PayloadTooShortError) as err:
                     logging.debug("%s: %s", stream_id, err)
                     try:
-                        _data += data.next()
+                        _data = _data[offset:] + data.next()
                     except StopIteration:
                         break
+                    offset = 0
                 except ProtocolError as err:
                     logging.debug("%s: %s", stream_id, err)
                     try:
                         _data = data.next()
                     except StopIteration:
                         break
+                    offset = 0
                 else:
                     src = (stream_id[0], stream_id[1])
                     dst = (stream_id[2], stream_id[3])
@@ -46,14 +46,36 @@ import time
 from binascii import hexlify, unhexlify
 from ConfigParser import ConfigParser
 
-from protocol import ProtocolError, ConnectionError, Connection
-from utils import new_redis_conn, get_keys, ip_to_network
+from protocol import (
+    REPLY_COMMANDS,
+    ConnectionError,
+    Connection,
+    DecodePolicy,
+    ProtocolError,
+)
+from utils import (
+    AdaptiveLimit,
+    get_keys,
+    ip_to_network,
+    migrate_nodes,
+    new_redis_conn,
+    pack_node,
+    pack_opendata,
+    unpack_node,
+    unpack_opendata,
+)
 
 redis.connection.socket = gevent.socket
 
 REDIS_CONN = None
 CONF = {}
 
+# Adaptive limit on concurrent workers, None for a fixed pool size
+LIMIT = None
+
+# Received messages are only sinked, so decode just enough to respond to them
+SINK_POLICY = DecodePolicy(decode=REPLY_COMMANDS, skip_checksum=True)
+
 
 class Keepalive(object):
     """
@@ -66,6 +88,8 @@ class Keepalive(object):
         self.last_ping = int(time.time())
         self.keepalive_time = 60
         self.last_bestblockhash = None
+        # Received messages are only sinked once the handshake is done
+        self.conn.decode_policy = SINK_POLICY
 
     def keepalive(self):
         """
@@ -76,32 +100,24 @@ class Keepalive(object):
         Open connections are tracked in open set with the associated data
         stored in opendata set in Redis.
         """
-        version = self.version_msg.get('version', "")
-        user_agent = self.version_msg.get('user_agent', "")
-        services = self.version_msg.get('services', "")
-        data = self.node + (version, user_agent, self.last_ping, services)
+        version = self.version_msg.get('version', 0)
+        user_agent = self.version_msg.get('user_agent', b"")
+        services = self.version_msg.get('services', 0)
+        data = pack_opendata(self.node[0], self.node[1], version, user_agent,
+                             self.last_ping, services)
 
         REDIS_CONN.sadd('opendata', data)
 
         while True:
             if time.time() > self.last_ping + self.keepalive_time:
+                # Messages are sent together when the batch exits
                 try:
-                    self.ping()
-                except socket.error as err:
-                    logging.info("ping: Closing %s (%s)", self.node, err)
-                    break
-
-                try:
-                    self.send_bestblockhash()
+                    with self.conn.batch():
+                        self.ping()
+                        self.send_bestblockhash()
+                        self.send_addr()
                 except socket.error as err:
-                    logging.info(
-                        "send_bestblockhash: Closing %s (%s)", self.node, err)
-                    break
-
-                try:
-                    self.send_addr()
-                except socket.error as err:
-                    logging.info("send_addr: Closing %s (%s)", self.node, err)
+                    logging.info("keepalive: Closing %s (%s)", self.node, err)
                     break
 
             # Sink received messages to flush them off socket buffer
@@ -157,7 +173,7 @@ class Keepalive(object):
         Sends an addr message containing a subset of the reachable nodes.
         """
         nodes = REDIS_CONN.srandmember('opendata', 10)
-        nodes = [eval(node) for node in nodes]
+        nodes = [unpack_opendata(node) for node in nodes]
         addr_list = []
         timestamp = int(self.last_ping)  # Timestamp less than 10 minutes old
         for node in nodes:
@@ -187,7 +203,7 @@ def task():
     node = REDIS_CONN.spop('reachable')
     if node is None:
         return
-    (address, port, services, height) = eval(node)
+    (address, port, services, height) = unpack_node(node)
     node = (address, port)
 
     # Check if prefix has hit its limit
@@ -226,6 +242,7 @@ def task():
                       user_agent=CONF['user_agent'],
                       height=height,
                       relay=CONF['relay'])
+    start = time.time()
     try:
         logging.debug("Connecting to %s", conn.to_addr)
         conn.open()
@@ -233,6 +250,8 @@ def task():
     except (ProtocolError, ConnectionError, socket.error) as err:
         logging.debug("Closing %s (%s)", node, err)
         conn.close()
+    if LIMIT is not None and len(handshake_msgs) > 0:
+        LIMIT.sample(time.time() - start)
 
     if len(handshake_msgs) == 0:
         if cidr_key:
@@ -298,11 +317,21 @@ def cron(pool):
 
             set_bestblockhash()
 
-        for _ in range(min(REDIS_CONN.scard('reachable'), pool.free_count())):
-            pool.spawn(task)
+        free = pool.free_count()
+        if LIMIT is not None:
+            free = min(free, LIMIT.free())
+        for _ in range(min(REDIS_CONN.scard('reachable'), free)):
+            if LIMIT is None:
+                pool.spawn(task)
+                continue
+            LIMIT.acquire()
+            pool.spawn(task).link(lambda _: LIMIT.release())
 
         workers = CONF['workers'] - pool.free_count()
         logging.info("Workers: %d", workers)
+        if LIMIT is not None:
+            logging.info("Limit: %d, increases %d, decreases %d",
+                         LIMIT.limit, LIMIT.increases, LIMIT.decreases)
 
         gevent.sleep(CONF['cron_delay'])
 
@@ -345,7 +374,8 @@ def set_reachable(nodes):
         services = node[2]
         height = node[3]
         if not REDIS_CONN.sismember('open', (address, port)):
-            REDIS_CONN.sadd('reachable', (address, port, services, height))
+            REDIS_CONN.sadd('reachable',
+                            pack_node(address, port, services, height))
     return REDIS_CONN.scard('reachable')
 
 
@@ -378,12 +408,28 @@ def init_conf(argv):
     """
     Populates CONF with key-value pairs from configuration file.
     """
-    conf = ConfigParser()
+    # Defaults for options missing from configuration files predating them
+    conf = ConfigParser({
+        'adaptive_workers': "True",
+        'min_workers': "50",
+        'workers_step': "50",
+        'max_lag': "0.1",
+        'max_cpu': "0.9",
+        'fd_reserve': "0.1",
+        'latency_ratio': "2.0",
+    })
     conf.read(argv[1])
     CONF['logfile'] = conf.get('ping', 'logfile')
     CONF['magic_number'] = unhexlify(conf.get('ping', 'magic_number'))
     CONF['db'] = conf.getint('ping', 'db')
     CONF['workers'] = conf.getint('ping', 'workers')
+    CONF['adaptive_workers'] = conf.getboolean('ping', 'adaptive_workers')
+    CONF['min_workers'] = conf.getint('ping', 'min_workers')
+    CONF['workers_step'] = conf.getint('ping', 'workers_step')
+    CONF['max_lag'] = conf.getfloat('ping', 'max_lag')
+    CONF['max_cpu'] = conf.getfloat('ping', 'max_cpu')
+    CONF['fd_reserve'] = conf.getfloat('ping', 'fd_reserve')
+    CONF['latency_ratio'] = conf.getfloat('ping', 'latency_ratio')
     CONF['debug'] = conf.getboolean('ping', 'debug')
     CONF['source_address'] = conf.get('ping', 'source_address')
     CONF['protocol_version'] = conf.getint('ping', 'protocol_version')
@@ -434,6 +480,7 @@ def main(argv):
 
     global REDIS_CONN
     REDIS_CONN = new_redis_conn(db=CONF['db'])
+    logging.info("Migrated nodes: %d", migrate_nodes(REDIS_CONN))
 
     if CONF['master']:
         redis_pipe = REDIS_CONN.pipeline()
@@ -447,6 +494,15 @@ def main(argv):
 
     # Initialize a pool of workers (greenlets)
     pool = gevent.pool.Pool(CONF['workers'])
+    global LIMIT
+    if CONF['adaptive_workers']:
+        LIMIT = AdaptiveLimit(
+            'ping', CONF['min_workers'], CONF['workers'],
+            minimum=CONF['min_workers'], step=CONF['workers_step'],
+            max_lag=CONF['max_lag'], max_cpu=CONF['max_cpu'],
+            fd_reserve=CONF['fd_reserve'],
+            latency_ratio=CONF['latency_ratio'])
+        gevent.spawn(LIMIT.run)
     pool.spawn(cron, pool)
     pool.join()
 
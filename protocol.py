@@ -137,6 +137,8 @@ Reference: https://en.bitcoin.it/wiki/Protocol_specification
 """
 
 import gevent
+import gevent.event
+import gevent.lock
 import hashlib
 import random
 import socket
@@ -146,10 +148,11 @@ import sys
 import time
 from base64 import b32decode, b32encode
 from binascii import hexlify, unhexlify
+from array import array
 from collections import deque
+from contextlib import contextmanager
 from io import StringIO, BytesIO
 from io import SEEK_CUR
-from operator import itemgetter
 import binascii
 
 MAGIC_NUMBER = "\xF9\xBE\xB4\xD9"
@@ -163,10 +166,35 @@ HEIGHT = 478000
 RELAY = 0  # set to 1 to receive all txs
 
 SOCKET_BUFSIZE = 8192
+INBOX_SIZE = 1024  # max. unclaimed messages kept by the reader greenlet
 SOCKET_TIMEOUT = 30
 HEADER_LEN = 24
+MAX_PAYLOAD = 32 * 1024 * 1024  # max. message size accepted by bitcoind
+HEADER = struct.Struct("<4s12sI4s")  # magic, command, length, checksum
 
 ONION_PREFIX = "\xFD\x87\xD8\x7E\xEB\x43"  # ipv6 prefix for .onion address
+IPV4_PREFIX = b"\x00" * 10 + b"\xFF" * 2  # ipv6 prefix for ipv4 address
+
+# Payload handling for a command, see DecodePolicy
+DECODE = 0  # decode payload into message fields
+RAW = 1  # keep payload bytes as msg['payload']
+SKIP = 2  # keep header fields only
+
+# Commands that Connection always decodes to respond to them immediately
+REPLY_COMMANDS = frozenset([b"ping", b"version"])
+
+# Commands with an empty payload; their messages only depend on the magic
+# number and are encoded once, see Serializer.serialize_msg()
+CONSTANT_COMMANDS = frozenset([b"verack", b"getaddr", b"mempool",
+                               b"sendheaders"])
+TEMPLATE_CACHE_SIZE = 1024  # max. cached inv messages or version templates
+VERSION_HEAD = struct.Struct("<iQq")  # version, services, timestamp
+NONCE = struct.Struct("<Q")
+
+# Shared by all Serializer instances as each connection gets its own
+CONSTANT_MSGS = {}  # (magic_number, command) -> message
+INV_MSGS = {}  # (magic_number, inventory) -> message
+VERSION_TEMPLATES = {}  # version conf and from_addr -> payload parts
 
 
 class ProtocolError(Exception):
@@ -189,6 +217,10 @@ class PayloadTooShortError(ProtocolError):
     pass
 
 
+class PayloadTooLargeError(ProtocolError):
+    pass
+
+
 class InvalidPayloadChecksum(ProtocolError):
     pass
 
@@ -213,6 +245,31 @@ def sha256(data):
     return hashlib.sha256(data).digest()
 
 
+class DecodePolicy(object):
+    """
+    Selects how deserialize_msg_at() handles the payload of each command.
+    Commands in skip are skipped after the header, commands in raw keep
+    their payload bytes and commands in decode are decoded fully. If decode
+    is None, commands not found in raw or skip are decoded, otherwise they
+    are skipped. Set skip_checksum to True to also skip checksum
+    verification for skipped payloads.
+    """
+    def __init__(self, decode=None, raw=(), skip=(), skip_checksum=False):
+        self.decode = None if decode is None else frozenset(decode)
+        self.raw = frozenset(raw)
+        self.skip = frozenset(skip)
+        self.skip_checksum = skip_checksum
+
+    def action(self, command):
+        if command in self.skip:
+            return SKIP
+        if command in self.raw:
+            return RAW
+        if self.decode is None or command in self.decode:
+            return DECODE
+        return SKIP
+
+
 def unpack(fmt, string):
     # Wraps problematic struct.unpack() in a try statement
     try:
@@ -221,6 +278,293 @@ def unpack(fmt, string):
         raise ReadError(err)
 
 
+def unpack_records(fmt, count, data, offset):
+    """
+    Unpacks count consecutive fixed-size records of fmt starting at offset
+    in data in a single call and returns the fields of all records as one
+    flat tuple. fmt must include the byte order character.
+    """
+    # count is read from the payload; check it before building the format
+    if struct.calcsize(fmt) * count > len(data) - offset:
+        raise ReadError("{} records of {} bytes exceed {} bytes".format(
+            count, struct.calcsize(fmt), len(data) - offset))
+    try:
+        return struct.unpack_from(fmt[0] + fmt[1:] * count, data, offset)
+    except struct.error as err:
+        raise ReadError(err)
+
+
+def pack_address(address):
+    """
+    Returns 16 bytes IP_ADDR for an ipv4, ipv6 or .onion address.
+    """
+    if address.endswith(".onion"):
+        # convert .onion address to its ipv6 equivalent (6 + 10 bytes)
+        return ONION_PREFIX + b32decode(address[:-6], True)
+    elif "." in address:
+        # unused (12 bytes) + ipv4 (4 bytes) = ipv4-mapped ipv6 address
+        return IPV4_PREFIX + socket.inet_pton(socket.AF_INET, address)
+    # ipv6 (16 bytes)
+    return socket.inet_pton(socket.AF_INET6, address)
+
+
+def unpack_address(data):
+    """
+    Returns a tuple of ipv4, ipv6 and .onion address from 16 bytes IP_ADDR
+    with only one of them set.
+    """
+    if data[:12] == IPV4_PREFIX:
+        return (socket.inet_ntop(socket.AF_INET, data[12:]), "", "")
+    if data[:6] == ONION_PREFIX:
+        return ("", "", b32encode(data[6:]).lower() + ".onion")
+    ipv6 = socket.inet_ntop(socket.AF_INET6, data)
+    ipv4 = socket.inet_ntop(socket.AF_INET, data[12:])
+    if ipv4 in ipv6:
+        return (ipv4, "", "")
+    return ("", ipv6, "")
+
+
+class Record(object):
+    """
+    Base class for decoded protocol objects with a fixed set of fields kept
+    in __slots__ instead of a per-instance dict. Records also support the
+    read/write mapping interface of the dicts they replace, e.g.
+    peer['ipv4'], so existing callers keep working. Fields that were never
+    set, e.g. wits of a non-segwit TxIn, are absent from the mapping.
+    """
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        for (field, value) in zip(self.__slots__, args):
+            setattr(self, field, value)
+        for (field, value) in kwargs.items():
+            self[field] = value
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self else default
+
+    def keys(self):
+        return [field for field in self.__slots__ if hasattr(self, field)]
+
+    def values(self):
+        return [getattr(self, field) for field in self.keys()]
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.keys()]
+
+    def update(self, other):
+        for (field, value) in dict(other).items():
+            self[field] = value
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "{}({!r})".format(self.__class__.__name__, dict(self.items()))
+
+
+class NetworkAddress(Record):
+    __slots__ = ('timestamp', 'services', 'ipv4', 'ipv6', 'onion', 'port')
+
+
+class InventoryItem(Record):
+    __slots__ = ('type', 'hash')
+
+
+class TxIn(Record):
+    __slots__ = ('prev_out_hash', 'prev_out_index', 'script_length', 'script',
+                 'sequence', 'wits')
+
+
+class TxOut(Record):
+    __slots__ = ('value', 'script_length', 'script')
+
+
+class BlockHeader(Record):
+    __slots__ = ('block_hash', 'version', 'prev_block_hash', 'merkle_root',
+                 'timestamp', 'bits', 'nonce', 'tx_count')
+
+
+class AddrList(object):
+    """
+    Network addresses from an addr message stored as columns of timestamps,
+    services, 16 bytes IP_ADDR and ports. Indexing returns the address in
+    the form returned by Serializer.deserialize_network_address().
+    """
+    def __init__(self, timestamps, services, addresses, ports):
+        self.timestamps = timestamps
+        self.services = services
+        self.addresses = addresses
+        self.ports = ports
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        (ipv4, ipv6, onion) = unpack_address(self.addresses[index])
+        return NetworkAddress(self.timestamps[index], self.services[index],
+                              ipv4, ipv6, onion, self.ports[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def unpack_int_from(data, offset):
+    """
+    Returns the variable integer at offset in data and the offset after it.
+    """
+    try:
+        length = struct.unpack_from("<B", data, offset)[0]
+        if length == 0xFD:
+            return (struct.unpack_from("<H", data, offset + 1)[0], offset + 3)
+        elif length == 0xFE:
+            return (struct.unpack_from("<I", data, offset + 1)[0], offset + 5)
+        elif length == 0xFF:
+            return (struct.unpack_from("<Q", data, offset + 1)[0], offset + 9)
+    except struct.error as err:
+        raise ReadError(err)
+    return (length, offset + 1)
+
+
+def scan_tx(data, offset):
+    """
+    Walks over the transaction starting at offset in data without decoding
+    it. Returns the offsets of its inputs, the end of its outputs, its
+    lock_time and its end.
+    """
+    try:
+        offset += 4  # version
+        segwit = struct.unpack_from("<B", data, offset)[0] == 0  # marker
+        if segwit:
+            offset += 2  # marker, flags
+        tx_in_start = offset
+        (tx_in_count, offset) = unpack_int_from(data, offset)
+        for _ in range(tx_in_count):
+            offset += 36  # prev_out_hash, prev_out_index
+            (script_length, offset) = unpack_int_from(data, offset)
+            offset += script_length + 4  # script, sequence
+        (tx_out_count, offset) = unpack_int_from(data, offset)
+        for _ in range(tx_out_count):
+            offset += 8  # value
+            (script_length, offset) = unpack_int_from(data, offset)
+            offset += script_length
+        tx_out_end = offset
+        if segwit:
+            for _ in range(tx_in_count):
+                (count, offset) = unpack_int_from(data, offset)
+                for _ in range(count):
+                    (length, offset) = unpack_int_from(data, offset)
+                    offset += length
+    except struct.error as err:
+        raise ReadError(err)
+    end = offset + 4
+    if end > len(data):
+        raise ReadError("got {} of {} bytes".format(len(data), end))
+    return (tx_in_start, tx_out_end, offset, end)
+
+
+class LazyBlock(object):
+    """
+    Transactions of a block payload that are decoded only when indexed.
+    Transaction boundaries are found on first use by scanning the payload,
+    so that txids can be iterated without decoding inputs and outputs and
+    memory stays close to the size of the payload.
+    """
+    def __init__(self, serializer, payload, offset, tx_count):
+        self.serializer = serializer
+        self.payload = payload
+        self.offset = offset  # start of first transaction
+        self.tx_count = tx_count
+        self.spans = None  # tx_in_start, tx_out_end, lock_time, end per tx
+
+    def __len__(self):
+        return self.tx_count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.tx_count))]
+        (start, end) = self.bounds(index)
+        return self.serializer.deserialize_tx_payload(self.payload[start:end])
+
+    def __iter__(self):
+        for index in range(self.tx_count):
+            yield self[index]
+
+    def __repr__(self):
+        return "<LazyBlock {} txs, {} bytes>".format(
+            self.tx_count, len(self.payload))
+
+    def scan(self):
+        if self.spans is not None:
+            return
+        spans = array('L')
+        offset = self.offset
+        for _ in range(self.tx_count):
+            span = scan_tx(self.payload, offset)
+            spans.extend(span)
+            offset = span[-1]
+        self.spans = spans
+
+    def bounds(self, index):
+        """
+        Returns the start and end offsets of the transaction at index.
+        """
+        if index < 0:
+            index += self.tx_count
+        if not 0 <= index < self.tx_count:
+            raise IndexError("transaction index out of range")
+        self.scan()
+        start = self.offset if index == 0 else self.spans[index * 4 - 1]
+        return (start, self.spans[index * 4 + 3])
+
+    def txids(self):
+        """
+        Yields txid of each transaction by hashing its non-witness ranges.
+        """
+        self.scan()
+        payload = memoryview(self.payload)
+        start = self.offset
+        for index in range(self.tx_count):
+            (tx_in_start, tx_out_end, lock_time, end) = \
+                self.spans[index * 4:index * 4 + 4]
+            txid = hashlib.sha256(payload[start:start + 4])
+            txid.update(payload[tx_in_start:tx_out_end])
+            txid.update(payload[lock_time:end])
+            yield hexlify(sha256(txid.digest())[::-1])
+            start = end
+
+
 def create_connection(address, timeout=SOCKET_TIMEOUT, source_address=None,
                       proxy=None):
     if address[0].endswith(".onion") and proxy is None:
@@ -252,16 +596,39 @@ class Serializer(object):
         if self.height is None:
             self.height = HEIGHT
         self.relay = conf.get('relay', RELAY)
+        # Set to True to decode transactions in block on demand, see LazyBlock
+        self.lazy_blocks = conf.get('lazy_blocks', False)
         # This is set prior to throwing PayloadTooShortError exception to
         # allow caller to fetch more data over the network.
         self.required_len = 0
 
     def serialize_msg(self, **kwargs):
+        """
+        Returns the encoded message for the specified command. Messages for
+        CONSTANT_COMMANDS and inv messages are cached as peers are sent the
+        same verack, getaddr and consensus block inv repeatedly.
+        """
         command = kwargs['command']
-        msg = [
-            self.magic_number,
-            command + b"\x00" * (12 - len(command)),
-        ]
+
+        if command in CONSTANT_COMMANDS:
+            key = (self.magic_number, command)
+            msg = CONSTANT_MSGS.get(key)
+            if msg is None:
+                msg = self.encode_msg(command, b"")
+                CONSTANT_MSGS[key] = msg
+            return msg
+
+        if command == b"inv":
+            inventory = tuple([tuple(item) for item in kwargs['inventory']])
+            key = (self.magic_number, inventory)
+            msg = INV_MSGS.get(key)
+            if msg is None:
+                msg = self.encode_msg(
+                    command, self.serialize_inv_payload(inventory))
+                if len(INV_MSGS) >= TEMPLATE_CACHE_SIZE:
+                    INV_MSGS.clear()
+                INV_MSGS[key] = msg
+            return msg
 
         payload = b""
         if command == b"version":
@@ -274,7 +641,7 @@ class Serializer(object):
         elif command == b"addr":
             addr_list = kwargs['addr_list']
             payload = self.serialize_addr_payload(addr_list)
-        elif command == b"inv" or command == b"getdata":
+        elif command == b"getdata":
             inventory = kwargs['inventory']
             payload = self.serialize_inv_payload(inventory)
         elif command == b"getblocks" or command == b"getheaders":
@@ -284,39 +651,71 @@ class Serializer(object):
         elif command == b"headers":
             headers = kwargs['headers']
             payload = self.serialize_block_headers_payload(headers)
-        # elif command == b"getblocks":
-
 
-        msg.extend([
-            struct.pack("<I", len(payload)),
-            sha256(sha256(payload))[:4],
-            payload,
-        ])
+        return self.encode_msg(command, payload)
 
-        return b''.join(msg)
+    def encode_msg(self, command, payload):
+        """
+        Returns the message header for command and payload followed by the
+        payload.
+        """
+        checksum = sha256(sha256(payload))[:4]
+        return HEADER.pack(
+            self.magic_number, command, len(payload), checksum) + payload
 
     def deserialize_msg(self, data):
-        msg = {}
-
-        data_len = len(data)
+        """
+        Returns the first message in data and the remaining bytes. Callers
+        holding a buffer with several messages should use
+        deserialize_msg_at() instead to avoid copying the remainder.
+        """
+        (msg, offset) = self.deserialize_msg_at(data)
+        return (msg, data[offset:])
+
+    def deserialize_msg_at(self, data, offset=0, policy=None):
+        """
+        Deserializes the message starting at offset in data without copying
+        the data that follows it. data can be any object supporting the
+        buffer interface, e.g. bytes, bytearray or memoryview. Payload is
+        decoded fully unless a DecodePolicy says otherwise. Returns the
+        message and the offset of the next message in data.
+        """
+        data = memoryview(data)
+
+        data_len = len(data) - offset
         if data_len < HEADER_LEN:
             raise HeaderTooShortError("got {} of {} bytes".format(
                 data_len, HEADER_LEN))
 
-        data = BytesIO(data) # try to make a stream out of data
-        header = data.read(HEADER_LEN)
-        msg.update(self.deserialize_header(header))
+        msg = self.deserialize_header(data, offset=offset)
 
         if (data_len - HEADER_LEN) < msg['length']:
             self.required_len = HEADER_LEN + msg['length']
             raise PayloadTooShortError("got {} of {} bytes".format(
                 data_len, HEADER_LEN + msg['length']))
 
-        payload = data.read(msg['length'])
-        computed_checksum = sha256(sha256(payload))[:4]
-        if computed_checksum != msg['checksum']:
-            raise InvalidPayloadChecksum("{} != {}".format(
-                hexlify(computed_checksum), hexlify(msg['checksum'])))
+        action = DECODE
+        if policy is not None:
+            action = policy.action(msg['command'])
+
+        start = offset + HEADER_LEN
+        end = start + msg['length']
+        if action != SKIP or not policy.skip_checksum:
+            computed_checksum = sha256(sha256(data[start:end]))[:4]
+            if computed_checksum != msg['checksum']:
+                raise InvalidPayloadChecksum("{} != {}".format(
+                    hexlify(computed_checksum), hexlify(msg['checksum'])))
+
+        if action == SKIP:
+            return (msg, end)
+
+        # Payload deserializers work on bytes, so this is the only copy made
+        # for the message.
+        payload = data[start:end].tobytes()
+
+        if action == RAW:
+            msg['payload'] = payload
+            return (msg, end)
 
         if msg['command'] == b"version":
             msg.update(self.deserialize_version_payload(payload))
@@ -333,36 +732,55 @@ class Serializer(object):
         elif msg['command'] == b"headers":
             msg.update(self.deserialize_block_headers_payload(payload))
 
-        return (msg, data.read())
+        return (msg, end)
 
-    def deserialize_header(self, data):
+    def deserialize_header(self, data, offset=0):
         msg = {}
-        data = BytesIO(data)
 
-        msg['magic_number'] = data.read(4)
+        (msg['magic_number'],
+         command,
+         msg['length'],
+         msg['checksum']) = HEADER.unpack_from(data, offset)
         if msg['magic_number'] != self.magic_number:
             raise InvalidMagicNumberError("{} != {}".format(
                 hexlify(msg['magic_number']), hexlify(self.magic_number)))
+        # Length is checked before the receive buffer is grown to hold it
+        if msg['length'] > MAX_PAYLOAD:
+            raise PayloadTooLargeError("{} > {}".format(
+                msg['length'], MAX_PAYLOAD))
 
-        msg['command'] = data.read(12).strip(b"\x00")
-        msg['length'] = struct.unpack("<I", data.read(4))[0]
-        msg['checksum'] = data.read(4)
+        msg['command'] = command.strip(b"\x00")
 
         return msg
 
     def serialize_version_payload(self, to_addr, from_addr):
-        # first arg is format identifiers: https://docs.python.org/3.7/library/struct.html#format-characters
-        # < means little-endian. i = int, Q = unsigned long long, q = long long, ? = bool
+        """
+        Returns the version payload built from a cached template where only
+        timestamp, to_addr and nonce are filled in per message.
+        """
+        key = (self.protocol_version, self.from_services, from_addr,
+               self.user_agent, self.height, self.relay)
+        template = VERSION_TEMPLATES.get(key)
+        if template is None:
+            template = (
+                self.serialize_network_address(from_addr),
+                b''.join([
+                    self.serialize_string(self.user_agent),
+                    struct.pack("<i", self.height),
+                    struct.pack("<?", self.relay),
+                ]),
+            )
+            if len(VERSION_TEMPLATES) >= TEMPLATE_CACHE_SIZE:
+                VERSION_TEMPLATES.clear()
+            VERSION_TEMPLATES[key] = template
+        (from_addr_bytes, tail) = template
         payload = [
-            struct.pack("<i", self.protocol_version),
-            struct.pack("<Q", self.from_services),
-            struct.pack("<q", int(time.time())),
+            VERSION_HEAD.pack(
+                self.protocol_version, self.from_services, int(time.time())),
             self.serialize_network_address(to_addr),
-            self.serialize_network_address(from_addr),
-            struct.pack("<Q", random.getrandbits(64)),
-            self.serialize_string(self.user_agent),
-            struct.pack("<i", self.height),
-            struct.pack("<?", self.relay),
+            from_addr_bytes,
+            NONCE.pack(random.getrandbits(64)),
+            tail,
         ]
         return b''.join(payload)
 
@@ -418,14 +836,15 @@ class Serializer(object):
 
     def deserialize_addr_payload(self, data):
         msg = {}
-        data = BytesIO(data)
 
-        msg['count'] = self.deserialize_int(data)
-        msg['addr_list'] = []
-        for _ in range(msg['count']):
-            network_address = self.deserialize_network_address(
-                data, has_timestamp=True)
-            msg['addr_list'].append(network_address)
+        (msg['count'], offset) = unpack_int_from(data, 0)
+
+        # Records are decoded in a single pass into columns, ports are
+        # big-endian so they are unpacked separately.
+        fields = unpack_records("<IQ16s2x", msg['count'], data, offset)
+        ports = unpack_records(">28xH", msg['count'], data, offset)
+        msg['addr_list'] = AddrList(
+            fields[0::3], fields[1::3], fields[2::3], ports)
 
         return msg
 
@@ -441,13 +860,14 @@ class Serializer(object):
         msg = {
             'timestamp': int(time.time() * 1000),  # milliseconds
         }
-        data = BytesIO(data)
 
-        msg['count'] = self.deserialize_int(data)
-        msg['inventory'] = []
-        for _ in range(msg['count']):
-            inventory = self.deserialize_inventory(data)
-            msg['inventory'].append(inventory)
+        (msg['count'], offset) = unpack_int_from(data, 0)
+
+        fields = unpack_records("<I32s", msg['count'], data, offset)
+        msg['inventory'] = [
+            InventoryItem(inv_type, hexlify(inv_hash[::-1]))  # BE -> LE
+            for (inv_type, inv_hash) in zip(fields[0::2], fields[1::2])
+        ]
 
         return msg
 
@@ -471,6 +891,7 @@ class Serializer(object):
         if isinstance(data, str):
             data = BytesIO(data)
 
+        start = data.tell()
         msg['version'] = unpack("<I", data.read(4))
 
         # Check for BIP144 marker
@@ -480,6 +901,7 @@ class Serializer(object):
         else:
             flags = '\x00'
             data.seek(-1, SEEK_CUR)
+        tx_in_start = data.tell()
 
         msg['tx_in_count'] = self.deserialize_int(data)
         msg['tx_in'] = []
@@ -492,6 +914,7 @@ class Serializer(object):
         for _ in range(msg['tx_out_count']):
             tx_out = self.deserialize_tx_out(data)
             msg['tx_out'].append(tx_out)
+        tx_out_end = data.tell()
 
         if flags != '\x00':
             for in_num in range(msg['tx_in_count']):
@@ -499,23 +922,37 @@ class Serializer(object):
                     'wits': self.deserialize_string_vector(data),
                 })
 
+        lock_time_start = data.tell()
         msg['lock_time'] = unpack("<I", data.read(4))
+        end = data.tell()
 
-        # Calculate hash from the entire payload
-        payload = self.serialize_tx_payload(msg)
-        msg['tx_hash'] = hexlify(sha256(sha256(payload))[::-1])
+        # Calculate hashes from the original bytes; txid excludes marker,
+        # flags and witnesses while wtxid (BIP141) covers the entire payload.
+        data.seek(start)
+        payload = memoryview(data.read(end - start))
+        wtx_hash = sha256(sha256(payload))
+        if flags != '\x00':
+            txid = hashlib.sha256(payload[:4])
+            txid.update(payload[tx_in_start - start:tx_out_end - start])
+            txid.update(payload[lock_time_start - start:])
+            msg['tx_hash'] = hexlify(sha256(txid.digest())[::-1])
+        else:
+            msg['tx_hash'] = hexlify(wtx_hash[::-1])
+        msg['wtx_hash'] = hexlify(wtx_hash[::-1])
 
         return msg
 
     def deserialize_block_payload(self, data):
         msg = {}
+        payload = data
 
         # Calculate hash from: version (4 bytes) + prev_block_hash (32 bytes) +
         # merkle_root (32 bytes) + timestamp (4 bytes) + bits (4 bytes) +
         # nonce (4 bytes) = 80 bytes
         msg['block_hash'] = hexlify(sha256(sha256(data[:80]))[::-1])
 
-        data = BytesIO(data)
+        # Header (80 bytes) + tx_count (up to 9 bytes)
+        data = BytesIO(payload[:89])
 
         msg['version'] = struct.unpack("<I", data.read(4))[0]
 
@@ -530,6 +967,13 @@ class Serializer(object):
         msg['nonce'] = struct.unpack("<I", data.read(4))[0]
 
         msg['tx_count'] = self.deserialize_int(data)
+        if self.lazy_blocks:
+            msg['tx'] = LazyBlock(self, payload, data.tell(), msg['tx_count'])
+            return msg
+
+        offset = data.tell()
+        data = BytesIO(payload)
+        data.seek(offset)
         msg['tx'] = []
         for _ in range(msg['tx_count']):
             tx_payload = self.deserialize_tx_payload(data)
@@ -559,13 +1003,25 @@ class Serializer(object):
 
     def deserialize_block_headers_payload(self, data):
         msg = {}
-        data = BytesIO(data)
 
-        msg['count'] = self.deserialize_int(data)
+        (msg['count'], offset) = unpack_int_from(data, 0)
+
+        # Each record is a block header followed by tx_count (always 0)
+        fields = unpack_records("<80sB", msg['count'], data, offset)
+        if any([tx_count >= 0xFD for tx_count in fields[1::2]]):
+            raise ReadError("unexpected tx_count in headers")
+        headers = unpack_records(
+            "<i32s32sIII", msg['count'], b''.join(fields[0::2]), 0)
         msg['headers'] = []
-        for _ in range(msg['count']):
-            header = self.deserialize_block_header(data)
-            msg['headers'].append(header)
+        for index in range(msg['count']):
+            (version, prev_block_hash, merkle_root, timestamp, bits,
+             nonce) = headers[index * 6:index * 6 + 6]
+            block_hash = sha256(sha256(fields[index * 2]))[::-1]  # BE -> LE
+            msg['headers'].append(BlockHeader(
+                hexlify(block_hash), version,
+                hexlify(prev_block_hash[::-1]),  # BE -> LE
+                hexlify(merkle_root[::-1]),  # BE -> LE
+                timestamp, bits, nonce, fields[index * 2 + 1]))
 
         return msg
 
@@ -577,19 +1033,7 @@ class Serializer(object):
         else:
             (services, ip_address, port) = addr
         network_address.append(struct.pack("<Q", services))
-        if ip_address.endswith(".onion"):
-            # convert .onion address to its ipv6 equivalent (6 + 10 bytes)
-            network_address.append(
-                ONION_PREFIX + b32decode(ip_address[:-6], True))
-        elif "." in ip_address:
-            # unused (12 bytes) + ipv4 (4 bytes) = ipv4-mapped ipv6 address
-            unused = b"\x00" * 10 + b"\xFF" * 2
-            network_address.append(
-                unused + socket.inet_pton(socket.AF_INET, ip_address))
-        else:
-            # ipv6 (16 bytes)
-            network_address.append(
-                socket.inet_pton(socket.AF_INET6, ip_address))
+        network_address.append(pack_address(ip_address))
         network_address.append(struct.pack(">H", port))
         return b''.join(network_address)
 
@@ -600,33 +1044,15 @@ class Serializer(object):
 
         services = unpack("<Q", data.read(8))
 
-        _ipv6 = data.read(12)
-        _ipv4 = data.read(4)
+        ip_addr = data.read(16)
         port = unpack(">H", data.read(2))
-        _ipv6 += _ipv4
 
-        ipv4 = ""
-        ipv6 = ""
-        onion = ""
+        try:
+            (ipv4, ipv6, onion) = unpack_address(ip_addr)
+        except ValueError as err:
+            raise ReadError(err)
 
-        if _ipv6[:6] == ONION_PREFIX:
-            onion = b32encode(_ipv6[6:]).lower() + ".onion"  # use .onion
-        else:
-            ipv6 = socket.inet_ntop(socket.AF_INET6, _ipv6)
-            ipv4 = socket.inet_ntop(socket.AF_INET, _ipv4)
-            if ipv4 in ipv6:
-                ipv6 = ""  # use ipv4
-            else:
-                ipv4 = ""  # use ipv6
-
-        return {
-            'timestamp': timestamp,
-            'services': services,
-            'ipv4': ipv4,
-            'ipv6': ipv6,
-            'onion': onion,
-            'port': port,
-        }
+        return NetworkAddress(timestamp, services, ipv4, ipv6, onion, port)
 
     def serialize_inventory(self, item):
         (inv_type, inv_hash) = item
@@ -639,10 +1065,7 @@ class Serializer(object):
     def deserialize_inventory(self, data):
         inv_type = unpack("<I", data.read(4))
         inv_hash = data.read(32)[::-1]  # BE -> LE
-        return {
-            'type': inv_type,
-            'hash': hexlify(inv_hash),
-        }
+        return InventoryItem(inv_type, hexlify(inv_hash))
 
     def serialize_tx_in(self, tx_in):
         payload = [
@@ -660,13 +1083,8 @@ class Serializer(object):
         script_length = self.deserialize_int(data)
         script = data.read(script_length)
         sequence = unpack("<I", data.read(4))
-        return {
-            'prev_out_hash': hexlify(prev_out_hash),
-            'prev_out_index': prev_out_index,
-            'script_length': script_length,
-            'script': script,
-            'sequence': sequence,
-        }
+        return TxIn(hexlify(prev_out_hash), prev_out_index, script_length,
+                    script, sequence)
 
     def serialize_tx_out(self, tx_out):
         payload = [
@@ -680,11 +1098,7 @@ class Serializer(object):
         value = unpack("<q", data.read(8))
         script_length = self.deserialize_int(data)
         script = data.read(script_length)
-        return {
-            'value': value,
-            'script_length': script_length,
-            'script': script,
-        }
+        return TxOut(value, script_length, script)
 
     def serialize_block_header(self, header):
         payload = [
@@ -709,16 +1123,9 @@ class Serializer(object):
         bits = unpack("<I", header.read(4))
         nonce = unpack("<I", header.read(4))
         tx_count = self.deserialize_int(data)
-        return {
-            'block_hash': hexlify(block_hash),
-            'version': version,
-            'prev_block_hash': hexlify(prev_block_hash),
-            'merkle_root': hexlify(merkle_root),
-            'timestamp': timestamp,
-            'bits': bits,
-            'nonce': nonce,
-            'tx_count': tx_count,
-        }
+        return BlockHeader(hexlify(block_hash), version,
+                           hexlify(prev_block_hash), hexlify(merkle_root),
+                           timestamp, bits, nonce, tx_count)
 
     def serialize_string_vector(self, data):
         payload = [
@@ -734,17 +1141,9 @@ class Serializer(object):
         return items
 
     def serialize_string(self, data):
-        length = len(data)
-        to_return = b''
-        if length < 0xFD:
-            to_return = chr(length) + data
-        elif length <= 0xFFFF:
-            to_return = chr(0xFD) + struct.pack("<H", length) + data
-        elif length <= 0xFFFFFFFF:
-            to_return = chr(0xFE) + struct.pack("<I", length) + data
-        else:
-            to_return = chr(0xFF) + struct.pack("<Q", length) + data
-        return to_return.encode('utf-8')
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')  # e.g. user agent read from conf
+        return self.serialize_int(len(data)) + data
 
     def deserialize_string(self, data):
         length = self.deserialize_int(data)
@@ -752,12 +1151,12 @@ class Serializer(object):
 
     def serialize_int(self, length):
         if length < 0xFD:
-            return chr(length).encode('utf-8')
+            return struct.pack("<B", length)
         elif length <= 0xFFFF:
-            return chr(0xFD).encode('utf-8') + struct.pack("<H", length)
+            return struct.pack("<BH", 0xFD, length)
         elif length <= 0xFFFFFFFF:
-            return chr(0xFE).encode('utf-8') + struct.pack("<I", length)
-        return chr(0xFF).encode('utf-8') + struct.pack("<Q", length)
+            return struct.pack("<BI", 0xFE, length)
+        return struct.pack("<BQ", 0xFF, length)
 
     def deserialize_int(self, data):
         length = unpack("<B", data.read(1))
@@ -775,18 +1174,42 @@ class Connection(object):
         self.to_addr = to_addr
         self.from_addr = from_addr
         self.serializer = Serializer(**conf)
+        # Policy used when reading messages, None to decode all messages
+        self.decode_policy = conf.get('decode_policy', None)
         self.socket_timeout = conf.get('socket_timeout', SOCKET_TIMEOUT)
+        # Timeout for open(), defaults to socket timeout
+        self.connect_timeout = conf.get('connect_timeout', self.socket_timeout)
         self.proxy = conf.get('proxy', None)
         self.socket = None
         self.bps = deque([], maxlen=128)  # bps samples for this connection
+        self.rbuf = bytearray(SOCKET_BUFSIZE)  # receive buffer
+        self.rlen = 0  # bytes of received data in receive buffer
+        self.reader = None  # reader greenlet, see start_reader()
+        self.reader_error = None
+        self.inbox = deque([], maxlen=INBOX_SIZE)
+        self.inbox_event = gevent.event.Event()
+        # Set to True to queue messages passed to send() until the current
+        # greenlet yields and send them with one sendall(), see batch()
+        self.coalesce_writes = conf.get('coalesce_writes', False)
+        self.wbuf = []  # queued outgoing messages
+        self.wlock = gevent.lock.Semaphore()
+        self.batch_depth = 0
+        self.batch_start = 0  # index in wbuf of the outermost batch
+        self.flusher = None  # greenlet flushing coalesced writes
+        self.write_error = None  # error from flusher for the next send()
 
     def open(self):
         self.socket = create_connection(self.to_addr,
-                                        timeout=self.socket_timeout,
+                                        timeout=self.connect_timeout,
                                         source_address=self.from_addr,
                                         proxy=self.proxy)
+        self.socket.settimeout(self.socket_timeout)
 
     def close(self):
+        if self.reader:
+            self.reader.kill(block=False)
+        if self.flusher:
+            self.flusher.kill(block=False)
         if self.socket:
             try:
                 self.socket.shutdown(socket.SHUT_RDWR)
@@ -796,51 +1219,236 @@ class Connection(object):
                 self.socket.close()
 
     def send(self, data):
-        self.socket.sendall(data)
-
-    def recv(self, length=0):
+        """
+        Sends data right away unless it is queued by batch() or by
+        coalesce_writes. Raises the socket error of a previous coalesced
+        write, if any.
+        """
+        self.raise_write_error()
+        self.wbuf.append(data)
+        if self.batch_depth > 0:
+            return
+        if self.coalesce_writes:
+            if self.flusher is None:
+                self.flusher = gevent.spawn(self.flush_coalesced)
+            return
+        self.flush()
+
+    def flush(self):
+        """
+        Sends all queued messages with one sendall().
+        """
+        self.raise_write_error()
+        with self.wlock:
+            if not self.wbuf:
+                return
+            data = b''.join(self.wbuf)
+            del self.wbuf[:]
+            self.batch_start = 0
+            self.socket.sendall(data)
+
+    def flush_coalesced(self):
+        try:
+            while self.wbuf and self.batch_depth == 0:
+                self.flush()
+        except socket.error as err:
+            self.write_error = err
+        finally:
+            self.flusher = None
+
+    def raise_write_error(self):
+        if self.write_error is not None:
+            (err, self.write_error) = (self.write_error, None)
+            raise err
+
+    @contextmanager
+    def batch(self):
+        """
+        Queues messages sent within the block and sends them with one
+        sendall() when the outermost batch exits without error, or drops
+        the messages still queued if it exits with an error. wait_for()
+        flushes the queue before waiting for a response.
+
+        Usage:
+            with conn.batch():
+                conn.ping()
+                conn.inv(inventory)
+        """
+        if self.batch_depth == 0:
+            self.batch_start = len(self.wbuf)
+        self.batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            if self.batch_depth == 1:
+                del self.wbuf[self.batch_start:]
+            raise
+        finally:
+            self.batch_depth -= 1
+        if self.batch_depth == 0:
+            self.flush()
+
+    def fill(self, length=0):
+        """
+        Reads from the socket into the receive buffer until it holds at least
+        length bytes, or reads once if length is 0. The buffer is grown to
+        the requested length in one go so that large messages, e.g. block,
+        are received without repeated concatenation.
+        """
         start_t = time.time()
-        if length > 0:
-            chunks = []
-            while length > 0:
-                chunk = self.socket.recv(SOCKET_BUFSIZE)
-                if not chunk:
-                    raise RemoteHostClosedConnection(
-                        "{} closed connection".format(self.to_addr))
-                chunks.append(chunk)
-                length -= len(chunk)
-            data = b''.join(chunks)
-        else:
-            data = self.socket.recv(SOCKET_BUFSIZE)
-            if not data:
+        size = max(length, self.rlen + SOCKET_BUFSIZE)
+        if size > len(self.rbuf):
+            rbuf = bytearray(size)
+            rbuf[:self.rlen] = memoryview(self.rbuf)[:self.rlen]
+            self.rbuf = rbuf
+        nbytes = 0
+        view = memoryview(self.rbuf)
+        while True:
+            chunk_len = self.socket.recv_into(view[self.rlen:])
+            if not chunk_len:
                 raise RemoteHostClosedConnection(
                     "{} closed connection".format(self.to_addr))
-        if len(data) > SOCKET_BUFSIZE:
+            self.rlen += chunk_len
+            nbytes += chunk_len
+            if self.rlen >= length:
+                break
+        if nbytes > SOCKET_BUFSIZE:
             end_t = time.time()
-            self.bps.append((len(data) * 8) / (end_t - start_t))
-        return data
+            self.bps.append((nbytes * 8) / (end_t - start_t))
+        return nbytes
+
+    def consume(self, length):
+        """
+        Discards length bytes of decoded messages from the receive buffer.
+        The buffer is never resized in place as memoryviews of it may still
+        be referenced, e.g. from the traceback of a decode error.
+        """
+        remaining = self.rlen - length
+        if remaining > 0:
+            self.rbuf[:remaining] = memoryview(self.rbuf)[length:self.rlen]
+        elif len(self.rbuf) > SOCKET_BUFSIZE:
+            # Release memory held after receiving a large message
+            self.rbuf = bytearray(SOCKET_BUFSIZE)
+        self.rlen = remaining
+
+    def start_reader(self):
+        """
+        Spawns the reader greenlet to receive messages for this connection
+        into the inbox. Once started, wait_for() returns as soon as the
+        expected message arrives and get_messages() drains the inbox instead
+        of reading from the socket.
+        """
+        if self.reader is None:
+            self.reader = gevent.spawn(self.read_loop)
+
+    def read_loop(self):
+        """
+        Receives messages into the inbox until the connection fails. The
+        error is kept to be raised to the next caller waiting for a message.
+        """
+        try:
+            while True:
+                try:
+                    msgs = self.read_messages(complete=False)
+                except socket.timeout:
+                    continue
+                self.inbox.extend(msgs)
+                self.inbox_event.set()
+        except (ProtocolError, ConnectionError, socket.error) as err:
+            self.reader_error = err
+            self.inbox_event.set()
+
+    def wait_for(self, commands, predicate=None, timeout=None, flush=True):
+        """
+        Returns the first received message with one of the commands for which
+        predicate, if specified, returns True. Returns None if no such message
+        arrives within timeout seconds (defaults to socket timeout). Queued
+        messages are sent first unless flush is False.
+        """
+        if timeout is None:
+            timeout = self.socket_timeout
+        deadline = time.time() + timeout
+        if flush:
+            self.flush()
+        self.start_reader()
+        while True:
+            for msg in self.inbox:
+                if msg.get('command') not in commands:
+                    continue
+                if predicate is None or predicate(msg):
+                    self.inbox.remove(msg)
+                    return msg
+            if self.reader_error is not None:
+                raise self.reader_error
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            self.inbox_event.clear()
+            self.inbox_event.wait(remaining)
+
+    def pop_messages(self, commands):
+        """
+        Removes and returns all messages with one of the commands that are
+        already in the inbox.
+        """
+        msgs = [m for m in self.inbox if m.get('command') in commands]
+        for msg in msgs:
+            self.inbox.remove(msg)
+        return msgs
 
     def get_messages(self, length=0, commands=None):
+        """
+        Returns received messages, limited to the commands if specified.
+        Messages with other commands are only decoded as far as needed to
+        respond to them. Once the reader greenlet is started, messages are
+        decoded by the greenlet with the policy of this connection.
+        """
+        if self.reader is not None:
+            msgs = list(self.inbox)
+            self.inbox.clear()
+            if not msgs and self.reader_error is not None:
+                raise self.reader_error
+        else:
+            policy = None
+            if commands:
+                policy = DecodePolicy(decode=REPLY_COMMANDS.union(commands))
+            msgs = self.read_messages(length=length, policy=policy)
+        if len(msgs) > 0 and commands:
+            msgs[:] = [m for m in msgs if m.get('command') in commands]
+        return msgs
+
+    def read_messages(self, length=0, complete=True, policy=None):
+        """
+        Reads from the socket and returns the messages received. If complete
+        is False, messages decoded so far are returned instead of blocking
+        for the rest of a trailing partial message, which is then kept in
+        the receive buffer. policy defaults to the policy of this connection.
+        """
+        if policy is None:
+            policy = self.decode_policy
         msgs = []
-        data = self.recv(length=length)
-        while len(data) > 0:
+        self.fill(length=length)
+        offset = 0
+        while offset < self.rlen:
             gevent.sleep(0)
-            try:
-                (msg, data) = self.serializer.deserialize_msg(data)
-            except PayloadTooShortError:
-                data += self.recv(
-                    length=self.serializer.required_len - len(data))
-                (msg, data) = self.serializer.deserialize_msg(data)
+            # Wait for the complete frame before passing it to the decoder
+            required_len = HEADER_LEN
+            if self.rlen - offset >= HEADER_LEN:
+                header = self.serializer.deserialize_header(self.rbuf, offset)
+                required_len += header['length']
+            if self.rlen - offset < required_len:
+                if msgs and not complete:
+                    break
+                self.fill(length=offset + required_len)
+                continue
+            (msg, offset) = self.serializer.deserialize_msg_at(
+                memoryview(self.rbuf)[:self.rlen], offset, policy=policy)
             if msg.get('command') == b"ping":
                 self.pong(msg['nonce'])  # respond to ping immediately
             elif msg.get('command') == b"version":
                 self.verack()  # respond to version immediately
             msgs.append(msg)
-        print('Received messages of type:')
-        for m in msgs:
-            print('\t', m.get('command'))
-        if len(msgs) > 0 and commands:
-            msgs[:] = [m for m in msgs if m.get('command') in commands]
+        self.consume(offset)
         return msgs
 
     def set_min_version(self, version):
@@ -849,17 +1457,28 @@ class Connection(object):
             version.get(b'version', PROTOCOL_VERSION))
 
     def handshake(self):
+        """
+        Sends version and waits for version and verack. Within batch(), our
+        verack stays queued so that it goes out with the next message,
+        e.g. getaddr.
+        """
         # [version] >>>
         msg = self.serializer.serialize_msg(
             command=b"version", to_addr=self.to_addr, from_addr=self.from_addr)
         self.send(msg)
 
         # <<< [version 124 bytes] [verack 24 bytes]
-        gevent.sleep(1)
-        msgs = self.get_messages(length=148, commands=[b"version", b"verack"])
-        if len(msgs) > 0:
-            msgs[:] = sorted(msgs, key=itemgetter('command'), reverse=True)
-            self.set_min_version(msgs[0])
+        msgs = []
+        deadline = time.time() + self.socket_timeout
+        version = self.wait_for([b"version"])
+        if version is not None:
+            msgs.append(version)
+            self.set_min_version(version)
+            verack = self.wait_for([b"verack"],
+                                   timeout=deadline - time.time(),
+                                   flush=False)
+            if verack is not None:
+                msgs.append(verack)
         return msgs
 
     def verack(self):
@@ -872,14 +1491,29 @@ class Connection(object):
         msg = self.serializer.serialize_msg(command=b"getaddr")
         self.send(msg)
 
-        # Caller should call get_messages separately.
+        # Caller should call wait_for_addr() or get_messages separately.
         if not block:
             return None
 
+        return self.wait_for_addr()
+
+    def wait_for_addr(self):
         # <<< [addr]..
-        gevent.sleep(1)
-        msgs = self.get_messages(commands=[b"addr"])
-        return msgs
+        # Skip addr messages advertising only the node's own address.
+        msg = self.wait_for([b"addr"], predicate=lambda m: m['count'] > 1)
+        if msg is None:
+            return []
+        return [msg] + self.pop_messages([b"addr"])
+
+    def get_response(self, commands):
+        """
+        Waits for the first message with one of the commands and returns it
+        together with the other matching messages received so far.
+        """
+        msg = self.wait_for(commands)
+        if msg is None:
+            return []
+        return [msg] + self.pop_messages(commands)
 
     def addr(self, addr_list):
         # addr_list = [(TIMESTAMP, SERVICES, "IP_ADDRESS", PORT),]
@@ -916,9 +1550,7 @@ class Connection(object):
         self.send(msg)
 
         # <<< [tx] [block]..
-        gevent.sleep(1)
-        msgs = self.get_messages(commands=[b"tx", b"block", b"inv"])
-        return msgs
+        return self.get_response([b"tx", b"block", b"inv"])
 
     def getblocks(self, block_hashes, last_block_hash=None):
         if last_block_hash is None:
@@ -932,9 +1564,7 @@ class Connection(object):
         self.send(msg)
 
         # <<< [inv]..
-        gevent.sleep(1)
-        msgs = self.get_messages(commands=[b"inv"])
-        return msgs
+        return self.get_response([b"inv"])
 
     def getheaders(self, block_hashes, last_block_hash=None):
         if last_block_hash is None:
@@ -950,9 +1580,7 @@ class Connection(object):
         self.send(msg)
 
         # <<< [headers]..
-        gevent.sleep(1)
-        msgs = self.get_messages(commands=[b"headers"])
-        return msgs
+        return self.get_response([b"headers"])
 
     def headers(self, headers):
         # headers = [{
@@ -47,7 +47,7 @@ from ConfigParser import ConfigParser
 from decimal import Decimal
 from geoip2.errors import AddressNotFoundError
 
-from utils import new_redis_conn
+from utils import new_redis_conn, unpack_opendata
 
 redis.connection.socket = gevent.socket
 
@@ -269,7 +269,7 @@ def main(argv):
             logging.info("Timestamp: %d", timestamp)
             nodes = REDIS_CONN.smembers('opendata')
             logging.info("Nodes: %d", len(nodes))
-            addresses = set([eval(node)[0] for node in nodes])
+            addresses = set([unpack_opendata(node)[0] for node in nodes])
             resolve = Resolve(addresses=addresses)
             resolve.resolve_addresses()
             REDIS_CONN.publish(publish_key, timestamp)
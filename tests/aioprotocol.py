@@ -0,0 +1 @@
+../aioprotocol.py
\ No newline at end of file
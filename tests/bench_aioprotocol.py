@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares connections/sec (open, handshake, getaddr) and memory per open
+connection of the gevent protocol.Connection and the asyncio
+aioprotocol.AsyncConnection against a local fake node. Each path runs in
+its own process so that gevent monkey-patching does not affect asyncio.
+
+Usage: python tests/bench_aioprotocol.py [connections]
+"""
+import os
+import subprocess
+import sys
+import time
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def rss():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * PAGE_SIZE
+
+
+def run_gevent(address, connections):
+    from gevent import monkey
+    monkey.patch_all()
+    import gevent
+    from protocol import Connection
+
+    def session():
+        conn = Connection(address)
+        conn.open()
+        conn.handshake()
+        conn.getaddr()
+        return conn
+
+    start_rss = rss()
+    start = time.time()
+    conns = [g.value for g in gevent.joinall(
+        [gevent.spawn(session) for _ in range(connections)])]
+    elapsed = time.time() - start
+    end_rss = rss()
+    for conn in conns:
+        conn.close()
+    return (elapsed, end_rss - start_rss)
+
+
+def run_asyncio(address, connections):
+    from aioprotocol import AsyncConnection, asyncio, then
+    loop = asyncio.get_event_loop()
+
+    def session():
+        conn = AsyncConnection(address)
+        future = then(conn.open(), lambda _: conn.handshake())
+        future = then(future, lambda _: conn.getaddr())
+        return then(future, lambda _: conn)
+
+    start_rss = rss()
+    start = time.time()
+    conns = loop.run_until_complete(asyncio.gather(
+        *[session() for _ in range(connections)]))
+    elapsed = time.time() - start
+    end_rss = rss()
+    for conn in conns:
+        conn.close()
+    loop.run_until_complete(asyncio.sleep(0.1))
+    return (elapsed, end_rss - start_rss)
+
+
+def child(argv):
+    (mode, port, connections) = (argv[2], int(argv[3]), int(argv[4]))
+    run = run_gevent if mode == "gevent" else run_asyncio
+    (elapsed, memory) = run(("127.0.0.1", port), connections)
+    print("{}: {:.0f} connections/s, {:.1f} KiB/connection".format(
+        mode, connections / elapsed, memory / 1024.0 / connections))
+    return 0
+
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == "--child":
+        return child(argv)
+    connections = argv[1] if len(argv) > 1 else "200"
+    here = os.path.dirname(os.path.abspath(__file__))
+    node = subprocess.Popen(
+        [sys.executable, os.path.join(here, "fakenode.py")],
+        stdout=subprocess.PIPE)
+    port = node.stdout.readline().strip()
+    try:
+        for mode in ("gevent", "asyncio"):
+            subprocess.check_call([
+                sys.executable, os.path.abspath(__file__), "--child", mode,
+                port, connections])
+    finally:
+        node.kill()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
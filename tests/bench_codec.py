@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures decoded nodes/sec for repr() tuples with eval() (previous
+behaviour) and pack_node() members, and, if Redis is reachable, memory used
+by and SADD/SPOP ops/sec on the pending set for both encodings.
+
+Usage: python tests/bench_codec.py [nodes] [redis db]
+
+The Redis part uses a scratch key in the given db (defaults to 15) and is
+skipped if Redis is not reachable.
+"""
+import random
+import socket
+import struct
+import sys
+import time
+
+import redis
+
+from utils import new_redis_conn, pack_node, unpack_node
+
+KEY = 'bench:pending'
+
+
+def random_nodes(count, rand):
+    nodes = []
+    for _ in range(count):
+        if rand.random() < 0.8:
+            address = socket.inet_ntoa(struct.pack(">I", rand.getrandbits(32)))
+        else:
+            address = socket.inet_ntop(socket.AF_INET6, struct.pack(
+                ">QQ", 0x2000 << 48 | rand.getrandbits(48),
+                rand.getrandbits(64)))
+        nodes.append((address, 8333, rand.choice([1, 9, 1033, 1037])))
+    return nodes
+
+
+def decode_rate(members, decode):
+    start = time.time()
+    for member in members:
+        decode(member)
+    return len(members) / (time.time() - start)
+
+
+def redis_stats(redis_conn, members):
+    redis_conn.delete(KEY)
+    before = redis_conn.info('memory')['used_memory']
+    start = time.time()
+    redis_pipe = redis_conn.pipeline()
+    for member in members:
+        redis_pipe.sadd(KEY, member)
+    redis_pipe.execute()
+    sadd_rate = len(members) / (time.time() - start)
+    memory = redis_conn.info('memory')['used_memory'] - before
+
+    start = time.time()
+    redis_pipe = redis_conn.pipeline()
+    for _ in members:
+        redis_pipe.spop(KEY)
+    redis_pipe.execute()
+    spop_rate = len(members) / (time.time() - start)
+    redis_conn.delete(KEY)
+    return (memory, sadd_rate, spop_rate)
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+    db = int(argv[2]) if len(argv) > 2 else 15
+    nodes = random_nodes(count, random.Random(0))
+    encodings = [
+        ("repr/eval", [str(node) for node in nodes], eval),
+        ("pack_node", [pack_node(*node) for node in nodes], unpack_node),
+    ]
+
+    for (name, members, decode) in encodings:
+        size = sum([len(member) for member in members]) / float(count)
+        print("{}: {:.1f} bytes/node, {:.0f} nodes/sec decoded".format(
+            name, size, decode_rate(members, decode)))
+
+    redis_conn = new_redis_conn(db=db)
+    try:
+        redis_conn.ping()
+    except redis.ConnectionError as err:
+        print("Redis skipped: {}".format(err))
+        return 0
+
+    for (name, members, _) in encodings:
+        (memory, sadd_rate, spop_rate) = redis_stats(redis_conn, members)
+        print("{}: {:.1f} bytes/node in Redis, {:.0f} SADD/sec, "
+              "{:.0f} SPOP/sec".format(name, memory / float(count), sadd_rate,
+                                       spop_rate))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures per-node crawl latency (open, handshake, getaddr) against a local
+fake node using fixed sleeps (previous behaviour) and event-driven waits.
+
+Usage: python tests/bench_connection.py [sessions]
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+import time
+
+import gevent
+
+from fakenode import FakeNode
+from protocol import Connection
+
+
+def fixed_sleep_session(to_addr):
+    """
+    Replicates the previous flow: sleep 1s after version, then poll for addr
+    every 0.3s as crawl.connect() did.
+    """
+    conn = Connection(to_addr)
+    conn.open()
+    conn.send(conn.serializer.serialize_msg(
+        command=b"version", to_addr=conn.to_addr, from_addr=conn.from_addr))
+    gevent.sleep(1)
+    conn.get_messages(length=148, commands=[b"version", b"verack"])
+    conn.getaddr(block=False)
+    while True:
+        gevent.sleep(0.3)
+        msgs = conn.get_messages(commands=[b"addr"])
+        if msgs and any([msg['count'] > 1 for msg in msgs]):
+            break
+    conn.close()
+
+
+def event_driven_session(to_addr):
+    conn = Connection(to_addr)
+    conn.open()
+    conn.handshake()
+    conn.getaddr()
+    conn.close()
+
+
+def main(argv):
+    sessions = int(argv[1]) if len(argv) > 1 else 5
+    node = FakeNode(addr_delay=0.05)
+    to_addr = node.start()
+
+    for session in (fixed_sleep_session, event_driven_session):
+        elapsed = []
+        for _ in range(sessions):
+            start = time.time()
+            session(to_addr)
+            elapsed.append(time.time() - start)
+        print("{}: {:.3f}s/node (min {:.3f}s, max {:.3f}s)".format(
+            session.__name__, sum(elapsed) / len(elapsed), min(elapsed),
+            max(elapsed)))
+
+    node.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures exclusion lookups/sec for random IPv4 and IPv6 addresses using a
+linear scan over all networks (previous behaviour) and NetworkIndex, and
+addr message filtering with per-peer string lookups (previous behaviour)
+and AddressFilter with and without NumPy.
+
+Usage: python tests/bench_exclude.py [addresses] [fullbogons-ipv4.txt]
+    [fullbogons-ipv6.txt]
+
+Without the bogon files from
+http://www.team-cymru.org/Services/Bogons/, random networks of a similar
+count are used. The linear scan is timed on a sample of the addresses.
+"""
+import io
+import random
+import socket
+import sys
+import time
+from binascii import hexlify
+from ipaddress import ip_address, ip_network
+
+from protocol import Serializer, unpack_address
+from utils import AddressFilter, NetworkIndex
+
+
+def load_networks(path):
+    networks = set()
+    with io.open(path, encoding='utf-8') as txt:
+        for line in txt:
+            try:
+                network = ip_network(line.split('#')[0].strip())
+            except ValueError:
+                continue
+            networks.add((int(network.network_address), int(network.netmask)))
+    return networks
+
+
+def random_networks(count, bits, min_prefix, max_prefix, rand):
+    networks = set()
+    while len(networks) < count:
+        prefix = rand.randint(min_prefix, max_prefix)
+        netmask = ((1 << prefix) - 1) << (bits - prefix)
+        networks.add((rand.getrandbits(bits) & netmask, netmask))
+    return networks
+
+
+def rate(func, addresses):
+    start = time.time()
+    for address in addresses:
+        func(address)
+    return len(addresses) / (time.time() - start)
+
+
+def bench(name, networks, bits, count, rand):
+    addresses = [rand.getrandbits(bits) for _ in range(count)]
+    index = NetworkIndex(networks, bits=bits)
+    nets = list(networks)
+
+    def linear(addr):
+        return any([(addr & net[1] == net[0]) for net in nets])
+
+    sample = addresses[:max(count // 10000, 20)]
+    linear_rate = rate(linear, sample)
+    index_rate = rate(index.__contains__, addresses)
+    assert [linear(a) for a in sample] == [a in index for a in sample]
+    print("{}: {} networks ({} intervals), linear {:.0f}/s, index {:.0f}/s "
+          "({:.0f}x), {} addresses in {:.2f}s".format(
+              name, len(networks), len(index), linear_rate, index_rate,
+              index_rate / linear_rate, count, count / index_rate))
+
+
+def bench_addr(ipv4_networks, ipv6_networks, rand, messages=100):
+    serializer = Serializer()
+    addr_lists = []
+    for _ in range(messages):
+        addr_list = []
+        for i in range(1000):
+            if i % 10 == 0:
+                address = socket.inet_ntop(socket.AF_INET6, b''.join(
+                    [chr(rand.getrandbits(8)) for j in range(16)]))
+            else:
+                address = socket.inet_ntop(socket.AF_INET, b''.join(
+                    [chr(rand.getrandbits(8)) for j in range(4)]))
+            addr_list.append((1500000000, 1, address, 8333))
+        msg = serializer.deserialize_addr_payload(
+            serializer.serialize_addr_payload(addr_list))
+        addr_lists.append(msg['addr_list'])
+
+    indexes = {
+        32: NetworkIndex(ipv4_networks, bits=32),
+        128: NetworkIndex(ipv6_networks, bits=128),
+    }
+
+    def is_excluded(address):
+        # Per-peer lookup from string as done by crawl.is_excluded()
+        if ip_address(address.decode()).is_private:
+            return True
+        if ":" in address:
+            (family, bits) = (socket.AF_INET6, 128)
+        else:
+            (family, bits) = (socket.AF_INET, 32)
+        addr = int(hexlify(socket.inet_pton(family, address)), 16)
+        return addr in indexes[bits]
+
+    def strings(addr_list):
+        return [is_excluded([a for a in unpack_address(ip_addr) if a][0])
+                for ip_addr in addr_list.addresses]
+
+    address_filter = AddressFilter(ipv4_networks, ipv6_networks)
+    results = []
+    for (name, func) in [
+            ("strings", strings),
+            ("AddressFilter", lambda a: address_filter.excluded(a.addresses))]:
+        start = time.time()
+        results.append([func(a) for a in addr_lists])
+        print("addr {}: {:.0f} peers/s".format(
+            name, messages * 1000 / (time.time() - start)))
+    if address_filter.ipv4_arrays is not None:
+        address_filter.ipv4_arrays = None
+        start = time.time()
+        results.append(
+            [address_filter.excluded(a.addresses) for a in addr_lists])
+        print("addr AddressFilter without NumPy: {:.0f} peers/s".format(
+            messages * 1000 / (time.time() - start)))
+    assert all([r == results[0] for r in results])
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 1000000
+    rand = random.Random(0)
+    if len(argv) > 3:
+        ipv4_networks = load_networks(argv[2])
+        ipv6_networks = load_networks(argv[3])
+    else:
+        ipv4_networks = random_networks(3500, 32, 8, 24, rand)
+        ipv6_networks = random_networks(100000, 128, 16, 48, rand)
+    bench("IPv4", ipv4_networks, 32, count, rand)
+    bench("IPv6", ipv6_networks, 128, count, rand)
+    bench_addr(ipv4_networks, ipv6_networks, rand)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runs the crawl loop (crawl.task() feeding the probe and handshake stages)
+and then the ping loop (ping.task() keeping connections with the reachable
+nodes found by the crawl) against a FakeNetwork of fake nodes on loopback
+addresses, and reports nodes/sec, CPU time and RSS of each loop.
+
+Usage: python tests/bench_network.py [nodes] [unreachable] [latency]
+    [loss] [degree] [ping seconds] [redis db]
+
+nodes fake nodes (defaults to 2000) are served from a forked process; a
+fraction unreachable (0.2) of them refuse connections, responses are
+delayed by latency seconds on average (0.05) and lost with probability loss
+(0.0), and each node advertises degree (100) other nodes. The ping loop
+holds its connections for ping seconds (10) while the fake nodes send a
+ping and an inv every second.
+
+Requires Redis at REDIS_SOCKET; all keys in the db (defaults to 15) are
+removed. Set REDIS_SERVER to the path of a redis-server binary to start a
+private Redis on a temporary socket instead.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import configparser
+import logging
+import os
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import gevent
+import gevent.pool
+
+import crawl
+import ping
+from fakenode import FakeNetwork
+from utils import (
+    AdaptiveLimit,
+    cpu_time,
+    crawl_key,
+    get_epoch,
+    new_redis_conn,
+    pack_node,
+)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PORT = 18333
+SEEDS = 10
+
+
+def write_conf(name, path, **options):
+    """
+    Writes the default configuration of the named script with options
+    replaced into path.
+    """
+    conf = configparser.ConfigParser()
+    conf.read(os.path.join(HERE, "..", "conf",
+                           "{}.conf.default".format(name)))
+    for (key, value) in options.items():
+        conf.set(name, key, str(value))
+    with open(path, 'w') as conf_file:
+        conf.write(conf_file)
+
+
+def start_redis(tmpdir):
+    """
+    Starts redis-server from REDIS_SERVER, if set, on a socket in tmpdir
+    and returns its process.
+    """
+    server = os.environ.get('REDIS_SERVER')
+    if server is None:
+        return None
+    socket_path = os.path.join(tmpdir, "redis.sock")
+    process = subprocess.Popen([server, "--port", "0", "--unixsocket",
+                                socket_path, "--save", "", "--dir", tmpdir],
+                               stdout=open(os.devnull, 'w'))
+    os.environ['REDIS_SOCKET'] = socket_path
+    while not os.path.exists(socket_path):
+        time.sleep(0.1)
+    return process
+
+
+def start_network(network):
+    """
+    Serves the fake nodes of network from a forked process and returns its
+    pid once they are listening.
+    """
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        network.start()
+        os.write(write_fd, b"1")
+        while True:
+            gevent.sleep(60)
+    os.close(write_fd)
+    os.read(read_fd, 1)
+    os.close(read_fd)
+    return pid
+
+
+class Usage(object):
+    """
+    CPU time and RSS of this process since the usage was created.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.cpu = cpu_time()
+
+    def report(self, stdout, text):
+        """
+        Writes text followed by the CPU time and RSS.
+        """
+        cpu = cpu_time() - self.cpu
+        with open("/proc/self/statm") as statm:
+            rss = int(statm.read().split()[1]) * resource.getpagesize()
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        stdout.write("{}, CPU {:.1f}s ({:.0f}%), RSS {:.1f} MB "
+                     "(max {:.1f} MB)\n".format(
+                         text, cpu, 100.0 * cpu / (time.time() - self.start),
+                         rss / 1048576.0, max_rss / 1048576.0))
+        stdout.flush()
+
+
+def rate(name, nodes, elapsed):
+    return "{}: {} nodes in {:.1f}s, {:.1f} nodes/sec".format(
+        name, nodes, elapsed, nodes / max(elapsed, 1e-9))
+
+
+def crawl_idle():
+    stages = (crawl.PROBE_STAGE, crawl.HANDSHAKE_STAGE)
+    if any([stage.queued or stage.active for stage in stages]):
+        return False
+    return crawl.count_pending() == 0
+
+
+def run_crawl(network, stdout):
+    """
+    Crawls the network from SEEDS of its nodes until the crawl set is empty
+    and returns the crawl epoch.
+    """
+    crawl.REDIS_CONN = new_redis_conn(db=crawl.CONF['db'])
+    crawl.REDIS_CONN.flushdb()
+    crawl.new_epoch()
+    crawl.index_excluded_networks()
+    crawl.REDIS_CONN.set('crawl:master:state', "running")
+    redis_pipe = crawl.REDIS_CONN.pipeline()
+    crawl.add_pending(redis_pipe, crawl.REACHABLE_SCORE,
+                      *[pack_node(*seed) for seed in network.seeds(SEEDS)])
+    # Header chain is bootstrapped from the fake chain instead of bitcoind
+    redis_pipe.rpush('crawl:blockhashes',
+                     *network.chain.recent_blockhashes())
+    redis_pipe.execute()
+    crawl.bootstrap_chain()
+
+    usage = Usage()
+    workers = crawl.start_pipeline() + [gevent.spawn(crawl.task)]
+    while not crawl_idle():
+        gevent.sleep(0.1)
+    gevent.killall(workers)
+
+    epoch = get_epoch(crawl.REDIS_CONN)
+    visited = crawl.REDIS_CONN.scard(crawl_key(epoch, 'nodes'))
+    up = crawl.REDIS_CONN.scard(crawl_key(epoch, 'up'))
+    usage.report(stdout, rate("crawl", visited, time.time() - usage.start))
+    stdout.write("crawl: {} of {} reachable nodes up\n".format(
+        up, len(network.nodes)))
+    return epoch
+
+
+def run_ping(epoch, seconds, stdout):
+    """
+    Connects to the reachable nodes of the crawl epoch from a snapshot with
+    ping.cron() and its adaptive limit, as ping.main() does, and keeps the
+    connections for seconds.
+    """
+    crawl.dump(int(time.time()), epoch,
+               crawl.REDIS_CONN.smembers(crawl_key(epoch, 'up')))
+    ping.REDIS_CONN = new_redis_conn(db=ping.CONF['db'])
+    nodes = ping.get_nodes(ping.get_snapshot())
+
+    pool = gevent.pool.Pool(ping.CONF['workers'])
+    # Stalled once no node connects for a timeout or a limit increase
+    stall = ping.CONF['socket_timeout']
+    if ping.CONF['adaptive_workers']:
+        ping.LIMIT = AdaptiveLimit(
+            'ping', ping.CONF['min_workers'], ping.CONF['workers'],
+            minimum=ping.CONF['min_workers'], step=ping.CONF['workers_step'],
+            max_lag=ping.CONF['max_lag'], max_cpu=ping.CONF['max_cpu'],
+            fd_reserve=ping.CONF['fd_reserve'],
+            latency_ratio=ping.CONF['latency_ratio'])
+        gevent.spawn(ping.LIMIT.run)
+        stall = max(stall, ping.LIMIT.interval + ping.CONF['cron_delay'])
+    pool.spawn(ping.cron, pool)
+    # Timed from the first task, cron() waits for connections to stabilize
+    # before it spawns tasks
+    while len(pool) < 2:
+        gevent.sleep(0.01)
+    usage = Usage()
+    # Connected once the node is added into the opendata set
+    connected = 0
+    last_connected = time.time()
+    while connected < len(nodes):
+        gevent.sleep(0.1)
+        count = ping.REDIS_CONN.scard('opendata')
+        if count > connected:
+            (connected, last_connected) = (count, time.time())
+        elif time.time() - last_connected > stall:
+            break
+    usage.report(stdout, rate("ping connect", connected,
+                              last_connected - usage.start))
+
+    usage = Usage()
+    gevent.sleep(seconds)
+    usage.report(stdout, "ping keepalive: {} connections for {}s".format(
+        ping.REDIS_CONN.scard('opendata'), seconds))
+    pool.kill()
+
+
+def main(argv):
+    nodes = int(argv[1]) if len(argv) > 1 else 2000
+    unreachable = float(argv[2]) if len(argv) > 2 else 0.2
+    latency = float(argv[3]) if len(argv) > 3 else 0.05
+    loss = float(argv[4]) if len(argv) > 4 else 0.0
+    degree = int(argv[5]) if len(argv) > 5 else 100
+    seconds = int(argv[6]) if len(argv) > 6 else 10
+    db = int(argv[7]) if len(argv) > 7 else 15
+
+    tmpdir = tempfile.mkdtemp()
+    redis_server = start_redis(tmpdir)
+    crawl_dir = os.path.join(tmpdir, "crawl")
+    # No excluded networks so that loopback addresses are crawled, and a
+    # minimum difficulty below that of the regtest headers of the fake chain
+    write_conf("crawl", os.path.join(tmpdir, "crawl.conf"),
+               logfile=os.path.join(tmpdir, "crawl.log"), port=PORT, db=db,
+               seeders="", workers=200, socket_timeout=3, probe_timeout=3,
+               peers_per_node=degree, ipv6=False, exclude_ipv4_networks="",
+               exclude_ipv4_bogons=False, exclude_ipv6_bogons=False,
+               exclude_private=False, min_difficulty=1e-10,
+               crawl_dir=crawl_dir)
+    write_conf("ping", os.path.join(tmpdir, "ping.conf"),
+               logfile=os.path.join(tmpdir, "ping.log"), db=db,
+               workers=nodes, socket_timeout=3, onion=False, cron_delay=1,
+               crawl_dir=crawl_dir)
+    crawl.init_conf([None, os.path.join(tmpdir, "crawl.conf"), "master"])
+    ping.init_conf([None, os.path.join(tmpdir, "ping.conf"), "master"])
+    logging.basicConfig(level=logging.INFO,
+                        filename=os.path.join(tmpdir, "bench.log"))
+
+    network = FakeNetwork(nodes=nodes, port=PORT, unreachable=unreachable,
+                          latency=latency, loss=loss, degree=degree,
+                          ping_interval=1.0)
+    pid = start_network(network)
+
+    # Progress printed by the crawl and protocol modules is discarded
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        epoch = run_crawl(network, stdout)
+        run_ping(epoch, seconds, stdout)
+    finally:
+        sys.stdout = stdout
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        if redis_server is not None:
+            redis_server.kill()
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
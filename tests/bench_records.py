@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares memory footprint of decoded messages holding their addresses,
+inventory items, tx_in, tx_out and headers as dicts (previous behaviour)
+and as __slots__ records.
+
+Usage: python tests/bench_records.py [addr_count] [tx_count]
+"""
+import sys
+
+from protocol import Record, Serializer
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    Returns the size in bytes of obj and all objects reachable from it
+    through dicts, lists, tuples and records, counting each object once.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum([deep_sizeof(k, seen) + deep_sizeof(v, seen)
+                     for (k, v) in obj.items()])
+    elif isinstance(obj, Record):
+        size += sum([deep_sizeof(v, seen) for v in obj.values()])
+    elif isinstance(obj, (list, tuple)):
+        size += sum([deep_sizeof(item, seen) for item in obj])
+    return size
+
+
+def as_dicts(obj):
+    """
+    Returns a copy of obj with records replaced by dicts.
+    """
+    if isinstance(obj, (Record, dict)):
+        return dict([(k, as_dicts(v)) for (k, v) in obj.items()])
+    if isinstance(obj, list):
+        return [as_dicts(item) for item in obj]
+    return obj
+
+
+def make_tx(index):
+    return {
+        'version': 1,
+        'tx_in_count': 2,
+        'tx_in': [{
+            'prev_out_hash': "{:064x}".format(index * 2 + i),
+            'prev_out_index': i,
+            'script_length': 107,
+            'script': b"\x01" * 107,
+            'sequence': 0xFFFFFFFF,
+        } for i in range(2)],
+        'tx_out_count': 2,
+        'tx_out': [{
+            'value': 5000 + i,
+            'script_length': 25,
+            'script': b"\x02" * 25,
+        } for i in range(2)],
+        'lock_time': 0,
+    }
+
+
+def report(name, records):
+    dicts = as_dicts(records)
+    records_size = deep_sizeof(records)
+    dicts_size = deep_sizeof(dicts)
+    print("{}: dict {:.1f} KiB, slots {:.1f} KiB ({:.0%})".format(
+        name, dicts_size / 1024.0, records_size / 1024.0,
+        float(records_size) / dicts_size))
+
+
+def main(argv):
+    addr_count = int(argv[1]) if len(argv) > 1 else 1000
+    tx_count = int(argv[2]) if len(argv) > 2 else 3000
+    serializer = Serializer()
+
+    addr_list = [
+        (1500000000 + i, 1, "10.{}.{}.1".format(i // 256, i % 256), 8333)
+        for i in range(addr_count)
+    ]
+    msg = serializer.deserialize_addr_payload(
+        serializer.serialize_addr_payload(addr_list))
+    report("addr ({} addresses)".format(addr_count), list(msg['addr_list']))
+
+    payload = b''.join(
+        [b"\x00" * 80, serializer.serialize_int(tx_count)] +
+        [serializer.serialize_tx_payload(make_tx(i)) for i in range(tx_count)])
+    msg = serializer.deserialize_block_payload(payload)
+    report("block ({} txs)".format(tx_count), msg['tx'])
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures how fast the up set of simulated consecutive crawls reaches 90%
+of its final size with the random schedule (previous behaviour) and the
+priority schedule, and the connect-seconds saved by the backoff of
+unreachable nodes. Nodes are claimed from Redis by crawl.claim() and peers
+are added with crawl.add_pending(); connections are simulated, taking
+CONNECT_TIME for reachable nodes and probe timeout for unreachable nodes.
+
+Usage: python tests/bench_schedule.py [reachable nodes] [workers]
+    [redis db]
+
+Requires Redis; all keys in the db (defaults to 15) are removed.
+"""
+import heapq
+import random
+import sys
+import time
+from collections import deque
+
+import crawl
+from utils import EPOCH_KEY, crawl_key, get_epoch, new_redis_conn, pack_node
+
+CONNECT_TIME = 0.5  # seconds for open, handshake and getaddr
+PROBE_TIMEOUT = 3
+UNREACHABLE_RATIO = 4  # unreachable per reachable advertised address
+PEERS = 100  # advertised addresses per addr response
+HISTORY = 0.9  # ratio of reachable nodes seen in the previous crawl
+CYCLES = 2
+
+
+def network(count, rand):
+    """
+    Returns reachable and unreachable members and the advertised addresses
+    of each reachable member as (age, services, member).
+    """
+    def member(i):
+        return pack_node("1.{}.{}.{}".format(
+            i >> 16 & 0xFF, i >> 8 & 0xFF, i & 0xFF), 8333, 1)
+
+    reachable = [member(i) for i in range(count)]
+    unreachable = [
+        member(i) for i in range(count, count * (1 + UNREACHABLE_RATIO))]
+    max_age = crawl.CONF['max_age']
+    peers = {}
+    for node in reachable:
+        # Reachable nodes are advertised more recently and with services
+        peers[node] = [
+            (rand.randint(0, max_age // 4), 1, rand.choice(reachable))
+            for _ in range(PEERS // 2)
+        ] + [
+            (rand.randint(0, max_age), rand.choice([0, 1]),
+             rand.choice(unreachable))
+            for _ in range(PEERS // 2)
+        ]
+    return (reachable, unreachable, peers)
+
+
+def crawl_cycle(redis_conn, reachable, peers, workers, rand):
+    """
+    Runs a simulated crawl from the next epoch and returns the time when up
+    reached 90% of its final size, the final size and the crawl duration.
+    """
+    now = int(time.time())
+    redis_conn.incr(EPOCH_KEY)
+    redis_pipe = redis_conn.pipeline()
+    crawl.load_reachable(redis_pipe, now)
+    for node in rand.sample(reachable, 20):  # DNS seeders
+        crawl.add_pending(redis_pipe, crawl.ADVERTISED_SCORE, node)
+    redis_pipe.execute()
+
+    claim_nodes = redis_conn.register_script(crawl.CLAIM_NODES)
+    epoch = 0
+    reachable = set(reachable)
+    claimed = [deque() for _ in range(workers)]
+    events = [(0.0, worker) for worker in range(workers)]
+    idle = set()
+    up = []
+    duration = 0.0
+    while len(idle) < workers:
+        (elapsed, worker) = heapq.heappop(events)
+        if not claimed[worker]:
+            (epoch, popped, members) = crawl.claim(claim_nodes, 'pending',
+                                                   epoch)
+            claimed[worker].extend(members)
+            if popped == 0:
+                idle.add(worker)
+                heapq.heappush(events, (elapsed + 1, worker))
+                continue
+            idle.discard(worker)
+            if not claimed[worker]:  # all popped nodes were skipped
+                heapq.heappush(events, (elapsed, worker))
+                continue
+        node = claimed[worker].popleft()
+        if node not in reachable:
+            crawl.record_failure(redis_conn, node, now)
+            duration = max(duration, elapsed + PROBE_TIMEOUT)
+            heapq.heappush(events, (elapsed + PROBE_TIMEOUT, worker))
+            continue
+        up.append(elapsed + CONNECT_TIME)
+        redis_pipe = redis_conn.pipeline()
+        for (age, services, peer) in peers[node]:
+            crawl.add_pending(
+                redis_pipe, crawl.score_peer(services, age), peer)
+        redis_pipe.zadd('crawl:reachable', now, node)
+        redis_pipe.hdel('crawl:failures', node)
+        redis_pipe.execute()
+        duration = max(duration, elapsed + CONNECT_TIME)
+        heapq.heappush(events, (elapsed + CONNECT_TIME, worker))
+
+    target = int(len(up) * 0.9)
+    return (sorted(up)[target - 1], len(up), duration)
+
+
+def simulate(redis_conn, schedule, reachable, unreachable, peers, workers,
+             rand):
+    redis_conn.flushdb()
+    crawl.CONF['schedule'] = schedule
+    now = int(time.time())
+
+    # Previous crawl, see crawl.restart()
+    redis_pipe = redis_conn.pipeline()
+    for node in rand.sample(reachable, int(len(reachable) * HISTORY)):
+        redis_pipe.zadd('crawl:reachable', now - rand.randint(0, 3600), node)
+    for node in rand.sample(unreachable, len(reachable) // 10):
+        redis_pipe.zadd('crawl:reachable', now - rand.randint(0, 3600), node)
+    redis_pipe.execute()
+
+    for cycle in range(1, CYCLES + 1):
+        (elapsed, final, duration) = crawl_cycle(
+            redis_conn, reachable, peers, workers, rand)
+        metrics = redis_conn.hgetall(
+            crawl_key(get_epoch(redis_conn), 'metrics'))
+        print("{} #{}: up reached 90% of {} nodes after {:.0f}s, crawl "
+              "took {:.0f}s, backoff saved {} connect-seconds".format(
+                  schedule, cycle, final, elapsed, duration,
+                  int(metrics.get(b'saved', 0))))
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 2000
+    workers = int(argv[2]) if len(argv) > 2 else 100
+    db = int(argv[3]) if len(argv) > 3 else 15
+    crawl.CONF.update({
+        'claim_batch': 10,
+        'max_age': 28800,
+        'ipv6': True,
+        'ipv6_prefix': 128,
+        'nodes_per_ipv6_prefix': 1,
+        'probe_timeout': PROBE_TIMEOUT,
+        'backoff': 3600,
+        'max_backoff': 7 * 86400,
+        'probe_rate': 0.05,
+        'shard_ring': None,
+        'pending_keys': ['pending'],
+    })
+    crawl.REDIS_CONN = redis_conn = new_redis_conn(db=db)
+
+    (reachable, unreachable, peers) = network(count, random.Random(0))
+    for schedule in ("random", "priority"):
+        simulate(redis_conn, schedule, reachable, unreachable, peers,
+                 workers, random.Random(1))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
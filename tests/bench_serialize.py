@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures messages/sec for the hot send paths of Serializer.serialize_msg()
+with its template caches (current behaviour) and with the caches emptied
+before every message, i.e. encoding each message from scratch.
+
+Usage: python tests/bench_serialize.py [seconds]
+"""
+import random
+import sys
+import time
+
+import protocol
+from protocol import Serializer
+
+
+def clear_caches():
+    protocol.CONSTANT_MSGS.clear()
+    protocol.INV_MSGS.clear()
+    protocol.VERSION_TEMPLATES.clear()
+
+
+def rate(func, seconds, before=None):
+    count = 0
+    start = time.time()
+    end = start + seconds
+    while time.time() < end:
+        for _ in range(100):
+            if before is not None:
+                before()
+            func()
+        count += 100
+    return count / (time.time() - start)
+
+
+def main(argv):
+    seconds = float(argv[1]) if len(argv) > 1 else 0.5
+    serializer = Serializer()
+    block_hash = "{:064x}".format(random.getrandbits(256))
+    to_addr = ("1.2.3.4", 8333)
+    from_addr = ("0.0.0.0", 0)
+
+    paths = [
+        ("version", lambda: serializer.serialize_msg(
+            command=b"version", to_addr=to_addr, from_addr=from_addr)),
+        ("verack", lambda: serializer.serialize_msg(command=b"verack")),
+        ("getaddr", lambda: serializer.serialize_msg(command=b"getaddr")),
+        ("ping", lambda: serializer.serialize_msg(
+            command=b"ping", nonce=random.getrandbits(64))),
+        ("inv", lambda: serializer.serialize_msg(
+            command=b"inv", inventory=[(2, block_hash)])),
+    ]
+    for (name, func) in paths:
+        uncached = rate(func, seconds, before=clear_caches)
+        cached = rate(func, seconds)
+        print("{:8} uncached {:>9.0f} msgs/s, cached {:>9.0f} msgs/s "
+              "({:.1f}x)".format(name, uncached, cached, cached / uncached))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
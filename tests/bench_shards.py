@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures crawled nodes/sec for 1, 2, 4 and 8 crawl processes claiming nodes
+from one shared pending set (previous behaviour) and from pending shards
+partitioned by utils.HashRing, against local fake nodes. Each node is
+visited with open, handshake and getaddr, and its addr messages are
+filtered as in crawl.enumerate_node().
+
+Usage: python tests/bench_shards.py [nodes] [workers per process]
+    [redis db]
+
+Requires Redis; all keys in the db (defaults to 15) are removed.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import subprocess
+import sys
+import time
+from collections import deque
+
+import gevent
+
+import crawl
+from protocol import Connection
+from utils import (
+    AddressFilter,
+    HashRing,
+    new_redis_conn,
+    pack_node,
+    unpack_node,
+)
+
+SHARDS = 8
+FAKE_NODES = 8
+
+
+def visit(node):
+    (address, port, _) = node
+    conn = Connection((address, port))
+    try:
+        conn.open()
+        conn.handshake()
+        addr_msgs = conn.getaddr()
+    finally:
+        conn.close()
+    now = int(time.time())
+    for addr_msg in addr_msgs:
+        crawl.filter_addr_list(addr_msg['addr_list'], now)
+
+
+def worker(db, keys):
+    """
+    Claims nodes as crawl.task() does until the pending sets in keys are
+    empty and returns the number of visited nodes.
+    """
+    redis_conn = new_redis_conn(db=db)
+    claim_nodes = redis_conn.register_script(crawl.CLAIM_NODES)
+    epoch = 0
+    claimed = deque()
+    visited = 0
+    while True:
+        if not claimed:
+            for key in keys:
+                (epoch, popped, members) = crawl.claim(claim_nodes, key,
+                                                       epoch)
+                claimed.extend(members)
+                if popped > 0:
+                    break
+            else:
+                return visited
+            continue
+        visit(unpack_node(claimed.popleft()))
+        visited += 1
+
+
+def run(members, processes, sharded, workers, db):
+    redis_conn = new_redis_conn(db=db)
+    redis_conn.flushdb()
+    crawl.CONF['shard_ring'] = None
+    crawl.CONF['pending_keys'] = ['pending']
+    if sharded:
+        crawl.CONF['shard_ring'] = HashRing(SHARDS)
+        crawl.CONF['pending_keys'] = [
+            'pending:{}'.format(shard) for shard in range(SHARDS)]
+    redis_pipe = redis_conn.pipeline()
+    crawl.add_pending(redis_pipe, crawl.ADVERTISED_SCORE, *members)
+    redis_pipe.execute()
+
+    start = time.time()
+    pids = []
+    for index in range(processes):
+        keys = crawl.CONF['pending_keys']
+        if sharded:
+            keys = keys[index::processes]
+        pid = os.fork()
+        if pid == 0:
+            gevent.joinall([
+                gevent.spawn(worker, db, keys) for _ in range(workers)])
+            os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    return len(members) / (time.time() - start)
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 2000
+    workers = int(argv[2]) if len(argv) > 2 else 50
+    db = int(argv[3]) if len(argv) > 3 else 15
+    crawl.CONF.update({
+        'claim_batch': 10,
+        'schedule': "random",
+        'ipv6': True,
+        'ipv6_prefix': 128,
+        'nodes_per_ipv6_prefix': 1,
+        'probe_rate': 0.05,
+        'probe_timeout': 3,
+        'max_age': 24 * 60 * 60,
+        'exclude_filter': AddressFilter(set(), set()),
+    })
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    fake_nodes = [
+        subprocess.Popen([sys.executable, os.path.join(here, "fakenode.py")],
+                         stdout=subprocess.PIPE)
+        for _ in range(FAKE_NODES)
+    ]
+    try:
+        ports = [int(node.stdout.readline()) for node in fake_nodes]
+        # Distinct services make distinct members for the same fake node
+        members = [
+            pack_node("127.0.0.1", ports[i % len(ports)], i)
+            for i in range(count)
+        ]
+        for processes in (1, 2, 4, 8):
+            for sharded in (False, True):
+                rate = run(members, processes, sharded, workers, db)
+                print("{} process(es), {}: {:.0f} nodes/sec".format(
+                    processes, "sharded" if sharded else "shared", rate))
+    finally:
+        for node in fake_nodes:
+            node.kill()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures keepalive rounds (ping, inv and addr) per second over loopback
+connections with one sendall() per message (previous behaviour) and with
+the messages batched into one sendall() by Connection.batch().
+
+Usage: python tests/bench_write.py [connections] [rounds]
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import socket
+import sys
+import time
+
+import gevent
+
+from protocol import Connection
+
+
+class CountingSocket(object):
+    """
+    Wraps a socket to count sendall() calls.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def sendall(self, data):
+        self.calls += 1
+        self.sock.sendall(data)
+
+
+def drain(sock):
+    while sock.recv(65536):
+        pass
+
+
+def keepalive(conn, block_hash, addr_list, rounds, batched):
+    for nonce in range(rounds):
+        if batched:
+            with conn.batch():
+                conn.ping(nonce=nonce)
+                conn.inv(inventory=[(2, block_hash)])
+                conn.addr(addr_list=addr_list)
+        else:
+            conn.ping(nonce=nonce)
+            conn.inv(inventory=[(2, block_hash)])
+            conn.addr(addr_list=addr_list)
+        gevent.sleep(0)
+
+
+def run(connections, rounds, batched):
+    block_hash = "00" * 32
+    addr_list = [
+        (1500000000, 1, "10.0.0.{}".format(i), 8333) for i in range(10)
+    ]
+    conns = [Connection(("127.0.0.1", 8333)) for _ in range(connections)]
+    peers = []
+    for conn in conns:
+        (sock, peer) = socket.socketpair()
+        conn.socket = CountingSocket(sock)
+        peers.append(peer)
+    drainers = [gevent.spawn(drain, p) for p in peers]
+
+    start = time.time()
+    gevent.joinall([
+        gevent.spawn(keepalive, c, block_hash, addr_list, rounds, batched)
+        for c in conns
+    ])
+    elapsed = time.time() - start
+
+    for conn in conns:
+        conn.socket.sock.close()
+    gevent.joinall(drainers)
+    calls = sum([c.socket.calls for c in conns])
+    return (connections * rounds / elapsed, calls)
+
+
+def main(argv):
+    connections = int(argv[1]) if len(argv) > 1 else 200
+    rounds = int(argv[2]) if len(argv) > 2 else 50
+    for batched in (False, True):
+        (rate, calls) = run(connections, rounds, batched)
+        print("{}: {:.0f} rounds/s, {} sendall calls".format(
+            "batched" if batched else "unbatched", rate, calls))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+# crawl.py and ping.py patch the standard library with gevent when imported;
+# patch it before any test module is imported so that all tests run against
+# the same, patched, modules.
+from gevent import monkey
+monkey.patch_all()
@@ -0,0 +1 @@
+../crawl.py
\ No newline at end of file
@@ -0,0 +1 @@
+../export.py
\ No newline at end of file
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fake Bitcoin node listening on loopback address for local benchmarks, and a
+fleet of fake nodes gossiping each other's addresses (FakeNetwork).
+
+Usage: python tests/fakenode.py [port]
+"""
+import random
+import socket
+import struct
+import sys
+import time
+from binascii import hexlify
+
+import gevent
+from gevent.server import StreamServer
+
+from protocol import (
+    Connection,
+    ConnectionError,
+    DecodePolicy,
+    ProtocolError,
+    Serializer,
+    sha256,
+    unpack_int_from,
+)
+from utils import bits_to_target
+
+# Payloads of requests for blocks are parsed by FakeNode.respond()
+REQUEST_POLICY = DecodePolicy(raw=[b"getheaders", b"getblocks", b"getdata"])
+
+MAX_HEADERS = 2000
+MAX_INV = 500
+
+# Regtest proof of work limit, met by about every other header
+BITS = 0x207fffff
+
+# NODE_NETWORK, NODE_NETWORK | NODE_WITNESS, NODE_NETWORK_LIMITED |
+# NODE_WITNESS | NODE_NETWORK
+SERVICES = (1, 9, 1033)
+
+
+class FakeChain(object):
+    """
+    Chain of height random block headers linked by their block hashes and
+    mined at the regtest difficulty.
+    """
+    def __init__(self, height=1000, seed=0):
+        rand = random.Random(seed)
+        serializer = Serializer()
+        target = bits_to_target(BITS)
+        self.headers = []
+        self.hashes = []
+        prev_block_hash = b"0" * 64
+        for index in range(height):
+            header = {
+                'version': 0x20000000,
+                'prev_block_hash': prev_block_hash,
+                'merkle_root': b"%064x" % rand.getrandbits(256),
+                'timestamp': 1500000000 + index * 600,
+                'bits': BITS,
+                'nonce': 0,
+            }
+            while True:
+                data = serializer.serialize_block_header(header)
+                block_hash = hexlify(sha256(sha256(data[:80]))[::-1])
+                if int(block_hash, 16) <= target:
+                    break
+                header['nonce'] += 1
+            prev_block_hash = block_hash
+            self.headers.append(header)
+            self.hashes.append(prev_block_hash)
+        self.index = dict([(h, i) for (i, h) in enumerate(self.hashes)])
+
+    def recent_blockhashes(self, count=10):
+        """
+        Returns hashes of the count blocks below the tip, most recent first,
+        as get_recent_blockhashes.sh does.
+        """
+        return self.hashes[-count - 1:-1][::-1]
+
+    def after(self, locator, stop, limit):
+        """
+        Returns indexes of up to limit blocks after the first block in
+        locator found in the chain and up to the stop block.
+        """
+        start = 0
+        for block_hash in locator:
+            if block_hash in self.index:
+                start = self.index[block_hash] + 1
+                break
+        end = min(start + limit, len(self.hashes))
+        if self.index.get(stop, -1) >= start:
+            end = min(end, self.index[stop] + 1)
+        return range(start, end)
+
+
+def parse_locator(payload):
+    """
+    Returns block locator hashes and stop hash of a getheaders or getblocks
+    payload.
+    """
+    (count, offset) = unpack_int_from(payload, 4)
+    hashes = [
+        hexlify(payload[i:i + 32][::-1])  # BE -> LE
+        for i in range(offset, offset + (count + 1) * 32, 32)
+    ]
+    return (hashes[:-1], hashes[-1])
+
+
+class FakeNode(object):
+    """
+    Answers version with version and verack, getaddr with an addr message and
+    getheaders, getblocks and getdata from chain, if set, with headers, inv
+    and block messages. Pings are answered by Connection.read_messages().
+
+    Each response is delayed by latency seconds and lost with probability
+    loss. peers, if set, returns the addr_list advertised to getaddr. With
+    ping_interval, a ping and an inv for the tip are sent every
+    ping_interval seconds after the handshake.
+    """
+    def __init__(self, address=("127.0.0.1", 0), addr_count=1000,
+                 addr_delay=0.0, latency=0.0, loss=0.0, services=1,
+                 chain=None, peers=None, ping_interval=0.0):
+        self.server = StreamServer(address, self.handle)
+        self.addr_count = addr_count
+        self.addr_delay = addr_delay
+        self.latency = latency
+        self.loss = loss
+        self.services = services
+        self.chain = chain
+        self.peers = peers
+        self.ping_interval = ping_interval
+
+    def start(self):
+        self.server.start()
+        return self.server.address
+
+    def stop(self):
+        self.server.stop()
+
+    def handle(self, sock, address):
+        height = len(self.chain.hashes) if self.chain else 0
+        conn = Connection(address, from_services=self.services,
+                          height=height, decode_policy=REQUEST_POLICY)
+        conn.socket = sock
+        announcer = None
+        try:
+            while True:
+                for msg in conn.read_messages():
+                    self.respond(conn, msg)
+                    if msg['command'] == b"verack" and self.ping_interval:
+                        announcer = gevent.spawn(self.announce, conn)
+        except (ProtocolError, ConnectionError, socket.error):
+            pass
+        finally:
+            if announcer is not None:
+                announcer.kill(block=False)
+            conn.close()
+
+    def announce(self, conn):
+        try:
+            while True:
+                gevent.sleep(self.ping_interval)
+                with conn.batch():
+                    conn.ping()
+                    if self.chain:
+                        conn.inv([(2, self.chain.hashes[-1])])
+        except socket.error:
+            pass
+
+    def respond(self, conn, msg):
+        command = msg['command']
+        if command not in (b"version", b"getaddr", b"getheaders",
+                           b"getblocks", b"getdata"):
+            return
+        if self.latency:
+            gevent.sleep(self.latency)
+        if self.loss and random.random() < self.loss:
+            return
+
+        if command == b"version":
+            conn.send(conn.serializer.serialize_msg(
+                command=b"version", to_addr=conn.to_addr,
+                from_addr=self.server.address))
+        elif command == b"getaddr":
+            gevent.sleep(self.addr_delay)
+            if self.peers is not None:
+                conn.addr(self.peers())
+                return
+            now = int(time.time())
+            conn.addr([
+                (now, 1, "1.{}.{}.1".format(i // 256, i % 256), 8333)
+                for i in range(self.addr_count)
+            ])
+        elif command == b"getheaders":
+            headers = []
+            if self.chain:
+                (locator, stop) = parse_locator(msg['payload'])
+                headers = [self.chain.headers[i]
+                           for i in self.chain.after(locator, stop,
+                                                     MAX_HEADERS)]
+            conn.headers(headers)
+        elif command == b"getblocks" and self.chain:
+            (locator, stop) = parse_locator(msg['payload'])
+            inventory = [(2, self.chain.hashes[i])
+                         for i in self.chain.after(locator, stop, MAX_INV)]
+            if inventory:
+                conn.inv(inventory)
+        elif command == b"getdata" and self.chain:
+            inventory = conn.serializer.deserialize_inv_payload(
+                msg['payload'])['inventory']
+            with conn.batch():
+                for item in inventory:
+                    index = self.chain.index.get(item['hash'])
+                    if item['type'] != 2 or index is None:
+                        continue
+                    # Block without transactions
+                    conn.send(conn.serializer.encode_msg(
+                        b"block", conn.serializer.serialize_block_header(
+                            self.chain.headers[index])))
+
+
+class FakeNetwork(object):
+    """
+    Fleet of fake nodes on consecutive loopback addresses from 127.1.0.1, all
+    listening on port. A fraction of the nodes, unreachable, have no
+    listener so that connections to them are refused. Each node advertises
+    degree random nodes of the fleet, reachable or not, to getaddr, and
+    delays its responses by a latency drawn from an exponential
+    distribution with the mean latency. The fleet shares one chain of
+    height blocks.
+    """
+    def __init__(self, nodes=1000, port=18333, unreachable=0.2, latency=0.0,
+                 loss=0.0, degree=100, height=1000, ping_interval=0.0,
+                 seed=0):
+        rand = random.Random(seed)
+        self.port = port
+        self.degree = min(degree, nodes - 1)
+        self.seed = seed
+        self.chain = FakeChain(height, seed)
+        self.addresses = [
+            socket.inet_ntoa(struct.pack(">I", 0x7f010001 + index))
+            for index in range(nodes)
+        ]
+        self.services = [rand.choice(SERVICES) for _ in range(nodes)]
+        self.reachable = [rand.random() >= unreachable for _ in range(nodes)]
+        self.nodes = []
+        for index in range(nodes):
+            if not self.reachable[index]:
+                continue
+            self.nodes.append(FakeNode(
+                address=(self.addresses[index], port),
+                latency=rand.expovariate(1.0 / latency) if latency else 0.0,
+                loss=loss, services=self.services[index], chain=self.chain,
+                peers=self.peers_of(index), ping_interval=ping_interval))
+
+    def peers_of(self, index):
+        """
+        Returns a function returning the addr_list advertised by the node
+        at index, with timestamps up to 3 hours old.
+        """
+        rand = random.Random(self.seed * len(self.addresses) + index)
+        indexes = [i for i in rand.sample(range(len(self.addresses)),
+                                          self.degree + 1) if i != index]
+        indexes = indexes[:self.degree]
+        ages = [rand.randint(0, 3 * 60 * 60) for _ in indexes]
+
+        def peers():
+            now = int(time.time())
+            return [(now - age, self.services[i], self.addresses[i],
+                     self.port) for (i, age) in zip(indexes, ages)]
+        return peers
+
+    def seeds(self, count=10):
+        """
+        Returns (address, port, services) of the first count reachable
+        nodes.
+        """
+        return [(node.server.address[0], self.port, node.services)
+                for node in self.nodes[:count]]
+
+    def start(self):
+        for node in self.nodes:
+            node.start()
+
+    def stop(self):
+        for node in self.nodes:
+            node.stop()
+
+
+def main(argv):
+    port = int(argv[1]) if len(argv) > 1 else 0
+    node = FakeNode(address=("127.0.0.1", port))
+    node.server.init_socket()
+    print(node.server.address[1])
+    sys.stdout.flush()
+    node.server.serve_forever()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1 @@
+../ping.py
\ No newline at end of file
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import socket
+import time
+
+import pytest
+
+from aioprotocol import AsyncConnection, asyncio
+from protocol import RemoteHostClosedConnection, Serializer
+
+
+class NodeProtocol(asyncio.Protocol):
+    """
+    Answers version with version and verack and getaddr with an addr message
+    with the own address followed by one with two addresses.
+    """
+    def __init__(self):
+        self.serializer = Serializer()
+        self.rbuf = b""
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.rbuf += data
+        offset = 0
+        while offset < len(self.rbuf):
+            (msg, offset) = self.serializer.deserialize_msg_at(
+                self.rbuf, offset)
+            self.respond(msg['command'])
+        self.rbuf = b""
+
+    def respond(self, command):
+        serialize_msg = self.serializer.serialize_msg
+        now = int(time.time())
+        if command == b"version":
+            self.transport.write(serialize_msg(
+                command=b"version", to_addr=("127.0.0.1", 8333),
+                from_addr=("127.0.0.1", 8333)))
+            self.transport.write(serialize_msg(command=b"verack"))
+        elif command == b"getaddr":
+            self.transport.write(serialize_msg(
+                command=b"addr", addr_list=[(now, 1, "127.0.0.1", 8333)]))
+            self.transport.write(serialize_msg(
+                command=b"addr", addr_list=[
+                    (now, 1, "10.0.0.1", 8333), (now, 1, "10.0.0.2", 8333)]))
+        elif command == b"ping":
+            self.transport.close()
+
+
+@pytest.fixture
+def node():
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(
+        loop.create_server(NodeProtocol, "127.0.0.1", 0))
+    yield (loop, server.sockets[0].getsockname())
+    server.close()
+    loop.close()
+
+
+def test_async_connection(node):
+    (loop, address) = node
+    conn = AsyncConnection(address, ("127.0.0.1", 0), loop=loop)
+
+    loop.run_until_complete(conn.open())
+    msgs = loop.run_until_complete(conn.handshake())
+    assert [m['command'] for m in msgs] == [b"version", b"verack"]
+
+    msgs = loop.run_until_complete(conn.getaddr())
+    assert [m['count'] for m in msgs] == [2, 1]
+    assert [a['ipv4'] for a in msgs[0]['addr_list']] == [
+        "10.0.0.1", "10.0.0.2"]
+
+    assert loop.run_until_complete(
+        conn.wait_for([b"headers"], timeout=0.1)) is None
+
+    conn.ping()
+    with pytest.raises(RemoteHostClosedConnection):
+        loop.run_until_complete(conn.wait_for([b"headers"]))
+    conn.close()
+
+
+def test_async_connection_ipv6(node):
+    (loop, _) = node
+    try:
+        server = loop.run_until_complete(
+            loop.create_server(NodeProtocol, "::1", 0))
+    except (OSError, socket.error):
+        pytest.skip("IPv6 loopback is not available")
+    address = server.sockets[0].getsockname()[:2]
+    # Default IPv4 from_addr is not bound for an IPv6 peer
+    conn = AsyncConnection(address, loop=loop)
+
+    loop.run_until_complete(conn.open())
+    msgs = loop.run_until_complete(conn.handshake())
+    assert [m['command'] for m in msgs] == [b"version", b"verack"]
+    conn.close()
+    server.close()
+
+
+def test_async_connection_partial_frames():
+    conn = AsyncConnection(("127.0.0.1", 8333), loop=asyncio.new_event_loop())
+    serializer = Serializer()
+    data = (serializer.serialize_msg(command=b"verack") +
+            serializer.serialize_msg(command=b"addr", addr_list=[
+                (1500000000, 1, "10.0.0.{}".format(i), 8333)
+                for i in range(200)]))
+    for i in range(len(data)):
+        conn.data_received(data[i:i + 1])
+        if i == 23:
+            assert len(conn.rbuf) == 0
+    assert [m['command'] for m in conn.inbox] == [b"verack", b"addr"]
+    assert len(conn.rbuf) == 0
+    conn.loop.close()
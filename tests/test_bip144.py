@@ -27,7 +27,8 @@ def test_bip144():
 
     for stream_id, reader.stream.segments in reader.streams.iteritems():
         assert stream_id == ('1.1.1.1', 56691, '2.2.2.2', 8333)
-        msg, _ = reader.serializer.deserialize_msg(reader.stream.data().next())
+        msg, _ = reader.serializer.deserialize_msg_at(
+            reader.stream.data().next())
         msgs.append(msg)
 
     assert len(msgs) == 1
@@ -45,8 +46,16 @@ def test_bip144():
         'tx_out',
         'tx_out_count',
         'version',
+        'wtx_hash',
     ]
 
+    assert (
+        msgs[0]['tx_hash'] ==
+        '87f0fdb83dd7a5b539baa8f47520b27e2e4d0cfe5b3eefefee4ddfca597ccccd')
+    assert (
+        msgs[0]['wtx_hash'] ==
+        '481baa5eafab2360b9d435446e8c7e51b02617e192fae7b5ec9fa51c22d8b117')
+
     sig = hexlify(msgs[0]['tx_in'][0]['wits'][0]).decode()
     pub = hexlify(msgs[0]['tx_in'][0]['wits'][1]).decode()
 
@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import os
+import socket
+import subprocess
+import time
+from distutils.spawn import find_executable
+
+import gevent
+import gevent.pool
+import pytest
+import redis
+from gevent.lock import BoundedSemaphore
+from gevent.queue import Queue
+
+import crawl
+import export
+from protocol import Serializer
+from utils import (
+    EPOCH_KEY,
+    AdaptiveLimit,
+    AddressFilter,
+    HashRing,
+    crawl_key,
+    pack_node,
+    pack_opendata,
+    unpack_node,
+)
+
+
+class StubRedis(object):
+    """
+    In-memory stand-in for the Redis commands used by crawl.py and
+    export.py. Pipelines run their commands right away.
+    """
+    def __init__(self):
+        self.data = {}
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        return []
+
+    def execute_command(self, command, *args):
+        if command == 'UNLINK':
+            return sum([self.data.pop(key, None) is not None
+                        for key in args])
+        if command == 'ZADD' and args[1] == 'NX':
+            (key, _, score, member) = args
+            self.data.setdefault(key, {}).setdefault(member, float(score))
+            return
+        raise NotImplementedError(command)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def incr(self, key):
+        self.data[key] = int(self.data.get(key, 0)) + 1
+        return self.data[key]
+
+    def sadd(self, key, *members):
+        self.data.setdefault(key, set()).update(members)
+
+    def smembers(self, key):
+        return set(self.data.get(key, set()))
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hmget(self, key, fields):
+        return [self.hget(key, field) for field in fields]
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    def hdel(self, key, *fields):
+        return sum([self.data.get(key, {}).pop(field, None) is not None
+                    for field in fields])
+
+    def hscan_iter(self, key, count=None):
+        return iter(list(self.data.get(key, {}).items()))
+
+    def zadd(self, key, score, member):
+        self.data.setdefault(key, {})[member] = float(score)
+
+    def zincrby(self, key, member, amount=1):
+        zset = self.data.setdefault(key, {})
+        zset[member] = zset.get(member, 0.0) + amount
+        return zset[member]
+
+    def zrangebyscore(self, key, low, high, withscores=False):
+        items = sorted([(score, member) for (member, score)
+                        in self.data.get(key, {}).items()
+                        if low <= score <= high])
+        if withscores:
+            return [(member, score) for (score, member) in items]
+        return [member for (_, member) in items]
+
+    def zremrangebyscore(self, key, low, high):
+        # Only the '-inf' to exclusive '(high' range used by crawl.py
+        assert low == '-inf' and high.startswith('(')
+        zset = self.data.get(key, {})
+        for member in [m for (m, score) in zset.items()
+                       if score < float(high[1:])]:
+            del zset[member]
+
+
+@pytest.fixture(scope='module')
+def redis_server(tmpdir_factory):
+    """
+    Starts redis-server from REDIS_SERVER or PATH on a temporary socket for
+    tests running Lua scripts, which the stub does not support.
+    """
+    server = os.environ.get('REDIS_SERVER') or find_executable('redis-server')
+    if server is None:
+        pytest.skip("redis-server is not available")
+    tmpdir = str(tmpdir_factory.mktemp("redis"))
+    socket_path = os.path.join(tmpdir, "redis.sock")
+    process = subprocess.Popen([server, "--port", "0", "--unixsocket",
+                                socket_path, "--save", "", "--dir", tmpdir],
+                               stdout=open(os.devnull, 'w'))
+    while not os.path.exists(socket_path):
+        time.sleep(0.01)
+    yield socket_path
+    process.kill()
+    process.wait()
+
+
+@pytest.fixture
+def live_redis(redis_server):
+    redis_conn = redis.StrictRedis(unix_socket_path=redis_server)
+    redis_conn.flushdb()
+    return redis_conn
+
+
+@pytest.fixture
+def redis_conn(monkeypatch):
+    redis_conn = StubRedis()
+    monkeypatch.setattr(crawl, 'REDIS_CONN', redis_conn)
+    monkeypatch.setattr(export, 'REDIS_CONN', redis_conn)
+    return redis_conn
+
+
+def test_new_epoch(redis_conn):
+    nodes = [pack_node("1.2.3.4", 8333, 1), pack_node("1.2.3.5", 8333, 1)]
+    redis_conn.set(EPOCH_KEY, 5)
+    for epoch in (4, 5):
+        redis_conn.sadd(crawl_key(epoch, 'nodes'), *nodes)
+        redis_conn.sadd(crawl_key(epoch, 'up'), nodes[0])
+        redis_conn.hset(crawl_key(epoch, 'height'), nodes[0], epoch)
+
+    # Epoch 5 is kept for export.py, epoch 4 is removed
+    assert crawl.new_epoch() == 5
+    assert int(redis_conn.get(EPOCH_KEY)) == 6
+    assert sorted(redis_conn.data) == [
+        crawl_key(5, name) for name in ('height', 'nodes', 'up')] + [EPOCH_KEY]
+    assert crawl.new_epoch() == 6
+    assert sorted(redis_conn.data) == [EPOCH_KEY]
+
+
+def test_dump(redis_conn, monkeypatch, tmpdir):
+    monkeypatch.setattr(crawl, 'CONF', {'crawl_dir': str(tmpdir)})
+    nodes = [pack_node("1.2.3.{}".format(i), 8333, 1) for i in range(4)]
+    for (node, height) in zip(nodes, (500001, 500001, 500000)):
+        redis_conn.hset(crawl_key(5, 'height'), node, str(height))
+    redis_conn.hset(crawl_key(6, 'height'), nodes[3], "500002")
+
+    # Heights of the crawl epoch, 0 if missing
+    assert crawl.dump(1500000000, 5, nodes) == 500001
+    with open(os.path.join(str(tmpdir), "1500000000.json")) as dump:
+        assert sorted(json.load(dump)) == [
+            ["1.2.3.0", 8333, 1, 500001],
+            ["1.2.3.1", 8333, 1, 500001],
+            ["1.2.3.2", 8333, 1, 500000],
+            ["1.2.3.3", 8333, 1, 0],
+        ]
+    assert crawl.dump(1500000001, 5, []) == 0
+
+
+def test_export_nodes(redis_conn, monkeypatch, tmpdir):
+    monkeypatch.setattr(export, 'CONF', {'export_dir': str(tmpdir)})
+    node = pack_opendata("1.2.3.4", 8333, 70015, b"/Satoshi:0.16.0/",
+                         1500000000, 1)
+    redis_conn.set(EPOCH_KEY, 6)
+    redis_conn.hset(crawl_key(5, 'height'), pack_node("1.2.3.4", 8333, 1),
+                    b"500000")
+    redis_conn.hset(crawl_key(6, 'height'), pack_node("1.2.3.4", 8333, 1),
+                    b"500001")
+
+    # Heights of the last completed crawl epoch
+    export.export_nodes([node], 1500000000)
+    with open(os.path.join(str(tmpdir), "1500000000.json")) as dump:
+        rows = json.load(dump)
+    assert rows[0][:7] == ["1.2.3.4", 8333, 70015, "/Satoshi:0.16.0/",
+                           1500000000, 1, 500000]
+
+
+def test_claim_nodes(live_redis, monkeypatch):
+    monkeypatch.setattr(crawl, 'CONF', {
+        'claim_batch': 3, 'ipv6': True, 'ipv6_prefix': 32,
+        'nodes_per_ipv6_prefix': 1, 'probe_rate': 0.0,
+        'probe_timeout': 3, 'socket_timeout': 30})
+    nodes = [
+        ("1.2.3.4", 8333, 1),
+        ("2001:db8:1::1", 8333, 1),
+        ("2001:db8:2::1", 8333, 1),  # same /32 prefix
+        ("1.2.3.5", 8333, 1),  # already visited in the epoch
+        ("1.2.3.6", 8333, 1),  # failing
+        ("aaaaaaaaaaaaaaaa.onion", 8333, 1),
+        ("2001:db9::1", 8333, 1),
+    ]
+    members = [pack_node(*node) for node in nodes]
+    for (score, member) in enumerate(reversed(members)):
+        live_redis.zadd('pending', score, member)
+    live_redis.set(EPOCH_KEY, 3)
+    live_redis.sadd(crawl_key(3, 'nodes'), members[3])
+    live_redis.hset('crawl:failures', members[4],
+                    crawl.FAILURE.pack(1, int(time.time()) + 3600))
+    claim_nodes = live_redis.register_script(crawl.CLAIM_NODES)
+
+    # Retried with the keys of the current epoch
+    (epoch, popped, claimed) = crawl.claim(claim_nodes, 'pending')
+    assert (epoch, popped) == (3, 3)
+    assert [unpack_node(m) for m in claimed] == [nodes[0], nodes[1]]
+    (epoch, popped, claimed) = crawl.claim(claim_nodes, 'pending', epoch)
+    assert (epoch, popped, claimed) == (3, 3, [members[5]])
+    assert live_redis.hgetall(crawl_key(3, 'metrics')) == {
+        b'skipped': b'1', b'probed': b'0', b'saved': b'3'}
+
+    # IPv6 nodes are skipped if disabled
+    crawl.CONF['ipv6'] = False
+    assert crawl.claim(claim_nodes, 'pending', epoch) == (3, 1, [])
+    assert crawl.claim(claim_nodes, 'pending', epoch) == (3, 0, [])
+    assert live_redis.scard(crawl_key(3, 'nodes')) == 6
+    assert live_redis.hgetall(crawl_key(3, 'cidr')) == {
+        b"\x20\x01\x0d\xb8": b'2'}
+    assert live_redis.exists(crawl_key(0, 'nodes')) == 0
+
+
+def test_score_peer(monkeypatch):
+    monkeypatch.setattr(crawl, 'CONF', {'max_age': 3600})
+    assert crawl.score_peer(1, 0) == crawl.ADVERTISED_SCORE
+    assert crawl.score_peer(1033, 900) == 0.75 * crawl.ADVERTISED_SCORE
+    # Without TO_SERVICES
+    assert crawl.score_peer(0, 0) == 0.5 * crawl.ADVERTISED_SCORE
+    scores = [crawl.score_peer(1, 0), crawl.score_peer(1, 1800),
+              crawl.score_peer(0, 0), crawl.score_peer(0, 1800),
+              crawl.score_peer(1, 3600)]
+    assert scores == sorted(scores, reverse=True)
+    assert crawl.REACHABLE_SCORE > 10 * crawl.score_peer(1, 0)
+
+
+def test_add_pending(redis_conn, monkeypatch):
+    monkeypatch.setattr(crawl, 'CONF', {
+        'schedule': "priority", 'shard_ring': None,
+        'pending_keys': ['pending']})
+    members = [pack_node("1.2.3.{}".format(i), 8333, 1) for i in range(3)]
+
+    # Scores of repeated advertisements accumulate
+    crawl.add_pending(redis_conn, 1.0, *members)
+    crawl.add_pending(redis_conn, 0.5, members[0])
+    crawl.add_pending(redis_conn, 0.25, members[0], members[1])
+    assert redis_conn.data['pending'] == {
+        members[0]: 1.75, members[1]: 1.25, members[2]: 1.0}
+
+    # Added once with a random score
+    crawl.CONF['schedule'] = "random"
+    crawl.add_pending(redis_conn, 100.0, members[2])
+    assert redis_conn.data['pending'][members[2]] == 1.0
+    redis_conn.data.clear()
+    crawl.add_pending(redis_conn, 100.0, *members)
+    scores = redis_conn.data['pending']
+    crawl.add_pending(redis_conn, 100.0, *members)
+    assert redis_conn.data['pending'] == scores
+    assert all([0.0 <= score < 1.0 for score in scores.values()])
+
+    # Added into the shards owning the members
+    redis_conn.data.clear()
+    crawl.CONF.update({
+        'schedule': "priority", 'shard_ring': HashRing(4),
+        'pending_keys': ['pending:{}'.format(i) for i in range(4)]})
+    crawl.add_pending(redis_conn, 1.0, *members)
+    for member in members:
+        key = 'pending:{}'.format(crawl.CONF['shard_ring'].shard(member))
+        assert redis_conn.data[key][member] == 1.0
+
+
+def test_load_reachable(redis_conn, monkeypatch):
+    monkeypatch.setattr(crawl, 'CONF', {
+        'max_age': 3600, 'schedule': "priority", 'shard_ring': None,
+        'pending_keys': ['pending']})
+    members = [pack_node("1.2.3.{}".format(i), 8333, 1) for i in range(3)]
+    now = 1500000000
+    for (member, age) in zip(members, (0, 1800, 3601)):
+        redis_conn.zadd('crawl:reachable', now - age, member)
+
+    # Nodes last reachable before max. age are pruned
+    assert crawl.load_reachable(redis_conn, now) == 2
+    assert redis_conn.data['pending'] == {
+        members[0]: crawl.REACHABLE_SCORE,
+        members[1]: 0.5 * crawl.REACHABLE_SCORE}
+    assert members[2] not in redis_conn.data['crawl:reachable']
+
+
+def test_record_failure(live_redis, redis_server, monkeypatch):
+    monkeypatch.setattr(crawl, 'CONF', {'backoff': 3600,
+                                        'max_backoff': 4 * 3600})
+    member = pack_node("1.2.3.4", 8333, 1)
+    now = 1500000000
+
+    # Backoff doubles with each consecutive failure up to max. backoff
+    for (count, backoff) in [(1, 1), (2, 2), (3, 4), (4, 4), (5, 4)]:
+        assert crawl.record_failure(live_redis, member, now) == count
+        failure = live_redis.hget('crawl:failures', member)
+        assert crawl.FAILURE.unpack(failure) == (count, now + backoff * 3600)
+
+    # Failures recorded concurrently by workers are all counted
+    conns = [redis.StrictRedis(unix_socket_path=redis_server)
+             for _ in range(20)]
+    gevent.joinall([gevent.spawn(crawl.record_failure, conn, member, now)
+                    for conn in conns])
+    failure = live_redis.hget('crawl:failures', member)
+    assert crawl.FAILURE.unpack(failure)[0] == 25
+
+
+def test_prune_failures(redis_conn, monkeypatch):
+    monkeypatch.setattr(crawl, 'CONF', {'max_backoff': 3600,
+                                        'max_failures': 2})
+    now = 1500000000
+    members = [pack_node("1.2.3.{}".format(i), 8333, 1) for i in range(5)]
+    for (member, eligible) in zip(members, (-3601, -3600, 0, 60, 30)):
+        redis_conn.hset('crawl:failures', member,
+                        crawl.FAILURE.pack(1, now + eligible))
+
+    # Stale failure and the oldest failures beyond max. failures
+    assert crawl.prune_failures(now) == 3
+    assert sorted(redis_conn.data['crawl:failures']) == sorted(members[3:])
+    assert crawl.prune_failures(now) == 0
+    assert crawl.prune_failures(now + 3645) == 1
+    assert list(redis_conn.data['crawl:failures']) == [members[3]]
+
+
+def test_enumerate_node(redis_conn, monkeypatch):
+    monkeypatch.setattr(crawl, 'SEEN', {})
+    monkeypatch.setattr(crawl, 'CONF', {
+        'max_advertisements': 3, 'schedule': "priority",
+        'seen_capacity': 1000, 'seen_error_rate': 0.001,
+        'exclude_filter': AddressFilter(), 'max_age': 3600, 'port': 8333,
+        'peers_per_node': 1000, 'shard_ring': None,
+        'pending_keys': ['pending']})
+    now = 1500000000
+    serializer = Serializer()
+    addr_msg = serializer.deserialize_addr_payload(
+        serializer.serialize_addr_payload([
+            (now, 1, "1.2.3.4", 8333),
+            (now, 1, "1.2.3.5", 0),  # default port
+            (now, 1, "10.0.0.1", 8333),  # excluded
+            (now - 7200, 1, "1.2.3.6", 8333),  # too old
+        ]))
+    members = [pack_node("1.2.3.4", 8333, 1), pack_node("1.2.3.5", 8333, 1)]
+
+    # Added up to max. advertisements times per epoch
+    for _ in range(5):
+        assert crawl.enumerate_node(redis_conn, [addr_msg], now, 1) == (2, 1)
+    assert redis_conn.data['pending'] == dict.fromkeys(members, 3.0)
+    seen = crawl.get_seen_filter(1)
+    assert (seen.checked, seen.dropped) == (10, 4)
+
+    # Filter is replaced in a new epoch
+    crawl.enumerate_node(redis_conn, [addr_msg], now, 2)
+    assert redis_conn.data['pending'] == dict.fromkeys(members, 4.0)
+    assert crawl.get_seen_filter(2) is not seen
+
+    # Added once with the random schedule
+    redis_conn.data.clear()
+    crawl.CONF['schedule'] = "random"
+    for _ in range(3):
+        crawl.enumerate_node(redis_conn, [addr_msg], now, 3)
+    seen = crawl.get_seen_filter(3)
+    assert (seen.checked, seen.dropped) == (6, 4)
+    assert sorted(redis_conn.data['pending']) == sorted(members)
+
+
+class StubConnection(object):
+    def __init__(self, node, events):
+        self.node = node
+        self.to_addr = node[:2]
+        self.events = events
+
+    def open(self):
+        self.events.append(('open', self.node[0]))
+        if self.node[0] == "1.2.3.6":
+            raise socket.error("connection refused")
+
+    def close(self):
+        self.events.append(('close', self.node[0]))
+
+
+def test_spawn_probe(monkeypatch):
+    events = []
+    monkeypatch.setattr(crawl, 'HANDSHAKE_SLOTS', BoundedSemaphore(1))
+    monkeypatch.setattr(crawl, 'HANDSHAKES', Queue(1))
+    monkeypatch.setattr(crawl, 'PROBES', gevent.pool.Pool(10))
+    monkeypatch.setattr(crawl, 'CONF', {'db': 0})
+    monkeypatch.setattr(crawl, 'PROBE_LIMIT', AdaptiveLimit('probe', 2, 4))
+    monkeypatch.setattr(crawl, 'new_connection',
+                        lambda node: StubConnection(node, events))
+    monkeypatch.setattr(crawl, 'new_redis_conn', lambda db: None)
+
+    def connect(redis_conn, epoch, node, conn):
+        events.append(('connect', node[0]))
+        return True
+
+    def record_failure(redis_conn, member, now):
+        events.append(('failure', unpack_node(member)[0]))
+
+    monkeypatch.setattr(crawl, 'connect', connect)
+    monkeypatch.setattr(crawl, 'record_failure', record_failure)
+    nodes = [("1.2.3.{}".format(i), 8333, 1) for i in range(4, 7)]
+
+    # Second probe waits for the handshake slot before opening
+    spawner = gevent.spawn(
+        lambda: [crawl.spawn_probe(1, node) for node in nodes])
+    gevent.sleep(0.01)
+    assert events == [('open', "1.2.3.4")]
+
+    # Probes waiting for a handshake slot are not active in the limit
+    assert crawl.PROBE_LIMIT.active == 0
+    assert crawl.PROBE_LIMIT.decide(0, None, None, 0) == "hold"
+
+    worker = gevent.spawn(crawl.handshake_worker)
+    spawner.join()
+    crawl.PROBES.join()
+    gevent.sleep(0.01)
+    worker.kill()
+    assert events == [('open', "1.2.3.4"), ('connect', "1.2.3.4"),
+                      ('open', "1.2.3.5"), ('connect', "1.2.3.5"),
+                      ('open', "1.2.3.6"), ('close', "1.2.3.6"),
+                      ('failure', "1.2.3.6")]
+    assert crawl.HANDSHAKE_SLOTS.counter == 1
@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import hashlib
+import socket
+import time
+from binascii import hexlify
+
+import gevent
+import gevent.socket
+import pytest
+
+from protocol import (
+    Connection,
+    ConnectionError,
+    DecodePolicy,
+    InvalidPayloadChecksum,
+    NetworkAddress,
+    PayloadTooLargeError,
+    PayloadTooShortError,
+    ReadError,
+    Serializer,
+    TxIn,
+)
+
+
+def test_deserialize_msg_at():
+    serializer = Serializer()
+    data = b''.join([
+        serializer.serialize_msg(command=b"ping", nonce=nonce)
+        for nonce in range(3)
+    ])
+
+    msgs = []
+    offset = 0
+    while offset < len(data):
+        (msg, offset) = serializer.deserialize_msg_at(data, offset)
+        msgs.append(msg)
+
+    assert offset == len(data)
+    assert [m['command'] for m in msgs] == [b"ping"] * 3
+    assert [m['nonce'] for m in msgs] == [0, 1, 2]
+
+
+def test_deserialize_msg_at_buffer():
+    serializer = Serializer()
+    ping = serializer.serialize_msg(command=b"ping", nonce=1)
+    data = bytearray(ping + ping[:-4])
+
+    (msg, offset) = serializer.deserialize_msg_at(data)
+    assert msg['nonce'] == 1
+    assert offset == len(ping)
+
+    with pytest.raises(PayloadTooShortError):
+        serializer.deserialize_msg_at(data, offset)
+    assert serializer.required_len == len(ping)
+
+    (msg, remainder) = serializer.deserialize_msg(bytes(data))
+    assert msg['nonce'] == 1
+    assert remainder == ping[:-4]
+
+
+def test_serialize_string():
+    serializer = Serializer()
+    assert serializer.serialize_string(b"") == b"\x00"
+    data = b"a" * 253
+    assert serializer.serialize_string(data) == b"\xfd\xfd\x00" + data
+    # User agent read from conf is text
+    data = serializer.serialize_string(u"/bitnodes:0.1/")
+    assert data == b"\x0e/bitnodes:0.1/"
+
+
+def test_serialize_msg_templates():
+    serializer = Serializer()
+    testnet = Serializer(magic_number=b"\x0B\x11\x09\x07")
+
+    verack = serializer.serialize_msg(command=b"verack")
+    assert verack is serializer.serialize_msg(command=b"verack")
+    assert verack != testnet.serialize_msg(command=b"verack")
+    msg = serializer.deserialize_msg_at(verack)[0]
+    assert msg['command'] == b"verack" and msg['length'] == 0
+
+    inv = serializer.serialize_msg(command=b"inv", inventory=[(2, "ab" * 32)])
+    assert inv is serializer.serialize_msg(
+        command=b"inv", inventory=[[2, "ab" * 32]])
+    msg = serializer.deserialize_msg_at(inv)[0]
+    assert msg['inventory'] == [{'type': 2, 'hash': "ab" * 32}]
+
+    to_addr = ("1.2.3.4", 8333)
+    versions = [
+        serializer.serialize_msg(
+            command=b"version", to_addr=to_addr, from_addr=("0.0.0.0", 0))
+        for i in range(2)
+    ]
+    msgs = [serializer.deserialize_msg_at(v)[0] for v in versions]
+    assert msgs[0]['nonce'] != msgs[1]['nonce']
+    assert msgs[0]['to_addr']['ipv4'] == "1.2.3.4"
+    assert msgs[0]['to_addr']['port'] == 8333
+    assert msgs[0]['user_agent'] == serializer.user_agent
+    assert msgs[0]['height'] == serializer.height
+
+    serializer.height = 500000
+    (msg, _) = serializer.deserialize_msg_at(serializer.serialize_msg(
+        command=b"version", to_addr=to_addr, from_addr=("0.0.0.0", 0)))
+    assert msg['height'] == 500000
+
+
+def test_deserialize_addr_payload():
+    serializer = Serializer()
+    addr_list = [
+        (1500000000, 1, "1.2.3.4", 8333),
+        (1500000001, 9, "2001:db8::1", 18333),
+        (1500000002, 0, "abcdefghijklmnop.onion", 8333),
+    ]
+    payload = serializer.serialize_addr_payload(addr_list)
+
+    msg = serializer.deserialize_addr_payload(payload)
+    assert msg['count'] == 3
+    assert list(msg['addr_list'].timestamps) == [
+        1500000000, 1500000001, 1500000002]
+    assert list(msg['addr_list'].services) == [1, 9, 0]
+    assert list(msg['addr_list'].ports) == [8333, 18333, 8333]
+    assert msg['addr_list'].addresses[0] == (
+        b"\x00" * 10 + b"\xFF" * 2 + b"\x01\x02\x03\x04")
+    assert [(m['ipv4'], m['ipv6'], m['onion']) for m in msg['addr_list']] == [
+        ("1.2.3.4", "", ""),
+        ("", "2001:db8::1", ""),
+        ("", "", "abcdefghijklmnop.onion"),
+    ]
+
+    with pytest.raises(ReadError):
+        serializer.deserialize_addr_payload(payload[:-1])
+    # Count exceeding the records in the payload is rejected before they
+    # are unpacked
+    for count in (b"\xfe\x00\x00\x00\x10", b"\xff" * 9):
+        with pytest.raises(ReadError):
+            serializer.deserialize_addr_payload(count + payload[1:31])
+        with pytest.raises(ReadError):
+            serializer.deserialize_inv_payload(count + b"\x00" * 36)
+        with pytest.raises(ReadError):
+            serializer.deserialize_block_headers_payload(
+                count + b"\x00" * 81)
+
+
+def test_records():
+    addr = NetworkAddress(1500000000, 1, "1.2.3.4", "", "", 8333)
+    assert addr['ipv4'] == addr.ipv4 == "1.2.3.4"
+    assert addr.get('port') == 8333
+    assert addr.get('nonce') is None
+    assert addr == {
+        'timestamp': 1500000000,
+        'services': 1,
+        'ipv4': "1.2.3.4",
+        'ipv6': "",
+        'onion': "",
+        'port': 8333,
+    }
+    assert not hasattr(addr, '__dict__')
+    with pytest.raises(KeyError):
+        addr['nonce']
+    with pytest.raises(KeyError):
+        addr['nonce'] = 1
+
+    tx_in = TxIn("11" * 32, 0, 0, b"", 0xFFFFFFFF)
+    assert 'wits' not in tx_in
+    assert tx_in.get('wits', []) == []
+    tx_in.update({'wits': [b"\x01"]})
+    assert 'wits' in tx_in and tx_in['wits'] == [b"\x01"]
+    assert len(tx_in) == len(dict(tx_in.items())) == 6
+
+
+def test_decode_policy():
+    serializer = Serializer()
+    ping = serializer.serialize_msg(command=b"ping", nonce=1)
+    inv = serializer.serialize_msg(command=b"inv", inventory=[(2, "00" * 32)])
+    bad_inv = inv[:20] + b"\x00" * 4 + inv[24:]
+
+    policy = DecodePolicy(decode=[b"ping"], raw=[b"inv"])
+    (msg, _) = serializer.deserialize_msg_at(ping, policy=policy)
+    assert msg['nonce'] == 1
+    (msg, _) = serializer.deserialize_msg_at(inv, policy=policy)
+    assert 'inventory' not in msg
+    assert msg['payload'] == inv[24:]
+
+    policy = DecodePolicy(decode=[b"ping"])
+    (msg, offset) = serializer.deserialize_msg_at(inv, policy=policy)
+    assert msg['command'] == b"inv"
+    assert 'payload' not in msg and 'inventory' not in msg
+    assert offset == len(inv)
+    with pytest.raises(InvalidPayloadChecksum):
+        serializer.deserialize_msg_at(bad_inv, policy=policy)
+
+    policy = DecodePolicy(skip=[b"inv"], skip_checksum=True)
+    (msg, _) = serializer.deserialize_msg_at(bad_inv, policy=policy)
+    assert msg['command'] == b"inv"
+    (msg, _) = serializer.deserialize_msg_at(ping, policy=policy)
+    assert msg['nonce'] == 1
+
+
+def make_tx(script):
+    return {
+        'version': 1,
+        'tx_in_count': 1,
+        'tx_in': [{
+            'prev_out_hash': "11" * 32,
+            'prev_out_index': 0,
+            'script_length': len(script),
+            'script': script,
+            'sequence': 0xFFFFFFFF,
+        }],
+        'tx_out_count': 1,
+        'tx_out': [{
+            'value': 5000,
+            'script_length': 2,
+            'script': b"\x51\x52",
+        }],
+        'lock_time': 0,
+    }
+
+
+def make_segwit_tx(serializer, script, wits):
+    payload = serializer.serialize_tx_payload(make_tx(script))
+    return b''.join([
+        payload[:4],
+        b"\x00\x01",  # marker, flags
+        payload[4:-4],
+        serializer.serialize_string_vector(wits),
+        payload[-4:],
+    ])
+
+
+def test_deserialize_tx_payload_hash():
+    serializer = Serializer()
+    payload = serializer.serialize_tx_payload(make_tx(b"\x01\x02\x03"))
+    tx_hash = hashlib.sha256(hashlib.sha256(payload).digest()).digest()
+
+    msg = serializer.deserialize_tx_payload(payload)
+    assert msg['tx_hash'] == hexlify(tx_hash[::-1])
+    assert msg['wtx_hash'] == msg['tx_hash']
+
+
+def test_lazy_block():
+    serializer = Serializer()
+    txs = [
+        serializer.serialize_tx_payload(make_tx(b"\x01" * 300)),
+        make_segwit_tx(serializer, b"", [b"\x02" * 72, b"\x03" * 33]),
+        serializer.serialize_tx_payload(make_tx(b"")),
+    ]
+    payload = b"\x00" * 80 + serializer.serialize_int(len(txs)) + b''.join(txs)
+
+    block = serializer.deserialize_block_payload(payload)
+    serializer.lazy_blocks = True
+    lazy_block = serializer.deserialize_block_payload(payload)
+
+    assert lazy_block['block_hash'] == block['block_hash']
+    assert lazy_block['tx_count'] == 3
+    assert len(lazy_block['tx']) == 3
+    assert list(lazy_block['tx'].txids()) == [
+        tx['tx_hash'] for tx in block['tx']]
+    assert lazy_block['tx'][1] == block['tx'][1]
+    assert lazy_block['tx'][-1] == block['tx'][-1]
+    assert list(lazy_block['tx']) == block['tx']
+    with pytest.raises(IndexError):
+        lazy_block['tx'][3]
+
+
+def test_get_messages_receive_buffer():
+    conn = Connection(("127.0.0.1", 8333))
+    (conn.socket, peer) = socket.socketpair()
+    addr_list = [
+        (1500000000, 1, "10.0.{}.{}".format(i // 256, i % 256), 8333)
+        for i in range(1000)
+    ]
+    addr = conn.serializer.serialize_msg(command=b"addr", addr_list=addr_list)
+    verack = conn.serializer.serialize_msg(command=b"verack")
+    peer.sendall(verack + addr + verack)
+
+    msgs = conn.get_messages(commands=[b"addr"])
+
+    assert len(msgs) == 1
+    assert msgs[0]['count'] == 1000
+    assert msgs[0]['addr_list'][-1]['ipv4'] == "10.0.3.231"
+    assert conn.rlen == 0
+    assert len(conn.rbuf) == 8192
+
+    conn.close()
+    peer.close()
+
+
+def test_get_messages_payload_too_large():
+    conn = Connection(("127.0.0.1", 8333))
+    (conn.socket, peer) = socket.socketpair()
+    verack = conn.serializer.serialize_msg(command=b"verack")
+    # Header advertising a 4 GB payload
+    peer.sendall(verack[:16] + b"\xff" * 4 + verack[20:])
+
+    with pytest.raises(PayloadTooLargeError):
+        conn.get_messages()
+    assert len(conn.rbuf) == 8192
+
+    conn.close()
+    peer.close()
+
+
+def test_wait_for():
+    conn = Connection(("127.0.0.1", 8333))
+    (conn.socket, peer) = gevent.socket.socketpair()
+    serializer = conn.serializer
+    addr_list = [
+        (1500000000, 1, "10.0.0.{}".format(i), 8333) for i in range(2)
+    ]
+    peer.sendall(serializer.serialize_msg(
+        command=b"addr", addr_list=addr_list[:1]))
+    gevent.spawn_later(0.1, peer.sendall, serializer.serialize_msg(
+        command=b"addr", addr_list=addr_list))
+
+    start = time.time()
+    msg = conn.wait_for([b"addr"], predicate=lambda m: m['count'] > 1,
+                        timeout=5)
+    assert time.time() - start < 1
+    assert msg['count'] == 2
+    assert conn.get_messages(commands=[b"addr"])[0]['count'] == 1
+
+    assert conn.wait_for([b"headers"], timeout=0.1) is None
+
+    peer.close()
+    with pytest.raises(ConnectionError):
+        conn.wait_for([b"headers"], timeout=5)
+    conn.close()
+
+
+class RecordingSocket(object):
+    def __init__(self, error=None):
+        self.sent = []
+        self.error = error
+
+    def sendall(self, data):
+        if self.error is not None:
+            raise self.error
+        self.sent.append(data)
+
+
+def test_write_batch():
+    conn = Connection(("127.0.0.1", 8333))
+    conn.socket = RecordingSocket()
+    serializer = conn.serializer
+
+    conn.ping(nonce=1)
+    assert len(conn.socket.sent) == 1
+
+    with conn.batch():
+        conn.ping(nonce=2)
+        with conn.batch():
+            conn.inv(inventory=[(2, "00" * 32)])
+        conn.addr(addr_list=[(1500000000, 1, "1.2.3.4", 8333)])
+        assert len(conn.socket.sent) == 1
+    assert len(conn.socket.sent) == 2
+
+    data = conn.socket.sent[1]
+    commands = []
+    offset = 0
+    while offset < len(data):
+        (msg, offset) = serializer.deserialize_msg_at(data, offset)
+        commands.append(msg['command'])
+    assert commands == [b"ping", b"inv", b"addr"]
+
+    # Messages of a batch exiting with an error are dropped, also when an
+    # inner batch exits without error or the queue is flushed within it
+    with pytest.raises(ValueError):
+        with conn.batch():
+            conn.ping(nonce=3)
+            with conn.batch():
+                conn.ping(nonce=4)
+            raise ValueError
+    conn.flush()
+    assert len(conn.socket.sent) == 2
+
+    with pytest.raises(ValueError):
+        with conn.batch():
+            conn.ping(nonce=5)
+            conn.flush()
+            conn.ping(nonce=6)
+            raise ValueError
+    conn.flush()
+    assert len(conn.socket.sent) == 3
+    assert serializer.deserialize_msg(conn.socket.sent[2])[0]['nonce'] == 5
+
+    # Messages queued before the batch are kept
+    conn.wbuf.append(conn.socket.sent[0])
+    with pytest.raises(ValueError):
+        with conn.batch():
+            conn.ping(nonce=7)
+            raise ValueError
+    conn.flush()
+    assert conn.socket.sent[3] == conn.socket.sent[0]
+
+
+def test_coalesce_writes():
+    conn = Connection(("127.0.0.1", 8333), coalesce_writes=True)
+    conn.socket = RecordingSocket()
+
+    conn.ping(nonce=1)
+    conn.ping(nonce=2)
+    assert conn.socket.sent == []
+    gevent.sleep(0)
+    assert len(conn.socket.sent) == 1
+
+    conn.socket.error = socket.error("broken pipe")
+    conn.ping(nonce=3)
+    gevent.sleep(0)
+    with pytest.raises(socket.error):
+        conn.ping(nonce=4)
+
+
+def test_connect_timeout():
+    server = gevent.socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    conn = Connection(server.getsockname(), socket_timeout=5,
+                      connect_timeout=1)
+    conn.open()
+    assert conn.socket.gettimeout() == 5
+    conn.close()
+    server.close()
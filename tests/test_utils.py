@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import random
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from binascii import hexlify
+from ipaddress import ip_address, ip_network
+
+from protocol import ONION_PREFIX, pack_address, unpack_address
+from utils import (
+    MAX_TARGET,
+    NODE,
+    AdaptiveLimit,
+    AddressFilter,
+    HashRing,
+    HeaderChain,
+    NetworkIndex,
+    SeenFilter,
+    bits_to_target,
+    fetch_networks,
+    load_networks,
+    pack_node,
+    pack_opendata,
+    save_networks,
+    unpack_node,
+    unpack_opendata,
+    upgrade_node_member,
+)
+
+
+def networks(*cidrs):
+    return set([
+        (int(n.network_address), int(n.netmask))
+        for n in [ip_network(cidr) for cidr in cidrs]
+    ])
+
+
+def test_network_index():
+    nets = networks(u"10.0.0.0/8", u"10.1.0.0/16", u"192.168.0.0/24",
+                    u"192.168.1.0/24", u"0.0.0.0/32", u"255.255.255.255/32")
+    index = NetworkIndex(nets, bits=32)
+    assert len(index) == 4  # 10/8, 192.168.0/23 and the two /32
+
+    for address in [u"10.255.255.255", u"192.168.1.7", u"0.0.0.0",
+                    u"255.255.255.255"]:
+        assert int(ip_address(address)) in index
+    for address in [u"9.255.255.255", u"11.0.0.0", u"192.168.2.0",
+                    u"0.0.0.1"]:
+        assert int(ip_address(address)) not in index
+
+    rand = random.Random(1)
+    for _ in range(10000):
+        addr = rand.getrandbits(32)
+        expected = any([addr & mask == net for (net, mask) in nets])
+        assert (addr in index) == expected
+
+    assert 1 not in NetworkIndex()
+
+
+def test_network_index_ipv6():
+    nets = networks(u"2001:db8::/32", u"fc00::/7")
+    index = NetworkIndex(nets, bits=128)
+    assert int(ip_address(u"2001:db8:ffff::1")) in index
+    assert int(ip_address(u"fdff::1")) in index
+    assert int(ip_address(u"2001:db9::")) not in index
+    assert int(ip_address(u"fe00::")) not in index
+
+
+def test_address_filter():
+    ipv4_networks = networks(u"1.0.0.0/8", u"100.64.0.0/10")
+    ipv6_networks = networks(u"2001:db8::/32", u"fd87:d87e:eb43:ff00::/56")
+    address_filter = AddressFilter(ipv4_networks, ipv6_networks)
+
+    rand = random.Random(1)
+    addresses = [pack_address(a) for a in [
+        "1.2.3.4", "10.0.0.1", "8.8.8.8", "100.100.0.1", "::1", "fe80::1",
+        "2001:db8::1", "2a00::1", "aaaaaaaaaaaaaaaa.onion"]]
+    addresses.append(ONION_PREFIX + b"\xFF" + b"\x00" * 9)
+    addresses.append(b"\x00" * 12 + b"\x0A\x00\x00\x01")  # ::10.0.0.1
+    for _ in range(2000):
+        addresses.append(pack_address(".".join(
+            [str(rand.randint(0, 255)) for i in range(4)])))
+        addresses.append(b''.join(
+            [chr(rand.getrandbits(8)) for i in range(16)]))
+
+    expected = []
+    for address in addresses:
+        address = [a for a in unpack_address(address) if a][0]
+        if address.endswith(".onion"):
+            value = int(hexlify(pack_address(address)), 16)
+            nets = ipv6_networks
+        else:
+            ip = ip_address(address.decode())
+            if ip.is_private:
+                expected.append(True)
+                continue
+            (value, nets) = (int(ip), ipv6_networks if ip.version == 6
+                             else ipv4_networks)
+        expected.append(any([value & mask == net for (net, mask) in nets]))
+
+    assert expected[:11] == [True, True, False, True, True, True, True,
+                             False, False, True, True]
+    assert address_filter.excluded(addresses) == expected
+    assert [address_filter.is_excluded(a) for a in addresses] == expected
+    address_filter.ipv4_arrays = None  # without NumPy
+    assert address_filter.excluded(addresses) == expected
+
+    address_filter = AddressFilter(exclude_private=False)
+    assert address_filter.excluded(addresses[:3]) == [False] * 3
+
+
+def test_save_networks(tmpdir):
+    ipv4_networks = networks(u"0.0.0.0/8", u"10.0.0.0/8", u"1.2.3.4/32",
+                             u"0.0.0.0/0")
+    ipv6_networks = networks(u"::/0", u"::1/128", u"2001:db8::/32")
+    path = str(tmpdir.join("ipv4.bin"))
+    save_networks(path, ipv4_networks, 32, etag=u'"abc"')
+    assert load_networks(path) == (ipv4_networks, 32, u'"abc"', u"")
+    assert os.path.getsize(path) == 14 + 5 + 4 * 5
+
+    path = str(tmpdir.join("ipv6.bin"))
+    save_networks(path, ipv6_networks, 128, last_modified=u"yesterday")
+    assert load_networks(path) == (ipv6_networks, 128, u"", u"yesterday")
+
+
+class BogonsHandler(BaseHTTPRequestHandler):
+    body = b"# bogons\n0.0.0.0/8\n10.0.0.0/8\n"
+    etag = '"v1"'
+    requests = []
+
+    def do_GET(self):
+        BogonsHandler.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_fetch_networks(tmpdir):
+    server = HTTPServer(("127.0.0.1", 0), BogonsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{}/fullbogons-ipv4.txt".format(
+        server.server_address[1])
+    path = str(tmpdir.join("bogons", "fullbogons-ipv4.bin"))
+    expected = networks(u"0.0.0.0/8", u"10.0.0.0/8")
+
+    assert fetch_networks(url, path, 32, 3600) == expected
+    assert len(BogonsHandler.requests) == 1
+    assert 'if-none-match' not in BogonsHandler.requests[0]
+
+    # Cache is fresh
+    assert fetch_networks(url, path, 32, 3600) == expected
+    assert len(BogonsHandler.requests) == 1
+
+    # Cache is stale, list is unchanged
+    os.utime(path, (time.time() - 7200, time.time() - 7200))
+    assert fetch_networks(url, path, 32, 3600) == expected
+    assert len(BogonsHandler.requests) == 2
+    assert BogonsHandler.requests[1]['if-none-match'] == '"v1"'
+    assert time.time() - os.path.getmtime(path) < 60
+
+    # List changed into an error page, cache is kept
+    os.utime(path, (time.time() - 7200, time.time() - 7200))
+    (BogonsHandler.body, BogonsHandler.etag) = (b"<html></html>", '"v2"')
+    assert fetch_networks(url, path, 32, 3600) == expected
+    assert len(BogonsHandler.requests) == 3
+    assert load_networks(path)[2] == u'"v1"'
+
+    # Offline
+    server.shutdown()
+    server.server_close()
+    assert fetch_networks(url, path, 32, 0, timeout=1) == expected
+    assert fetch_networks(url, str(tmpdir.join("missing.bin")), 32, 0,
+                          timeout=1) == set()
+
+
+def test_pack_node():
+    onion = "aaaaaaaaaaaaaaaa.onion"
+    for node in [("1.2.3.4", 8333, 1033), ("2001:db8::1", 18333, 0),
+                 (onion, 8333, 1)]:
+        member = pack_node(*node)
+        assert len(member) == NODE.size == 26
+        assert unpack_node(member) == node
+
+    member = pack_node("1.2.3.4", 8333, 1, height=600000)
+    assert len(member) == 30
+    assert unpack_node(member) == ("1.2.3.4", 8333, 1, 600000)
+
+    # Raw address from addr message packs to the same member
+    assert NODE.pack(pack_address("1.2.3.4"), 8333, 1) == pack_node(
+        "1.2.3.4", 8333, 1)
+
+    data = ("1.2.3.4", 8333, 70015, b"/Satoshi:0.16.0/", 1500000000, 1033)
+    assert unpack_opendata(pack_opendata(*data)) == data
+    data = (onion, 8333, 70015, b"", 1500000000, 0)
+    assert unpack_opendata(pack_opendata(*data)) == data
+
+
+def test_upgrade_node_member():
+    assert upgrade_node_member(
+        'pending', repr(("1.2.3.4", 8333, 1))) == pack_node(
+            "1.2.3.4", 8333, 1)
+    assert upgrade_node_member(
+        'reachable', repr(("2001:db8::1", 8333, 1, 500000))) == pack_node(
+            "2001:db8::1", 8333, 1, 500000)
+    data = ("1.2.3.4", 8333, 70015, b"/Satoshi:0.16.0/", 1500000000, 1)
+    assert upgrade_node_member('opendata', repr(data)) == pack_opendata(
+        *data)
+
+    # Packed members are left as is
+    assert upgrade_node_member(
+        'pending', pack_node("1.2.3.4", 8333, 1)) is None
+
+
+def test_hash_ring():
+    rand = random.Random(0)
+    members = [pack_node("1.{}.{}.{}".format(
+        rand.randint(0, 255), rand.randint(0, 255), rand.randint(0, 255)),
+        8333, 1) for _ in range(8000)]
+    ring = HashRing(8)
+    shards = [ring.shard(member) for member in members]
+    for shard in range(8):
+        assert 600 < shards.count(shard) < 1400
+    ring = HashRing(8)
+    assert shards == [ring.shard(member) for member in members]
+
+    # Adding a shard only moves members onto the new shard
+    ring = HashRing(9)
+    for (member, shard) in zip(members, shards):
+        assert ring.shard(member) in (shard, 8)
+
+
+def test_seen_filter():
+    members = [pack_node("1.2.{}.{}".format(i // 256, i % 256), 8333, 1)
+               for i in range(1000)]
+    seen = SeenFilter(1000)
+    assert [seen.add(m) for m in members[:2]] == [0, 0]
+    assert seen.add(members[0]) == 1
+
+    seen = SeenFilter(1000)
+    assert all([seen.check(m) for m in members])
+    assert not any([seen.check(m) for m in members])
+    assert (seen.checked, seen.dropped) == (2000, 1000)
+
+    # Members are written until seen limit times
+    assert [seen.check(members[0], limit=3) for _ in range(3)] == [
+        True, False, False]
+    assert seen.check(members[1], limit=3)
+
+    # Filter is cleared once it holds more than capacity members
+    seen = SeenFilter(100)
+    for member in members[:101]:
+        seen.add(member)
+    assert seen.members == 1
+    assert seen.add(members[0]) == 0
+
+
+def test_adaptive_limit():
+    limit = AdaptiveLimit('test', 10, 100, minimum=5, step=10)
+    for _ in range(10):
+        limit.acquire()
+    assert limit.free() == 0
+
+    # Grows while the workers are at the limit
+    assert limit.decide(0.0, 1.0, 0.5, 0.5) == "saturated"
+    assert (limit.limit, limit.free()) == (20, 10)
+    assert limit.decide(0.0, 1.5, 0.5, 0.5) == "hold"
+    assert limit.limit == 20
+
+    # Cut by half when any of the signals is over its threshold
+    assert limit.decide(0.0, 2.5, None, 0.5) == "latency"
+    assert limit.limit == 10
+    assert limit.decide(0.5, None, None, 0.5) == "lag"
+    assert limit.decide(0.0, None, None, 1.0) == "cpu"
+    assert limit.decide(0.0, None, 0.05, 0.5) == "fds"
+    assert (limit.limit, limit.decreases) == (5, 2)
+
+    limit.release()
+    assert (limit.active, limit.free()) == (9, 0)
+
+
+def test_bits_to_target():
+    assert bits_to_target(0x1d00ffff) == MAX_TARGET
+    assert bits_to_target(0x1b0404cb) == 0x0404cb * 2 ** (8 * (0x1b - 3))
+    assert bits_to_target(0x207fffff) == 0x7fffff << 232  # regtest
+    assert bits_to_target(0x03123456) == 0x123456
+    assert bits_to_target(0x02123456) == 0x1234
+    assert bits_to_target(0x04923456) == 0  # negative
+
+
+def test_header_chain():
+    # Block hashes below the target of difficulty 1
+    hashes = [b"%064x" % i for i in range(20)]
+
+    def headers(prev_block_hash, *block_hashes, **fields):
+        records = []
+        for block_hash in block_hashes:
+            records.append({'prev_block_hash': prev_block_hash,
+                            'block_hash': block_hash,
+                            'bits': fields.get('bits', 0x1d00ffff)})
+            prev_block_hash = block_hash
+        return records
+
+    chain = HeaderChain(size=8)
+    assert (chain.tip(), chain.locator()) == (None, [])
+    assert chain.add(headers(hashes[0], hashes[1])) == 0
+
+    # Bootstrapped from the most recent block first, tip is left out of the
+    # locator so that it is returned in the headers message
+    chain.bootstrap(hashes[4::-1])
+    assert chain.tip() == hashes[4]
+    assert chain.locator(2) == [hashes[3], hashes[2]]
+    assert chain.locator() == hashes[3::-1]
+
+    assert chain.add(headers(hashes[4], *hashes[5:12])) == 7
+    assert (chain.height, chain.tip()) == (11, hashes[11])
+    # Older blocks are overwritten
+    assert chain.locator() == hashes[10:3:-1]
+    assert chain.find(hashes[3]) is None
+
+    # Rejects headers that do not connect, are not linked or do not make
+    # the chain longer
+    assert chain.add(headers(hashes[19], hashes[12])) == 0
+    assert chain.add(headers(hashes[11], hashes[12]) +
+                     headers(hashes[19], hashes[13])) == 0
+    fork = [b"%064x" % (100 + i) for i in range(4)]
+    assert chain.add(headers(hashes[9], *fork[:2])) == 0
+    assert chain.tip() == hashes[11]
+
+    # Switches to a longer branch
+    assert chain.add(headers(hashes[9], *fork)) == 2
+    assert chain.tip() == fork[3]
+    assert chain.locator(4) == fork[2::-1] + [hashes[9]]
+
+    # Rejects a longer branch without valid proof of work at the minimum
+    # difficulty
+    fake = [b"%064x" % (MAX_TARGET + 1 + i) for i in range(10)]
+    assert chain.add(headers(fork[3], *fake)) == 0
+    fake = [b"%064x" % (200 + i) for i in range(10)]
+    assert chain.add(headers(fork[3], *fake, bits=0x207fffff)) == 0
+    assert chain.add(headers(fork[3], *fake, bits=0x04923456)) == 0
+    chain.max_target = MAX_TARGET >> 32
+    assert chain.add(headers(fork[3], *fake)) == 0
+    assert chain.tip() == fork[3]
+    assert chain.add(headers(fork[3], *fake, bits=0x1900ffff)) == 10
+    assert chain.tip() == fake[-1]
@@ -28,10 +28,69 @@
 Common helper methods.
 """
 
+import gevent
+import gevent.event
+import hashlib
+import logging
+import math
 import os
 import redis
+import requests
+import resource
+import struct
+import time
+import zlib
+from ast import literal_eval
+from binascii import hexlify, unhexlify
+from bisect import bisect_right
 from ipaddress import ip_network
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from protocol import IPV4_PREFIX, ONION_PREFIX, pack_address, unpack_address
+
+# Networks of addresses for which ipaddress reports is_private
+PRIVATE_IPV4_NETWORKS = (
+    u"0.0.0.0/8", u"10.0.0.0/8", u"127.0.0.0/8", u"169.254.0.0/16",
+    u"172.16.0.0/12", u"192.0.0.0/29", u"192.0.0.170/31", u"192.0.2.0/24",
+    u"192.168.0.0/16", u"198.18.0.0/15", u"198.51.100.0/24",
+    u"203.0.113.0/24", u"240.0.0.0/4", u"255.255.255.255/32",
+)
+PRIVATE_IPV6_NETWORKS = (
+    u"::1/128", u"::/128", u"::ffff:0:0/96", u"100::/64", u"2001::/23",
+    u"2001:2::/48", u"2001:db8::/32", u"2001:10::/28", u"fc00::/7",
+    u"fe80::/10",
+)
+
+IPV4 = struct.Struct(">I")
+IPV6 = struct.Struct(">QQ")
+
+# Header of network cache file written by save_networks(): magic, version,
+# address size in bits, number of networks, length of ETag and length of
+# Last-Modified that follow the header before the networks.
+NETWORKS_HEADER = struct.Struct(">4sBBIHH")
+NETWORKS_MAGIC = b"NETS"
+NETWORKS_VERSION = 1
+
+# Fixed-width Redis set members for nodes, see pack_node(); 16 bytes IP_ADDR,
+# port and services optionally followed by height or, for opendata members,
+# by version, timestamp and user agent.
+NODE = struct.Struct(">16sHQ")
+HEIGHT = struct.Struct(">i")
+OPENDATA = struct.Struct(">iQ")
+
+# Redis sets holding nodes as repr() tuples prior to pack_node()
+NODE_KEYS = ('pending', 'reachable', 'opendata')
+
+# Id of the current crawl epoch, see crawl_key()
+EPOCH_KEY = 'crawl:epoch'
+
+# Proof of work limit of mainnet, i.e. the target at difficulty 1
+MAX_TARGET = 0xFFFF << 208
+
 
 def new_redis_conn(db=0):
     """
@@ -56,6 +115,371 @@ def get_keys(redis_conn, pattern, count=500):
     return keys
 
 
+def crawl_key(epoch, name):
+    """
+    Returns key of the Redis container holding state of a crawl epoch:
+    crawl:EPOCH:nodes, crawl:EPOCH:up, crawl:EPOCH:height or crawl:EPOCH:cidr.
+    """
+    return 'crawl:{}:{}'.format(epoch, name)
+
+
+def get_epoch(redis_conn):
+    """
+    Returns id of the current crawl epoch.
+    """
+    return int(redis_conn.get(EPOCH_KEY) or 0)
+
+
+def unlink(redis_conn, *keys):
+    """
+    Removes keys, reclaiming their memory in the background on Redis 4.0
+    and later.
+    """
+    try:
+        return redis_conn.execute_command('UNLINK', *keys)
+    except redis.ResponseError:  # UNLINK requires Redis 4.0
+        return redis_conn.delete(*keys)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring mapping Redis set members onto shards. Each shard
+    owns replicas points on the ring, so changing the number of shards only
+    moves the members of the ring segments gained or lost.
+    """
+    def __init__(self, shards, replicas=160):
+        points = sorted([
+            (zlib.crc32("{}-{}".format(shard, replica).encode()) & 0xFFFFFFFF,
+             shard)
+            for shard in range(shards) for replica in range(replicas)
+        ])
+        self.hashes = [point[0] for point in points]
+        self.shards = [point[1] for point in points]
+
+    def shard(self, member):
+        """
+        Returns the shard owning member.
+        """
+        index = bisect_right(self.hashes, zlib.crc32(member) & 0xFFFFFFFF)
+        return self.shards[index % len(self.shards)]
+
+
+class SeenFilter(object):
+    """
+    Counting Bloom filter of Redis set members with bounded memory. Counts
+    how many times each member was seen with a false positive rate of at
+    most error_rate while it holds up to capacity members; it is cleared
+    once it holds more.
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(
+            float(self.size) / capacity * math.log(2))))
+        self.counters = bytearray(self.size)
+        self.members = 0  # distinct members since the filter was cleared
+        self.checked = 0
+        self.dropped = 0
+
+    def positions(self, member):
+        digest = hashlib.md5(member).digest()
+        (hash1, hash2) = struct.unpack("<QQ", digest)
+        return [(hash1 + i * hash2) % self.size for i in range(self.hashes)]
+
+    def add(self, member):
+        """
+        Counts member and returns how many times it was seen before.
+        """
+        positions = self.positions(member)
+        seen = min([self.counters[i] for i in positions])
+        if seen == 0:
+            self.members += 1
+            if self.members > self.capacity:
+                self.counters = bytearray(self.size)
+                self.members = 1
+        for i in positions:
+            if self.counters[i] == seen and seen < 255:
+                self.counters[i] = seen + 1
+        return seen
+
+    def check(self, member, limit=1):
+        """
+        Returns True if member was seen fewer than limit times before, i.e.
+        it should be written, and counts it.
+        """
+        self.checked += 1
+        if self.add(member) < limit:
+            return True
+        self.dropped += 1
+        return False
+
+
+class AdaptiveLimit(object):
+    """
+    Limit on concurrent workers adjusted by additive increase and
+    multiplicative decrease (AIMD). Every interval seconds, the limit is cut
+    by backoff if the event loop lagged by more than max_lag seconds, the
+    free file descriptors fell below fd_reserve of RLIMIT_NOFILE, the
+    process used more than max_cpu of a CPU or the mean latency of the
+    samples exceeded latency_ratio times its baseline. Otherwise it grows
+    by step if the workers were at the limit.
+    """
+    def __init__(self, name, limit, maximum, minimum=1, step=10,
+                 backoff=0.5, interval=5, max_lag=0.1, max_cpu=0.9,
+                 fd_reserve=0.1, latency_ratio=2.0):
+        self.name = name
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.limit = max(self.minimum, min(limit, maximum))
+        self.step = step
+        self.backoff = backoff
+        self.interval = interval
+        self.max_lag = max_lag
+        self.max_cpu = max_cpu
+        self.fd_reserve = fd_reserve
+        self.latency_ratio = latency_ratio
+        self.active = 0
+        self.peak = 0  # max. active workers since the last update
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self.base_latency = None
+        self.increases = 0
+        self.decreases = 0
+        self.available = gevent.event.Event()
+        self.available.set()
+        self.cpu_time = cpu_time()
+        self.time = time.time()
+
+    def free(self):
+        return max(self.limit - self.active, 0)
+
+    def acquire(self):
+        """
+        Blocks while the workers are at the limit, then counts a worker.
+        """
+        while self.active >= self.limit:
+            self.available.clear()
+            self.available.wait()
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+
+    def release(self):
+        self.active -= 1
+        if self.active < self.limit:
+            self.available.set()
+
+    def sample(self, latency):
+        """
+        Adds the latency of a successful operation, e.g. connect.
+        """
+        self.latency_sum += latency
+        self.latency_count += 1
+
+    def run(self):
+        """
+        Measures event loop lag and updates the limit every interval.
+        """
+        while True:
+            lag = 0.0
+            end = time.time() + self.interval
+            while time.time() < end:
+                start = time.time()
+                gevent.sleep(0.1)
+                lag = max(lag, time.time() - start - 0.1)
+            self.update(lag)
+
+    def update(self, lag):
+        """
+        Updates the limit from lag and the latency samples, open file
+        descriptors and CPU usage since the last update.
+        """
+        now = time.time()
+        now_cpu_time = cpu_time()
+        cpu = (now_cpu_time - self.cpu_time) / max(now - self.time, 1e-9)
+        (self.cpu_time, self.time) = (now_cpu_time, now)
+        latency = None
+        if self.latency_count > 0:
+            latency = self.latency_sum / self.latency_count
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        fds = open_fds()
+        fd_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        headroom = None
+        if fds is not None and fd_limit > 0:
+            headroom = float(fd_limit - fds) / fd_limit
+
+        limit = self.limit
+        reason = self.decide(lag, latency, headroom, cpu)
+        log = logging.info if self.limit != limit else logging.debug
+        log("%s limit: %d -> %d (%s), active %d, lag %.3fs, latency %s, "
+            "fds %s/%d, cpu %.0f%%", self.name, limit, self.limit, reason,
+            self.active, lag, "-" if latency is None else
+            "{:.3f}s".format(latency), fds, fd_limit, cpu * 100)
+        return reason
+
+    def decide(self, lag, latency, headroom, cpu):
+        """
+        Adjusts the limit from the signals, latency and headroom may be None
+        if unknown, and returns the reason.
+        """
+        baseline = self.base_latency
+        if latency is not None:
+            # Baseline follows the lowest latency and rises slowly so that
+            # a lasting change in network latency is accepted
+            if baseline is None:
+                baseline = latency
+            self.base_latency = min(latency, baseline * 1.1)
+
+        reason = "hold"
+        if headroom is not None and headroom < self.fd_reserve:
+            reason = "fds"
+        elif lag > self.max_lag:
+            reason = "lag"
+        elif cpu > self.max_cpu:
+            reason = "cpu"
+        elif latency is not None and latency > baseline * self.latency_ratio:
+            reason = "latency"
+        elif self.peak >= self.limit:
+            reason = "saturated"
+
+        if reason == "saturated":
+            if self.limit < self.maximum:
+                self.limit = min(self.limit + self.step, self.maximum)
+                self.increases += 1
+                self.available.set()
+        elif reason != "hold":
+            if self.limit > self.minimum:
+                self.limit = max(int(self.limit * self.backoff),
+                                 self.minimum)
+                self.decreases += 1
+        self.peak = self.active
+        return reason
+
+
+def cpu_time():
+    """
+    Returns user and system CPU time of this process in seconds.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def open_fds():
+    """
+    Returns number of open file descriptors of this process, or None if
+    unknown.
+    """
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def bits_to_target(bits):
+    """
+    Returns the target encoded in the compact bits field of a block header,
+    or 0 if it is negative.
+    """
+    (exponent, mantissa) = (bits >> 24, bits & 0x7FFFFF)
+    if bits & 0x800000:
+        return 0
+    if exponent <= 3:
+        return mantissa >> 8 * (3 - exponent)
+    return mantissa << 8 * (exponent - 3)
+
+
+class HeaderChain(object):
+    """
+    Hashes of the last size blocks of the best chain learned from headers
+    messages, kept in one bytearray indexed by height modulo size. Headers
+    are accepted if they connect to the kept blocks, make the chain longer
+    and each meets its own target, which must not exceed max_target, i.e.
+    the minimum difficulty. Heights are relative to the first bootstrapped
+    block.
+    """
+    def __init__(self, size=2016, max_target=MAX_TARGET):
+        self.size = size
+        self.max_target = max_target
+        self.hashes = bytearray(size * 32)
+        self.height = -1  # height of the tip, -1 if empty
+
+    def get(self, height):
+        offset = height % self.size * 32
+        return bytes(self.hashes[offset:offset + 32])
+
+    def put(self, height, block_hash):
+        offset = height % self.size * 32
+        self.hashes[offset:offset + 32] = block_hash
+
+    def find(self, block_hash):
+        """
+        Returns the height of the kept block with block_hash or None.
+        """
+        for height in range(self.height,
+                            max(self.height - self.size, -1), -1):
+            if self.get(height) == block_hash:
+                return height
+        return None
+
+    def bootstrap(self, blockhashes):
+        """
+        Replaces the chain with blockhashes, most recent first, e.g. from
+        bitcoind.
+        """
+        blockhashes = blockhashes[:self.size]
+        for (height, block_hash) in enumerate(reversed(blockhashes)):
+            self.put(height, unhexlify(block_hash))
+        self.height = len(blockhashes) - 1
+
+    def add(self, headers):
+        """
+        Adds headers, BlockHeader records in chain order as found in a
+        headers message. Returns the number of blocks the tip moved up by.
+        """
+        if not headers or self.height < 0:
+            return 0
+        fork = self.find(unhexlify(headers[0]['prev_block_hash']))
+        if fork is None:
+            return 0
+        for (prev, header) in zip(headers, headers[1:]):
+            if header['prev_block_hash'] != prev['block_hash']:
+                return 0
+        for header in headers:
+            # Block hash is computed from the header when it is decoded
+            target = bits_to_target(header['bits'])
+            if not 0 < target <= self.max_target:
+                return 0
+            if int(header['block_hash'], 16) > target:
+                return 0
+        height = fork + len(headers)
+        if height <= self.height:
+            return 0
+        for (offset, header) in enumerate(headers[-self.size:]):
+            self.put(height - min(len(headers), self.size) + 1 + offset,
+                     unhexlify(header['block_hash']))
+        (moved, self.height) = (height - self.height, height)
+        return moved
+
+    def tip(self):
+        """
+        Returns hash of the tip or None if the chain is empty.
+        """
+        if self.height < 0:
+            return None
+        return hexlify(self.get(self.height))
+
+    def locator(self, count=10):
+        """
+        Returns hashes of up to count blocks below the tip, most recent
+        first, as the locator of a getheaders message for which the tip is
+        returned too.
+        """
+        end = max(self.height - 1 - count, self.height - self.size, -1)
+        return [hexlify(self.get(height))
+                for height in range(self.height - 1, end, -1)]
+
+
 def ip_to_network(address, prefix):
     """
     Returns CIDR notation to represent the address and its prefix.
@@ -63,3 +487,336 @@ def ip_to_network(address, prefix):
     network = ip_network(str("{}/{}".format(address, prefix)),
                          strict=False)
     return "{}/{}".format(network.network_address, prefix)
+
+
+class NetworkIndex(object):
+    """
+    Merged, sorted address intervals of a set of (network address, netmask)
+    tuples for lookups in O(log n) using bisect. bits is the address size,
+    i.e. 32 for IPv4 and 128 for IPv6 networks.
+    """
+    def __init__(self, networks=(), bits=32):
+        hostmask = (1 << bits) - 1
+        self.starts = []
+        self.ends = []
+        for (network, netmask) in sorted(networks):
+            end = network | (~netmask & hostmask)
+            if self.ends and network <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(network)
+                self.ends.append(end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __contains__(self, address):
+        """
+        Returns True if the integer address is in one of the networks.
+        """
+        index = bisect_right(self.starts, address) - 1
+        return index >= 0 and address <= self.ends[index]
+
+
+def to_networks(cidrs):
+    """
+    Returns a set of (network address, netmask) tuples for the networks in
+    CIDR notation.
+    """
+    networks = [ip_network(cidr) for cidr in cidrs]
+    return set([
+        (int(network.network_address), int(network.netmask))
+        for network in networks
+    ])
+
+
+class AddressFilter(object):
+    """
+    Checks 16 bytes IP_ADDR values, as found in addr messages, against the
+    excluded IPv4 and IPv6 networks without converting them into strings.
+    Unless exclude_private is False, addresses in private networks are
+    excluded too, except for .onion addresses which map into fc00::/7.
+    """
+    def __init__(self, ipv4_networks=(), ipv6_networks=(),
+                 exclude_private=True):
+        ipv4_networks = set(ipv4_networks)
+        ipv6_networks = set(ipv6_networks)
+        self.onion_index = NetworkIndex(ipv6_networks, bits=128)
+        if exclude_private:
+            ipv4_networks |= to_networks(PRIVATE_IPV4_NETWORKS)
+            ipv6_networks |= to_networks(PRIVATE_IPV6_NETWORKS)
+        self.ipv4_index = NetworkIndex(ipv4_networks, bits=32)
+        self.ipv6_index = NetworkIndex(ipv6_networks, bits=128)
+
+        # IPv4 intervals for vectorized lookups in excluded()
+        self.ipv4_arrays = None
+        if numpy is not None and len(self.ipv4_index) > 0:
+            self.ipv4_arrays = (
+                numpy.array(self.ipv4_index.starts, dtype=numpy.uint32),
+                numpy.array(self.ipv4_index.ends, dtype=numpy.uint32),
+            )
+
+    def is_excluded(self, address):
+        """
+        Returns True if the 16 bytes address is excluded.
+        """
+        if address[:12] == IPV4_PREFIX:
+            return IPV4.unpack_from(address, 12)[0] in self.ipv4_index
+        (high, low) = IPV6.unpack(address)
+        if address[:6] == ONION_PREFIX:
+            return (high << 64 | low) in self.onion_index
+        if high == 0 and unpack_address(address)[0]:
+            # Embedded ipv4 address, e.g. ::1.2.3.4, used as ipv4 address
+            return (low & 0xFFFFFFFF) in self.ipv4_index
+        return (high << 64 | low) in self.ipv6_index
+
+    def excluded(self, addresses):
+        """
+        Returns a list of True or False for each 16 bytes address in
+        addresses, True if the address is excluded. With NumPy, IPv4
+        addresses are looked up in one vectorized pass.
+        """
+        if self.ipv4_arrays is None or not addresses:
+            return [self.is_excluded(address) for address in addresses]
+
+        words = numpy.frombuffer(
+            b''.join(addresses), dtype=">u4").reshape(-1, 4)
+        ipv4 = ((words[:, 0] == 0) & (words[:, 1] == 0) &
+                (words[:, 2] == 0xFFFF))
+        values = words[:, 3]
+        (starts, ends) = self.ipv4_arrays
+        index = numpy.searchsorted(starts, values, side='right') - 1
+        flags = ((index >= 0) & (values <= ends[index.clip(0)])).tolist()
+        for i in numpy.flatnonzero(~ipv4).tolist():
+            flags[i] = self.is_excluded(addresses[i])
+        return flags
+
+
+def list_excluded_networks(txt, networks=None):
+    """
+    Converts list of networks from configuration file into a list of tuples of
+    network address and netmask to be excluded from the crawl.
+    """
+    if isinstance(txt, bytes):
+        txt = txt.decode('utf-8', 'replace')  # ip_network() needs unicode
+    if networks is None:
+        networks = set()
+    lines = txt.strip().split('\n')
+    for line in lines:
+        line = line.split('#')[0].strip()
+        try:
+            network = ip_network(line)
+        except ValueError:
+            continue
+        else:
+            networks.add((int(network.network_address), int(network.netmask)))
+    return networks
+
+
+def save_networks(path, networks, bits, etag="", last_modified=""):
+    """
+    Writes (network address, netmask) tuples into a binary cache file as
+    network address and prefix length together with the ETag and
+    Last-Modified of the list they were parsed from.
+    """
+    records = []
+    for (network, netmask) in sorted(networks):
+        prefixlen = bin(netmask).count("1")
+        if bits == 32:
+            records.append(struct.pack(">IB", network, prefixlen))
+        else:
+            records.append(struct.pack(
+                ">QQB", network >> 64, network & 0xFFFFFFFFFFFFFFFF,
+                prefixlen))
+    etag = etag.encode('utf-8')
+    last_modified = last_modified.encode('utf-8')
+    data = b''.join([
+        NETWORKS_HEADER.pack(NETWORKS_MAGIC, NETWORKS_VERSION, bits,
+                             len(records), len(etag), len(last_modified)),
+        etag,
+        last_modified,
+    ] + records)
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, 'wb') as cache:
+        cache.write(data)
+    os.rename(tmp_path, path)
+
+
+def load_networks(path):
+    """
+    Returns (networks, bits, etag, last_modified) from a cache file written
+    by save_networks(). Raises ValueError if the file is not a valid cache.
+    """
+    with open(path, 'rb') as cache:
+        data = cache.read()
+    try:
+        (magic, version, bits, count, etag_len,
+         last_modified_len) = NETWORKS_HEADER.unpack_from(data, 0)
+    except struct.error as err:
+        raise ValueError(err)
+    if magic != NETWORKS_MAGIC or version != NETWORKS_VERSION:
+        raise ValueError("{} is not a network cache file".format(path))
+
+    offset = NETWORKS_HEADER.size
+    etag = data[offset:offset + etag_len].decode('utf-8')
+    offset += etag_len
+    last_modified = data[offset:offset + last_modified_len].decode('utf-8')
+    offset += last_modified_len
+
+    hostmask = (1 << bits) - 1
+    try:
+        if bits == 32:
+            fields = struct.unpack_from(">" + "IB" * count, data, offset)
+            networks = set([
+                (network, hostmask ^ (hostmask >> prefixlen))
+                for (network, prefixlen) in zip(fields[0::2], fields[1::2])
+            ])
+        else:
+            fields = struct.unpack_from(">" + "QQB" * count, data, offset)
+            networks = set([
+                (high << 64 | low, hostmask ^ (hostmask >> prefixlen))
+                for (high, low, prefixlen) in zip(
+                    fields[0::3], fields[1::3], fields[2::3])
+            ])
+    except struct.error as err:
+        raise ValueError(err)
+    return (networks, bits, etag, last_modified)
+
+
+def fetch_networks(url, path, bits, interval, timeout=15):
+    """
+    Returns the set of (network address, netmask) tuples listed at url using
+    the cache file at path. The list is requested only if the cache is older
+    than interval seconds, conditional on the ETag and Last-Modified of the
+    cached copy. The cached networks are returned if the list is unchanged,
+    cannot be fetched or lists no networks, e.g. an error page, so that this
+    works offline once cached. Returns an empty set if there is neither a
+    list nor a cache.
+    """
+    networks = set()
+    headers = {}
+    try:
+        (networks, _, etag, last_modified) = load_networks(path)
+    except (IOError, OSError, ValueError):
+        pass
+    else:
+        if time.time() - os.path.getmtime(path) < interval:
+            return networks
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+    try:
+        response = requests.get(url, headers=headers, timeout=timeout)
+    except requests.exceptions.RequestException as err:
+        logging.warning(err)
+        return networks
+
+    if response.status_code == 304:
+        os.utime(path, None)  # cache is fresh for another interval
+    elif response.status_code == 200:
+        fetched = list_excluded_networks(response.content)
+        if not fetched:
+            logging.warning("%s: no networks listed, keeping %d cached",
+                            url, len(networks))
+            return networks
+        networks = fetched
+        save_networks(path, networks, bits,
+                      etag=response.headers.get('ETag', ""),
+                      last_modified=response.headers.get('Last-Modified', ""))
+    else:
+        logging.warning("%s: HTTP %d", url, response.status_code)
+    return networks
+
+
+def pack_node(address, port, services, height=None):
+    """
+    Returns node as a 26 bytes Redis set member, or 30 bytes with height.
+    """
+    node = NODE.pack(pack_address(address), port, services)
+    if height is None:
+        return node
+    return node + HEIGHT.pack(height)
+
+
+def unpack_node(data):
+    """
+    Returns (address, port, services) for a member from pack_node(), or
+    (address, port, services, height) if the member includes height.
+    """
+    (ip_addr, port, services) = NODE.unpack_from(data)
+    address = [a for a in unpack_address(ip_addr) if a][0]
+    if len(data) == NODE.size:
+        return (address, port, services)
+    return (address, port, services, HEIGHT.unpack_from(data, NODE.size)[0])
+
+
+def pack_opendata(address, port, version, user_agent, timestamp, services):
+    """
+    Returns data of an open connection as a Redis set member.
+    """
+    return b''.join([
+        NODE.pack(pack_address(address), port, services),
+        OPENDATA.pack(version, timestamp),
+        user_agent,
+    ])
+
+
+def unpack_opendata(data):
+    """
+    Returns (address, port, version, user_agent, timestamp, services) for a
+    member from pack_opendata().
+    """
+    (address, port, services) = unpack_node(data[:NODE.size])
+    (version, timestamp) = OPENDATA.unpack_from(data, NODE.size)
+    user_agent = bytes(data[NODE.size + OPENDATA.size:])
+    return (address, port, version, user_agent, timestamp, services)
+
+
+def upgrade_node_member(key, member):
+    """
+    Returns the packed member for a member of key written prior to
+    pack_node(), i.e. a repr() tuple. Returns None if member is already
+    packed.
+    """
+    if not (member.startswith(b"(") and member.endswith(b")")):
+        return None
+    try:
+        node = literal_eval(member.decode('utf-8'))
+    except (SyntaxError, TypeError, ValueError):  # packed IPv6 member
+        return None
+    if key == 'opendata':
+        (address, port, version, user_agent, timestamp, services) = node
+        if not isinstance(user_agent, bytes):
+            user_agent = user_agent.encode('utf-8')
+        return pack_opendata(address, port, version, user_agent,
+                             int(timestamp), services)
+    return pack_node(*node)
+
+
+def migrate_nodes(redis_conn, keys=NODE_KEYS):
+    """
+    Converts members of the Redis sets in keys written prior to pack_node()
+    into packed members once. Returns the number of converted members.
+    """
+    if not redis_conn.setnx('migrated:nodes', int(time.time())):
+        return 0
+    migrated = 0
+    for key in keys:
+        if redis_conn.type(key) != b"set":
+            continue
+        redis_pipe = redis_conn.pipeline()
+        for member in redis_conn.sscan_iter(key, count=1000):
+            packed = upgrade_node_member(key, member)
+            if packed is None:
+                continue
+            redis_pipe.srem(key, member)
+            redis_pipe.sadd(key, packed)
+            migrated += 1
+        redis_pipe.execute()
+    return migrated